@@ -0,0 +1,144 @@
+"""
+Load benchmark for the asyncio ingest server (lidar.async_server.AsyncLidarServer).
+
+Simulated sensors replay the rotation in test.txt as fast as the server
+accepts it.  A fixed number of rotations is split across the sensors and
+the time until the server has decoded all of them is measured, so the
+rotations/sec figure is the ingest capacity for each sensor count.
+With `--decode-workers 0 1 2 4` the same load is repeated with frames
+decoded in that many worker processes (0 = on the event loop), which shows
+how decoding scales with cores.
+
+`--verify` first runs two servers (LidarServer instances) in the same
+process and checks that each one counts only the rotations sent to it,
+and that a sensor that reconnects keeps its "host:sensor_id" entry.
+
+    python benchmarks/bench_async_server.py --verify
+    python benchmarks/bench_async_server.py --sensors 1 10 100 --rotations 3000
+    python benchmarks/bench_async_server.py --sensors 16 --decode-workers 0 1 2 4
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lidar import codec, server  # noqa: E402
+from lidar.async_server import AsyncLidarServer  # noqa: E402
+
+
+def load_lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if "theta" in line]
+
+
+async def simulated_sensor(port, frame, rotations, sensor_id=None):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    if sensor_id is not None:
+        writer.write(codec.build_hello(sensor_id))
+    for _ in range(rotations):
+        writer.write(frame)
+        await writer.drain()
+    writer.close()
+    await writer.wait_closed()
+
+
+async def viewer(port):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        while await reader.read(65536):
+            pass
+    finally:
+        writer.close()
+
+
+async def run(sensor_count, viewer_count, rotations, frame, decode_workers=0):
+    lidar_server = AsyncLidarServer(server.LidarServer(host="127.0.0.1", lidar_port=0, monitor_ports=(0, 0),
+                                                       decode_workers=decode_workers, metrics_port=None))
+    await lidar_server.start()
+    viewers = [asyncio.ensure_future(viewer(lidar_server.monitor_port[0])) for _ in range(viewer_count)]
+    await asyncio.sleep(0.1)
+
+    per_sensor = max(1, rotations // sensor_count)
+    expected = per_sensor * sensor_count
+    start = time.perf_counter()
+    await asyncio.gather(*(simulated_sensor(lidar_server.lidar_port, frame, per_sensor)
+                           for _ in range(sensor_count)))
+
+    # ソケットに残っているフレームを処理し終えるまで待つ
+    while sum(lidar_server.rotation_counts.values()) < expected:
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - start
+
+    await lidar_server.close()
+    await asyncio.gather(*viewers, return_exceptions=True)
+    return expected, elapsed
+
+
+async def verify(frame):
+    lidar_servers = [server.LidarServer(host="127.0.0.1", lidar_port=0, monitor_ports=(0, 0), metrics_port=None)
+                     for _ in range(2)]
+    async_servers = [AsyncLidarServer(lidar_server) for lidar_server in lidar_servers]
+    for async_server in async_servers:
+        await async_server.start()
+    ports = {async_server.lidar_port for async_server in async_servers}
+    assert len(ports) == 2, f"both servers bound {ports}"
+    counts = (3, 5)
+    await asyncio.gather(*(simulated_sensor(async_server.lidar_port, frame, count)
+                           for async_server, count in zip(async_servers, counts)))
+    for async_server, count in zip(async_servers, counts):
+        while sum(async_server.rotation_counts.values()) < count:
+            await asyncio.sleep(0.001)
+    for async_server in async_servers:
+        await async_server.close()
+    received = tuple(sum(sensor.rotations_received for sensor in lidar_server.metrics.sensors.values())
+                     for lidar_server in lidar_servers)
+    assert received == counts, f"rotations per server {received}, sent {counts}"
+    print(f"verify: two servers in one process OK ({counts[0]} / {counts[1]} rotations)")
+
+    # 再接続しても（送信元ポートが変わっても）同じセンサーのまま
+    lidar_server = server.LidarServer(host="127.0.0.1", lidar_port=0, monitor_ports=(0, 0), metrics_port=None)
+    async_server = AsyncLidarServer(lidar_server)
+    await async_server.start()
+    for connection in range(1, 4):
+        await simulated_sensor(async_server.lidar_port, frame, 2, sensor_id=7)
+        while sum(async_server.rotation_counts.values()) < connection * 2 or async_server.connected:
+            await asyncio.sleep(0.001)
+    await async_server.close()
+    assert set(lidar_server.metrics.sensors) == {"127.0.0.1:7"}, f"sensors {set(lidar_server.metrics.sensors)}"
+    print("verify: reconnecting sensor keeps one entry OK")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--verify", action="store_true", help="check two servers in one process first")
+    parser.add_argument("--sensors", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--viewers", type=int, default=0, help="number of port 8001 viewers")
+    parser.add_argument("--rotations", type=int, default=3000, help="total rotations over all sensors")
+    parser.add_argument("--input", default=os.path.join(os.path.dirname(__file__), "..", "test.txt"))
+    parser.add_argument("--decode-workers", type=int, nargs="+", default=[0],
+                        help="worker processes for decoding (0 = on the event loop)")
+    args = parser.parse_args()
+
+    server.logger.setLevel(logging.ERROR)
+    server.load_numpy()  # serve_forever() と同じく NumPy で解凍する
+    frame = bytes(codec.compress_data(load_lines(args.input), int(time.time() * 1e6)))
+
+    if args.verify:
+        asyncio.run(verify(frame))
+
+    print(f"{os.cpu_count()} CPUs")
+    print(f"{'workers':>8} {'sensors':>8} {'decoded':>8} {'seconds':>8} {'rot/s':>10} {'rot/s/sensor':>13} {'MB/s':>8}")
+    for decode_workers in args.decode_workers:
+        for sensor_count in args.sensors:
+            decoded, elapsed = asyncio.run(run(sensor_count, args.viewers, args.rotations, frame, decode_workers))
+            rate = decoded / elapsed
+            print(f"{decode_workers:>8} {sensor_count:>8} {decoded:>8} {elapsed:>8.2f} {rate:>10.1f} "
+                  f"{rate / sensor_count:>13.2f} {rate * len(frame) / 1e6:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
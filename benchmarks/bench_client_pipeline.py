@@ -0,0 +1,186 @@
+"""
+Benchmark for the client under a stalled or dropped network.
+
+test.txt is replayed at the sensor rate (`--speed 1` = 10 Hz) for
+`--seconds` to an in-process receiver that decodes the frames with
+server.FrameParser.  `--at` seconds in, the receiver either
+  * stall:      stops reading for `--stall` seconds (small socket buffers, so
+                sendall blocks as it would on a congested link), or
+  * disconnect: closes the connection (the client has to reconnect).
+Compared are
+  * single:   the loop before the pipeline: process_lidar_data() reads,
+              compresses and sends on one thread, and a failed send restarts
+              the LiDAR (here: the replay continues where it was)
+  * pipeline: ClientPipeline with drop-oldest queues
+Reported: the longest gap between two rotations read from the sensor (on
+the Pi this is how long ultra_simple's stdout was not drained), rotations
+read / decoded by the receiver / dropped or skipped in the client, and how
+often the connection or the LiDAR was restarted.
+
+    python benchmarks/bench_client_pipeline.py
+    python benchmarks/bench_client_pipeline.py --keyframe-interval 10 --scenario disconnect
+"""
+import argparse
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lidar import client, server  # noqa: E402
+
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test.txt")
+SOCKET_BUFFER = 8192  # 送受信のバッファを小さくして，読まれないとすぐ sendall が止まるようにする
+
+
+class TimedSource:
+    """ReplaySource that remembers when each rotation was read and can be resumed after a restart."""
+    def __init__(self, path, speed, count):
+        self.replay = client.ReplaySource(path, speed, count)
+        self.iterator = iter(self.replay)
+        self.read_times = []
+
+    @property
+    def exhausted(self):
+        return self.replay.exhausted
+
+    def __iter__(self):
+        for rotation in self.iterator:
+            self.read_times.append(time.perf_counter())
+            yield rotation
+
+
+class Receiver(threading.Thread):
+    """Accept connections one after another and decode the frames, misbehaving once."""
+    def __init__(self, scenario, at, stall):
+        super().__init__(daemon=True)
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen()
+        self.port = self.listener.getsockname()[1]
+        self.scenario = scenario
+        self.at = at
+        self.stall = stall
+        self.start_time = None
+        self.misbehaved = False
+        self.decoded = 0
+        self.connections = 0
+        self.metrics = server.SensorMetrics()
+
+    def run(self):
+        while True:
+            connection, _ = self.listener.accept()
+            self.connections += 1
+            if self.start_time is None:
+                self.start_time = time.perf_counter()
+            parser = server.FrameParser(self.metrics)  # 接続ごとに新しい状態（サーバーと同じ）
+            with connection:
+                while True:
+                    if not self.misbehaved and time.perf_counter() - self.start_time >= self.at:
+                        self.misbehaved = True
+                        if self.scenario == "disconnect":
+                            break
+                        time.sleep(self.stall)
+                    connection.settimeout(0.1)
+                    try:
+                        data = connection.recv(65536)
+                    except socket.timeout:
+                        continue
+                    except OSError:
+                        break
+                    if not data:
+                        break
+                    self.decoded += len(parser.feed(data))
+
+
+def small_buffer_socket(port):
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+    client_socket.settimeout(client.SOCKET_TIMEOUT)
+    client_socket.connect(("127.0.0.1", port))
+    return client_socket
+
+
+def process_lidar_data(socket_connection, keyframe_interval=None, source=None):
+    """The client loop before ClientPipeline: read, compress and send on one thread until sending fails."""
+    compress, _ = client.make_compressor(keyframe_interval=keyframe_interval)
+    for rotation in client.get_lidar_data(source):
+        client.log_rotation(rotation)
+        if not client.check_rotation(rotation):
+            continue  # 次の回転へ
+
+        compressed_data = compress(rotation)
+        if compressed_data:
+            try:
+                socket_connection.sendall(compressed_data)
+            except Exception as e:
+                client.logger.exception(f"Error during data transmission: {e}")
+                break
+
+
+def run_single(source, port, args):
+    restarts = 0
+    while not source.exhausted:
+        with small_buffer_socket(port) as client_socket:
+            process_lidar_data(client_socket, keyframe_interval=args.keyframe_interval, source=source)
+        if not source.exhausted:
+            restarts += 1  # 従来は送信に失敗すると LiDAR のプロセスを起動し直していた
+    return {"dropped": 0, "reconnects": restarts, "lidar_restarts": restarts}
+
+
+class BenchPipeline(client.ClientPipeline):
+    def _connect(self):
+        while self.running:
+            try:
+                return small_buffer_socket(self.server_address[1])
+            except OSError:
+                time.sleep(client.RECONNECT_DELAY)
+        return None
+
+
+def run_pipeline(source, port, args):
+    pipeline = BenchPipeline("127.0.0.1", port, keyframe_interval=args.keyframe_interval, source=source)
+    pipeline.run()
+    dropped = pipeline.rotation_queue.dropped_count + pipeline.frame_queue.dropped_count + pipeline.skipped_count
+    return {"dropped": dropped, "reconnects": pipeline.reconnect_count, "lidar_restarts": 0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=["stall", "disconnect"], default="stall")
+    parser.add_argument("--seconds", type=float, default=8.0)
+    parser.add_argument("--at", type=float, default=2.0, help="seconds before the receiver misbehaves")
+    parser.add_argument("--stall", type=float, default=3.0)
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--keyframe-interval", type=int, default=None, help="predictive mode")
+    args = parser.parse_args()
+    server.load_numpy()
+
+    rotations = int(args.seconds * 10 * args.speed)
+    print(f"{args.scenario}, {rotations} rotations at {args.speed * 10:.0f} Hz, "
+          f"{'predictive' if args.keyframe_interval else 'fixed'} encoding")
+    print(f"{'client':<10}{'max gap ms':>12}{'read':>7}{'decoded':>9}{'dropped':>9}{'reconnects':>12}"
+          f"{'LiDAR restarts':>16}")
+    with tempfile.TemporaryDirectory() as log_dir:
+        client.logging_setup(log_dir)
+        client.logger.setLevel(logging.CRITICAL)
+        for name, run in (("single", run_single), ("pipeline", run_pipeline)):
+            receiver = Receiver(args.scenario, args.at, args.stall)
+            receiver.start()
+            source = TimedSource(TEST_FILE, args.speed, rotations)
+            result = run(source, receiver.port, args)
+            time.sleep(0.5)  # 受信側が残りを読み終えるまで待つ
+            times = source.read_times
+            max_gap = max(b - a for a, b in zip(times, times[1:])) if len(times) > 1 else float("nan")
+            print(f"{name:<10}{max_gap * 1e3:>12.0f}{len(times):>7}{receiver.decoded:>9}{result['dropped']:>9}"
+                  f"{result['reconnects']:>12}{result['lidar_restarts']:>16}")
+        client.logging_shutdown()
+
+
+if __name__ == "__main__":
+    main()
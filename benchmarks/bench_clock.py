@@ -0,0 +1,204 @@
+"""
+Benchmark for the clock-offset estimation (server.ClockSync) and the
+corrected per-rotation delay.
+
+Simulation: a sensor clock with an offset of `--offset` s and a drift of
+`--drift` ppm answers one TIME_PING per second over a link whose one-way
+delays are a fixed base (different up and down) plus exponential jitter
+and occasional spikes.  Reported: the error of the estimated offset after
+10, 30 and 60 exchanges, for ClockSync and for the naive estimate from the
+last exchange only.
+
+End to end: client.ClientPipeline replays test.txt at 10 Hz with its clock
+(client.time and codec.time) shifted and drifting as above, and
+LidarServer.handle_lidar_client receives it over loopback.  Reported from
+the 8002 messages: the delay without correction, the printed (corrected)
+delay, the true delay and the stages, with and without the client
+answering the time sync.  That the estimate is within 1 ms of the true
+offset after 30 exchanges is checked by tests/test_clock_sync.py.
+
+    python benchmarks/bench_clock.py
+    python benchmarks/bench_clock.py --offset -3.5 --drift 80 --rotations 300
+"""
+import argparse
+import logging
+import os
+import random
+import re
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lidar import client, codec, server  # noqa: E402
+
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test.txt")
+DELAY_PATTERN = re.compile(r"Delay: (-?[\d.]+)sec")
+STAGE_PATTERN = re.compile(r"(\w+): (-?[\d.]+)sec")
+
+
+class SimulatedLink:
+    """One-way delays [us]: base + exponential jitter, sometimes a spike."""
+    def __init__(self, rng, up_base, down_base, jitter, spike=0.05):
+        self.rng = rng
+        self.up_base = up_base
+        self.down_base = down_base
+        self.jitter = jitter
+        self.spike = spike
+
+    def delay(self, base):
+        delay = base + self.rng.expovariate(1.0 / self.jitter)
+        if self.rng.random() < self.spike:
+            delay += self.rng.uniform(10000, 100000)  # 再送や混雑
+        return delay
+
+
+def simulate(offset_us, drift, link, exchanges, checkpoints):
+    """Errors [us] of (ClockSync, last exchange) at the checkpoints."""
+    clock = server.ClockSync()
+    server_time = 1.7e15
+    errors = {}
+    for index in range(1, exchanges + 1):
+        server_time += 1e6
+        t1 = server_time
+        t2 = t1 + link.delay(link.down_base)
+        t3 = t2 + 50  # クライアントが応答するまで
+        t4 = t3 + link.delay(link.up_base)
+
+        def client_clock(t):
+            return t + offset_us + drift * (t - 1.7e15)
+        clock.add_sample(t1, client_clock(t2), client_clock(t3), t4)
+        last = ((client_clock(t2) - t1) + (client_clock(t3) - t4)) / 2
+        if index in checkpoints:
+            truth = offset_us + drift * (t4 - 1.7e15)
+            errors[index] = (clock.offset_at(t4) - truth, last - truth)
+    return errors
+
+
+class SkewedTime:
+    """Stand-in for client.time / codec.time: time() runs `offset` seconds off and drifts by `drift`."""
+    def __init__(self, offset, drift):
+        self.offset = offset
+        self.drift = drift
+        self.origin = time.time()
+
+    def time(self):
+        now = time.time()
+        return now + self.offset + self.drift * (now - self.origin)
+
+    def true_time(self, client_time):
+        """Real time of a client time."""
+        return (client_time - self.offset + self.drift * self.origin) / (1 + self.drift)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class CollectingManager:
+    """Receives what would go to the viewers; keeps (8002 text, true delay, delay without correction)."""
+    def __init__(self, clock):
+        self.clock = clock
+        self.messages = []
+        self.timestamp = None
+
+    def broadcast_8001(self, message):
+        self.timestamp = message.timestamp
+
+    def broadcast_8002(self, message):
+        now = time.time()
+        true_delay = now - self.clock.true_time(self.timestamp / 1e6)
+        self.messages.append((message, true_delay, now - self.timestamp / 1e6))
+
+
+def run_end_to_end(offset, drift, rotations, time_sync):
+    skewed = SkewedTime(offset, drift)
+    manager = CollectingManager(skewed)
+    lidar_server = server.LidarServer(metrics_port=None)  # センサー "default" の時計の推定を前の実行から持ち越さない
+    lidar_server.monitor_manager = manager
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+
+    def accept():
+        connection, _ = listener.accept()
+        lidar_server.handle_lidar_client(connection)
+    handler = threading.Thread(target=accept, daemon=True)
+    handler.start()
+
+    saved, client.time, codec.time = client.time, skewed, skewed  # TIME_PONG は codec が時刻を付ける
+    try:
+        source = client.ReplaySource(TEST_FILE, 1.0, rotations)
+        pipeline = client.ClientPipeline("127.0.0.1", listener.getsockname()[1], encoding=client.ENCODING_RICE,
+                                         source=source, time_sync=time_sync)
+        pipeline.run()
+    finally:
+        client.time = codec.time = saved
+    handler.join(timeout=10)
+    listener.close()
+    return manager.messages, lidar_server.metrics.sensor(None).clock
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--offset", type=float, default=2.5, help="sensor clock - server clock [s]")
+    parser.add_argument("--drift", type=float, default=50.0, help="sensor clock drift [ppm]")
+    parser.add_argument("--rotations", type=int, default=200, help="rotations replayed at 10 Hz end to end")
+    parser.add_argument("--skip", type=int, default=20, help="first rotations left out of the error (no estimate yet)")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    checkpoints = (10, 30, 60)
+    print(f"simulated link, offset {args.offset} s, drift {args.drift} ppm: |offset error| p50 / max in us")
+    print(f"{'link':<26}" + "".join(f"{f'{n} ClockSync':>16}{f'{n} last':>16}" for n in checkpoints))
+    for name, up, down, jitter in (("LAN (0.2 ms, 0.5 ms jit)", 200, 200, 500),
+                                   ("Wi-Fi (asym, 3 ms jit)", 1500, 500, 3000)):
+        errors = {n: ([], []) for n in checkpoints}
+        for _ in range(200):
+            link = SimulatedLink(rng, up, down, jitter)
+            for n, (synced, last) in simulate(args.offset * 1e6, args.drift * 1e-6, link, max(checkpoints),
+                                              set(checkpoints)).items():
+                errors[n][0].append(abs(synced))
+                errors[n][1].append(abs(last))
+        print(f"{name:<26}" + "".join(f"{percentile(s, 0.5):>7.0f} / {max(s):<6.0f}{percentile(l, 0.5):>7.0f} / "
+                                      f"{max(l):<6.0f}" for s, l in errors.values()))
+
+    with tempfile.TemporaryDirectory() as log_dir:
+        server.logging_setup(log_dir)
+        server.load_numpy()
+        server.logger.setLevel(logging.ERROR)
+        client.logger.setLevel(logging.ERROR)
+        print(f"\nend to end, {args.rotations} rotations at 10 Hz, client clock {args.offset:+} s, {args.drift} ppm "
+              f"(first {args.skip} left out); ms")
+        print(f"{'client':<10}{'raw p50':>9}{'shown p50':>11}{'true p50':>10}{'max |err|':>11}"
+              + "".join(f"{stage:>10}" for stage in server.LATENCY_STAGES) + f"{'offset est':>12}")
+        for name, time_sync in (("time sync", True), ("no sync", False)):
+            messages, clock = run_end_to_end(args.offset, args.drift * 1e-6, args.rotations, time_sync)
+            messages = messages[args.skip:]
+            shown, true, raw, stages = [], [], [], {stage: [] for stage in server.LATENCY_STAGES}
+            for text, true_delay, raw_delay in messages:
+                shown.append(float(DELAY_PATTERN.search(text).group(1)))
+                true.append(true_delay)
+                raw.append(raw_delay)
+                if "Stages:" in text:
+                    for stage, seconds in STAGE_PATTERN.findall(text.split("Stages:")[1]):
+                        stages[stage].append(float(seconds))
+            error = max((abs(s - t) for s, t in zip(shown, true)), default=float("nan"))
+            estimate = clock.offset_at(time.time() * 1e6) / 1e6 if clock.offset is not None else float("nan")
+            print(f"{name:<10}{percentile(raw, 0.5) * 1e3:>9.1f}{percentile(shown, 0.5) * 1e3:>11.1f}"
+                  f"{percentile(true, 0.5) * 1e3:>10.1f}{error * 1e3:>11.1f}"
+                  + "".join(f"{percentile(stages[stage], 0.5) * 1e3:>10.1f}" for stage in server.LATENCY_STAGES)
+                  + f"{estimate:>12.4f}")
+        server.logging_shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""
+Codec benchmark and round-trip check.
+
+Compares, per rotation, the encoded size and encode/decode time of
+  * fixed         27-bit records, pure-Python reference (codec.compress_points / codec.decode_points)
+  * fixed-numpy   the same format with NumPy (codec.compress_points_numpy / codec.decode_points_numpy)
+  * rice          zigzag + Rice coding with a per-rotation parameter
+  * varint        zigzag + LEB128 varints
+and then the average size over a simulated static scene (test.txt with
+angular offset and distance noise per rotation) for the intra-coded modes
+and the predictive mode (codec.PredictiveEncoder, `--keyframe-interval`),
+and finally the lossy mode (codec.compress_points_lossy) for several
+angle bin / distance step settings: bytes per rotation against the
+guaranteed and the measured maximum error of the kept points.
+`--verify` first checks on random rotations that the NumPy codec produces
+the same bytes / points as the reference, that every mode round-trips and
+that the lossy mode stays within its error bound.
+
+    python benchmarks/bench_codec.py --verify --repeat 200
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lidar import codec, server  # noqa: E402
+
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test.txt")
+
+
+def load_lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if "theta" in line and "S" not in line]
+
+
+def parse_lines(lines):
+    theta_values, dist_values = [], []
+    for line in lines:
+        fields = line.split()
+        theta_values.append(int(float(fields[1]) * 100))
+        dist_values.append(int(float(fields[3])))
+    return theta_values, dist_values
+
+
+def random_rotation(rng):
+    """ultra_simple と同じ書式のランダムな一周分（差分が範囲外になる周も含む）"""
+    lines = []
+    theta = rng.uniform(0.0, 10.0)
+    dist = rng.randint(0, 14000)
+    while theta < 360.0:
+        if rng.random() < 0.01:
+            lines.append("theta: 0.00 Dist: 00000.00 Q: 0")
+        lines.append(f"theta: {theta:.2f} Dist: {dist:08.2f} Q: {rng.randint(0, 63)}")
+        theta += rng.uniform(0.0, 1.2) if rng.random() > 0.002 else rng.uniform(-15.0, 15.0)
+        theta = max(theta, 0.0)
+        dist = min(max(dist + int(rng.gauss(0, 40 if rng.random() > 0.01 else 8000)), 0), 65535)
+    return lines
+
+
+def expected_points(theta_values, dist_values):
+    points = [(theta, dist) for theta, dist in zip(theta_values, dist_values) if theta or dist]
+    theta_deltas = [b[0] - a[0] for a, b in zip(points, points[1:])]
+    dist_deltas = [b[1] - a[1] for a, b in zip(points, points[1:])]
+    return codec.accumulate_points(points[0][0], points[0][1], theta_deltas, dist_deltas)
+
+
+def static_scene(theta_values, dist_values, count, rng):
+    """同じ場所を見続けるLiDARの連続した周（角度のずれと距離のノイズのみ）"""
+    rotations = []
+    for _ in range(count):
+        offset = rng.randint(-25, 25)
+        rotations.append(([max(theta + offset + rng.randint(-2, 2), 1) for theta in theta_values],
+                          [max(dist + int(rng.gauss(0, 3)), 0) if dist else 0 for dist in dist_values]))
+    return rotations
+
+
+def decode(frame_bytes):
+    frame = server.FrameParser().split(frame_bytes)[0]
+    return codec.decode_frame(frame)[1]
+
+
+def verify(count, seed):
+    rng = random.Random(seed)
+    rotations = [load_lines(TEST_FILE)] + [random_rotation(rng) for _ in range(count)]
+    for index, lines in enumerate(rotations):
+        theta_values, dist_values = parse_lines(lines)
+        expected = expected_points(theta_values, dist_values)
+
+        reference = codec.compress_data(lines, index)
+        if codec.np is not None:
+            assert codec.compress_data_numpy(lines, index) == reference, f"numpy encoder mismatch in rotation {index}"
+        if reference is not None:
+            frame = server.FrameParser().split(reference)[0]
+            assert codec.decode_points(frame.payload, frame.point_count) == expected, \
+                f"fixed decoder mismatch in rotation {index}"
+            if codec.np is not None:
+                assert codec.decode_points_numpy(frame.payload, frame.point_count) == expected, \
+                    f"numpy decoder mismatch in rotation {index}"
+
+        for encoding in (codec.ENCODING_RICE, codec.ENCODING_VARINT):
+            encoded = codec.compress_points_adaptive(theta_values, dist_values, index, encoding)
+            assert decode(encoded) == expected, f"encoding {encoding} round-trip mismatch in rotation {index}"
+
+    # 予測モード: 1つの接続で連続した周を送り，参照する周を引き継いで解凍できるか
+    theta_values, dist_values = parse_lines(load_lines(TEST_FILE))
+    encoder = codec.PredictiveEncoder(keyframe_interval=7)
+    frame_parser = server.FrameParser()
+    for index, (theta_values, dist_values) in enumerate(static_scene(theta_values, dist_values, count, rng)):
+        decoded = frame_parser.feed(encoder.encode(theta_values, dist_values, index))
+        assert decoded == [(index, expected_points(theta_values, dist_values), None)], \
+            f"predictive round-trip mismatch in rotation {index}"
+    # 非可逆モード: 誤差が保証した範囲に収まるか
+    for index, lines in enumerate(rotations):
+        theta_values, dist_values = parse_lines(lines)
+        quantization = codec.Quantization(rng.randint(1, 400), rng.randint(1, 200))
+        for encoding in (codec.ENCODING_RICE, codec.ENCODING_VARINT):
+            encoded = codec.compress_points_lossy(theta_values, dist_values, index, quantization, encoding)
+            if encoded is None:
+                continue
+            theta_error, dist_error = lossy_errors(theta_values, dist_values, quantization, decode(encoded))
+            max_theta_error, max_dist_error = codec.quantization_max_error(quantization)
+            assert theta_error <= max_theta_error + 1e-9 and dist_error <= max_dist_error, \
+                f"lossy error out of bound in rotation {index} ({quantization})"
+    print(f"verify: {len(rotations)} rotations + {count} predicted rotations + lossy OK (seed={seed})")
+
+
+LOSSY_SETTINGS = [(1, 1), (10, 1), (50, 1), (50, 10), (100, 10), (100, 50), (200, 100)]  # (0.01°, mm)
+
+
+def lossy_errors(theta_values, dist_values, quantization, decoded):
+    """復元した点と，その点に選ばれた元の点との差の最大（角度[°], 距離[mm]）"""
+    _, _, source_indices = codec.quantize_points(theta_values, dist_values, quantization)
+    assert len(decoded) == len(source_indices)
+    theta_error = max((abs(theta - theta_values[i] / 100.0) for (theta, _), i in zip(decoded, source_indices)),
+                      default=0.0)
+    dist_error = max((abs(dist - dist_values[i]) for (_, dist), i in zip(decoded, source_indices)), default=0)
+    return theta_error, dist_error
+
+
+def measure(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--verify", action="store_true", help="run the round-trip check first")
+    parser.add_argument("--count", type=int, default=500, help="random rotations for --verify")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--keyframe-interval", type=int, default=10)
+    parser.add_argument("--scene", type=int, default=100, help="rotations of the simulated static scene")
+    parser.add_argument("--input", default=TEST_FILE)
+    args = parser.parse_args()
+
+    logging.getLogger("MyLogger").setLevel(logging.ERROR)
+    codec.load_numpy()
+    if args.verify:
+        verify(args.count, args.seed)
+
+    lines = load_lines(args.input)
+    raw_size = sum(len(line) + 1 for line in lines)
+    theta_values, dist_values = parse_lines(lines)
+
+    encoders = [("fixed", lambda: codec.compress_points(theta_values, dist_values, 0), codec.decode_points)]
+    if codec.np is not None:
+        encoders.append(("fixed-numpy", lambda: codec.compress_points_numpy(theta_values, dist_values, 0),
+                         codec.decode_points_numpy))
+    for name, encoding in (("rice", codec.ENCODING_RICE), ("varint", codec.ENCODING_VARINT)):
+        encoders.append((name, lambda e=encoding: codec.compress_points_adaptive(theta_values, dist_values, 0, e),
+                         None))
+
+    fixed_size = None
+    print(f"{len(lines)} points per rotation, {raw_size} bytes of text")
+    print(f"{'mode':<12} {'bytes':>6} {'vs text':>8} {'vs fixed':>9} {'encode ms':>10} {'decode ms':>10}")
+    for name, encoder, decoder in encoders:
+        encode_time, encoded = measure(encoder, args.repeat)
+        frame = server.FrameParser().split(encoded)[0]
+        if decoder is None:
+            decode_time, _ = measure(lambda: codec.decode_frame(frame), args.repeat)
+        else:
+            decode_time, _ = measure(lambda: decoder(frame.payload, frame.point_count), args.repeat)
+        fixed_size = fixed_size or len(encoded)
+        print(f"{name:<12} {len(encoded):>6} {raw_size / len(encoded):>7.2f}x {fixed_size / len(encoded):>8.2f}x "
+              f"{encode_time * 1e3:>10.3f} {decode_time * 1e3:>10.3f}")
+
+    scene = static_scene(theta_values, dist_values, args.scene, random.Random(args.seed))
+    encoder = codec.PredictiveEncoder(args.keyframe_interval)
+    frame_parser = server.FrameParser()
+    sizes = {"fixed": 0, "rice": 0, "predictive": 0}
+    start = time.perf_counter()
+    for index, (scene_theta, scene_dist) in enumerate(scene):
+        sizes["fixed"] += len(codec.compress_points(scene_theta, scene_dist, index))
+        sizes["rice"] += len(codec.compress_points_adaptive(scene_theta, scene_dist, index))
+    intra_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for index, (scene_theta, scene_dist) in enumerate(scene):
+        encoded = encoder.encode(scene_theta, scene_dist, index)
+        sizes["predictive"] += len(encoded)
+        frame_parser.feed(encoded)
+    predictive_time = time.perf_counter() - start
+
+    print(f"\nstatic scene, {args.scene} rotations, keyframe every {args.keyframe_interval}")
+    for name, size in sizes.items():
+        print(f"{name:<12} {size / args.scene:>8.1f} bytes/rotation {sizes['fixed'] / size:>6.2f}x vs fixed")
+    print(f"fixed + rice encode {intra_time / args.scene * 1e3:.3f} ms/rotation, "
+          f"predictive encode + decode {predictive_time / args.scene * 1e3:.3f} ms/rotation")
+
+    print("\nlossy mode (rice), bytes/rotation vs error of the kept points")
+    print(f"{'angle step':>10} {'dist step':>9} {'points':>6} {'bytes':>6} {'vs fixed':>9} "
+          f"{'max err':>16} {'measured':>16}")
+    for angle_step, dist_step in LOSSY_SETTINGS:
+        quantization = codec.Quantization(angle_step, dist_step)
+        encoded = codec.compress_points_lossy(theta_values, dist_values, 0, quantization)
+        decoded = decode(encoded)
+        theta_error, dist_error = lossy_errors(theta_values, dist_values, quantization, decoded)
+        max_theta_error, max_dist_error = codec.quantization_max_error(quantization)
+        print(f"{angle_step / 100:>9.2f}° {dist_step:>7}mm {len(decoded):>6} {len(encoded):>6} "
+              f"{fixed_size / len(encoded):>8.2f}x {max_theta_error:>7.3f}° {max_dist_error:>5.1f}mm "
+              f"{theta_error:>7.3f}° {dist_error:>5.1f}mm")
+
+
+if __name__ == "__main__":
+    main()
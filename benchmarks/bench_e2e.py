@@ -0,0 +1,207 @@
+"""
+End-to-end benchmark: client.py and server.py against each other over loopback.
+
+For every encoding mode server.py is started as a subprocess, a viewer is
+connected to its delay port (8002 output) and client.py replays test.txt
+(`--rotations` rotations at `--speed`, 0 = as fast as possible) through a
+byte-counting relay.  Reported per mode:
+  * rotations/s received by the server (first to last rotation on 8002)
+  * bytes per rotation on the wire
+  * CPU ms per rotation of the client and of the server process
+  * p50 / p99 of the delay that format_timestamp() prints on 8002
+
+    python benchmarks/bench_e2e.py --rotations 2000
+    python benchmarks/bench_e2e.py --rotations 300 --speed 1     # 10 Hz, like the sensor
+"""
+import argparse
+import os
+import re
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+TEST_FILE = os.path.join(ROOT, "test.txt")
+
+MODES = [
+    ("fixed", ["--encoding", "fixed"]),
+    ("rice", ["--encoding", "rice"]),
+    ("varint", ["--encoding", "varint"]),
+    ("predictive", ["--keyframe-interval", "10"]),
+    ("lossy", ["--angle-step", "0.5", "--dist-step", "10"]),
+]  # 旧形式は区切りがなく，連続した周を分けられないので対象外
+DELAY_PATTERN = re.compile(rb"Delay: (-?[\d.]+)sec")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def connect(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return socket.create_connection(("127.0.0.1", port))
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def forward_back(upstream, connection):
+    """Copy the server's TIME_PING frames back to the client (unread data would reset the connection)."""
+    try:
+        while True:
+            data = upstream.recv(65536)
+            if not data:
+                break
+            connection.sendall(data)
+    except OSError:
+        pass
+
+
+class Relay(threading.Thread):
+    """Forward one client connection to the server and count the bytes."""
+    def __init__(self, target_port):
+        super().__init__(daemon=True)
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen()
+        self.port = self.listener.getsockname()[1]
+        self.target_port = target_port
+        self.byte_count = 0
+
+    def run(self):
+        connection, _ = self.listener.accept()
+        with connection, socket.create_connection(("127.0.0.1", self.target_port)) as upstream:
+            back = threading.Thread(target=forward_back, args=(upstream, connection), daemon=True)
+            back.start()
+            try:
+                while True:
+                    data = connection.recv(65536)
+                    if not data:
+                        break
+                    self.byte_count += len(data)
+                    upstream.sendall(data)
+            except ConnectionError:
+                pass
+            upstream.shutdown(socket.SHUT_WR)  # クライアントと同じく，サーバーが読み終えて閉じるまで待つ
+            back.join(timeout=30)
+
+
+class DelayViewer(threading.Thread):
+    """Read the 8002 output and keep the arrival time and delay of every rotation."""
+    def __init__(self, port):
+        super().__init__(daemon=True)
+        self.sock = connect(port)
+        self.arrivals = []
+        self.delays = []
+
+    def run(self):
+        buffer = b""
+        while True:
+            data = self.sock.recv(65536)
+            if not data:
+                break
+            buffer += data
+            matches = list(DELAY_PATTERN.finditer(buffer))
+            if matches:
+                now = time.perf_counter()
+                for match in matches:
+                    self.arrivals.append(now)
+                    self.delays.append(float(match.group(1)))
+                buffer = buffer[matches[-1].end():]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else float("nan")
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_mode(client_args, args, log_dir):
+    lidar_port, data_port, delay_port = free_port(), free_port(), free_port()
+    server_cmd = [sys.executable, os.path.join(ROOT, "server.py"), "--lidar-port", str(lidar_port),
+                  "--monitor-ports", str(data_port), str(delay_port), "--log-dir", log_dir,
+                  "--monitor-queue-size", str(args.rotations + 100), "--metrics-port", str(free_port())]
+    if args.asyncio:
+        server_cmd.append("--asyncio")
+    if args.async_logging:
+        server_cmd.append("--async-logging")
+
+    cpu_before = children_cpu()
+    server = subprocess.Popen(server_cmd)
+    try:
+        viewer = DelayViewer(delay_port)
+        viewer.start()
+        connect(lidar_port).close()  # 8000番ポートの準備ができるまで待つ
+        relay = Relay(lidar_port)
+        relay.start()
+
+        client_cmd = [sys.executable, os.path.join(ROOT, "client.py"), "127.0.0.1", str(relay.port),
+                      "--replay", TEST_FILE, "--speed", str(args.speed), "--rotations", str(args.rotations),
+                      "--log-dir", log_dir] + client_args
+        if args.async_logging:
+            client_cmd.append("--async-logging")
+        if not args.speed:
+            client_cmd += ["--queue-policy", "block"]  # 最大速度では古い周を捨てずに全部送る
+        start = time.perf_counter()
+        subprocess.run(client_cmd, check=True)
+        client_cpu = children_cpu() - cpu_before
+
+        # 最後の周が 8002 番ポートに届くまで待つ
+        deadline = time.monotonic() + 30
+        while len(viewer.delays) < args.rotations and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        server.terminate()
+        server.wait()
+    server_cpu = children_cpu() - cpu_before - client_cpu
+
+    received = len(viewer.delays)
+    elapsed = (viewer.arrivals[-1] - start) if received else float("nan")
+    return {
+        "received": received,
+        "rate": received / elapsed if received else 0.0,
+        "bytes": relay.byte_count / args.rotations,
+        "client_cpu": client_cpu / args.rotations * 1e3,
+        "server_cpu": server_cpu / max(received, 1) * 1e3,
+        "p50": percentile(viewer.delays, 0.50) * 1e3,
+        "p99": percentile(viewer.delays, 0.99) * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rotations", type=int, default=2000)
+    parser.add_argument("--speed", type=float, default=0.0)
+    parser.add_argument("--modes", nargs="+", choices=[name for name, _ in MODES],
+                        default=[name for name, _ in MODES])
+    parser.add_argument("--asyncio", action="store_true", help="server.py --asyncio")
+    parser.add_argument("--async-logging", action="store_true", help="both sides with --async-logging")
+    args = parser.parse_args()
+
+    print(f"{args.rotations} rotations of test.txt, speed {args.speed or 'max'}")
+    print(f"{'mode':<12}{'recv':>6}{'rot/s':>9}{'bytes/rot':>11}{'client ms':>11}{'server ms':>11}"
+          f"{'p50 ms':>9}{'p99 ms':>9}")
+    for name, client_args in MODES:
+        if name not in args.modes:
+            continue
+        with tempfile.TemporaryDirectory() as log_dir:
+            result = run_mode(client_args, args, log_dir)
+        print(f"{name:<12}{result['received']:>6}{result['rate']:>9.0f}{result['bytes']:>11.0f}"
+              f"{result['client_cpu']:>11.3f}{result['server_cpu']:>11.3f}{result['p50']:>9.1f}{result['p99']:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
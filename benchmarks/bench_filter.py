@@ -0,0 +1,181 @@
+"""
+Benchmark for server.filter_invalid_data.
+
+Rotations from test.txt get `--noise` of their points replaced by invalid
+values (angles outside 0-360°, distances over the range, angle jumps and
+distance spikes) and are filtered with
+  * legacy: the loop before the rule profiles, one warning per dropped point
+  * python: the pure-Python mask (NumPy unavailable)
+  * numpy:  the vectorized mask for every rotation
+  * auto:   filter_invalid_data as the server runs it (NumPy from
+            FILTER_NUMPY_MIN_POINTS points on)
+for the default profile and for rplidar_c1_strict (Q and median rules),
+with rotations thinned out to each of `--points` points.
+Warnings go to a temporary log file as in production.
+
+`--verify` checks on random noisy rotations that python and numpy give the
+same points and reason counts for every profile, and that the default
+profile keeps exactly what the legacy loop kept.
+
+    python benchmarks/bench_filter.py --verify --repeat 200
+    python benchmarks/bench_filter.py --points 614 500 400 300 200
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lidar import client, server  # noqa: E402
+
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test.txt")
+
+
+def legacy_filter(decompressed_data):
+    """filter_invalid_data before the rule profiles (per-point warnings)"""
+    filtered_data = []
+    delete_data_count = 0
+    prev_theta = None
+    for theta, dist in decompressed_data:
+        if not (0.0 <= theta <= 360.0):
+            server.logger.warning(f"Warning: Invalid theta value detected: {theta:.2f}, skipping...")
+            delete_data_count += 1
+            continue
+        if not (0 <= dist <= 14000):
+            server.logger.warning(f"Warning: Invalid distance value detected: {dist}, skipping...")
+            delete_data_count += 1
+            continue
+        if prev_theta is not None and abs(theta - prev_theta) > 100.0:
+            server.logger.warning(f"Warning: Sudden jump detected in theta values ({prev_theta:.2f} → {theta:.2f}), "
+                                  f"skipping...")
+            delete_data_count += 1
+            continue
+        filtered_data.append((theta, dist))
+        prev_theta = theta
+    return filtered_data, delete_data_count
+
+
+def load_rotation():
+    parser = client.StdoutRotationParser()
+    with open(TEST_FILE, "rb") as f:
+        rotation = parser.feed(f.read() + b"\n")[0]  # 最後の S 行で一周が完成する
+    return [(theta / 100, dist) for theta, dist in zip(rotation.theta, rotation.dist)]
+
+
+def noisy(points, noise, rng):
+    points = list(points)
+    for index in rng.sample(range(len(points)), int(len(points) * noise)):
+        theta, dist = points[index]
+        kind = rng.randrange(4)
+        if kind == 0:
+            points[index] = (rng.choice((-1.0, 1.0)) * rng.uniform(361.0, 700.0), dist)
+        elif kind == 1:
+            points[index] = (theta, rng.randint(30001, 60000))
+        elif kind == 2:
+            points[index] = ((theta + rng.uniform(101.0, 250.0)) % 360.0, dist)
+        else:
+            points[index] = (theta, dist + rng.randint(1500, 5000))
+    quality = bytes(rng.choice((0, 5, 15, 47)) for _ in points)
+    return points, quality
+
+
+def thinned(points, count):
+    """`count` of the points, evenly spaced and in their order."""
+    if count >= len(points):
+        return points
+    return [points[index * len(points) // count] for index in range(count)]
+
+
+class Variant:
+    """Run filter_invalid_data as "python" (server.np None), "numpy" (for every size) or "auto"."""
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.saved = server.np, server.FILTER_NUMPY_MIN_POINTS
+        if self.name == "python":
+            server.np = None
+        elif self.name == "numpy":
+            server.FILTER_NUMPY_MIN_POINTS = 1
+
+    def __exit__(self, *exc):
+        server.np, server.FILTER_NUMPY_MIN_POINTS = self.saved
+
+
+def run_filter(variant, points, rules, quality):
+    reasons = dict.fromkeys(server.FILTER_REASONS, 0)
+    if variant == "legacy":
+        return legacy_filter(points)
+    with Variant(variant):
+        result = server.filter_invalid_data(points, reasons, rules, quality)
+    server.log_filter_summary(None, result[1], reasons)
+    return result
+
+
+def verify(base, count, seed):
+    rng = random.Random(seed)
+    for index in range(count):
+        points, quality = noisy(base, rng.uniform(0.0, 0.3), rng)
+        if rng.random() < 0.1:
+            points = points[:rng.randrange(4)]  # 空や数点だけの周
+            quality = quality[:len(points)]
+        for name, rules in server.FILTER_PROFILES.items():
+            results = []
+            for variant in ("python", "numpy"):
+                with Variant(variant):
+                    reasons = dict.fromkeys(server.FILTER_REASONS, 0)
+                    results.append(server.filter_invalid_data(points, reasons, rules, quality) + (reasons,))
+            assert results[0] == results[1], f"python / numpy mismatch in rotation {index}, profile {name}"
+        assert server.filter_invalid_data(points) == legacy_filter(points), \
+            f"default profile differs from legacy in rotation {index}"
+    print(f"verify: {count} rotations x {len(server.FILTER_PROFILES)} profiles OK (seed={seed})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--verify", action="store_true", help="run the equivalence check first")
+    parser.add_argument("--count", type=int, default=300, help="random rotations for --verify")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--noise", type=float, default=0.05, help="fraction of invalid points per rotation")
+    parser.add_argument("--points", type=int, nargs="+", default=[614, 400, 200],
+                        help="points per rotation (test.txt thinned out)")
+    args = parser.parse_args()
+    server.load_numpy()
+
+    base = load_rotation()
+    with tempfile.TemporaryDirectory() as log_dir:
+        server.logging_setup(log_dir)
+        if args.verify:
+            server.logger.setLevel(logging.ERROR)
+            verify(base, args.count, args.seed)
+            server.logger.setLevel(logging.DEBUG)
+        if server.np is None:
+            print("NumPy is not installed: numpy rows are the pure-Python fallback")
+
+        rng = random.Random(args.seed)
+        print(f"{len(base)} points in test.txt, {args.noise:.0%} invalid, "
+              f"NumPy from {server.FILTER_NUMPY_MIN_POINTS} points")
+        print(f"{'profile':<20}{'points':>7}  {'variant':<9}{'ms/rotation':>13}{'dropped':>9}")
+        for count in args.points:
+            rotations = [noisy(thinned(base, count), args.noise, rng) for _ in range(16)]
+            for profile in ("rplidar_c1", "rplidar_c1_strict"):
+                rules = server.FILTER_PROFILES[profile]
+                for variant in ("legacy", "python", "numpy", "auto"):
+                    if variant == "legacy" and profile != "rplidar_c1":
+                        continue
+                    start = time.perf_counter()
+                    for index in range(args.repeat):
+                        points, quality = rotations[index % len(rotations)]
+                        _, dropped = run_filter(variant, points, rules, quality)
+                    elapsed = (time.perf_counter() - start) / args.repeat
+                    print(f"{profile:<20}{len(rotations[0][0]):>7}  {variant:<9}{elapsed * 1e3:>13.3f}{dropped:>9}")
+        server.logging_shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Benchmark for the frame CRC32 and the resynchronisation of server.FrameParser.
+
+Cost: per encoding, the time per rotation of client.append_crc, of the
+CRC32 check in FrameParser.split (split with and without FLAG_CRC) and of
+decode_frame, for rotations from test.txt.
+
+Corruption: a stream of `--rotations` frames is damaged at `--corrupt` of
+the frames (a flipped payload byte, a flipped header byte, a truncated
+frame or inserted garbage) and fed to the parser in random chunks:
+  * before:  the split loop before the resynchronisation (the first bad
+             header raised FrameError and ended the connection)
+  * no-crc:  resynchronising parser, frames without FLAG_CRC
+  * crc:     resynchronising parser, frames with FLAG_CRC
+Reported: rotations decoded correctly, decoded wrongly (points differ from
+what was sent), and lost.  That with the CRC no corrupted rotation is
+ever delivered while every undamaged frame still is, is checked by
+tests/test_integrity.py.
+
+    python benchmarks/bench_integrity.py
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lidar import client, server  # noqa: E402
+
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test.txt")
+ENCODINGS = [("fixed", client.ENCODING_FIXED), ("rice", client.ENCODING_RICE), ("varint", client.ENCODING_VARINT)]
+CORRUPTIONS = ("payload", "header", "truncate", "garbage")
+
+
+def load_rotation():
+    parser = client.StdoutRotationParser()
+    with open(TEST_FILE, "rb") as f:
+        return parser.feed(f.read() + b"\n")[0]  # 最後の S 行で一周が完成する
+
+
+class LegacySplitParser(server.FrameParser):
+    """FrameParser.split before the resynchronisation: a bad header ends the connection."""
+    def split(self, data):
+        self.buffer.extend(data)
+        frames = []
+        offset = 0
+        header_size = server.FRAME_HEADER.size
+        while len(self.buffer) - offset >= header_size:
+            magic, version, frame_type, flags, payload_length, point_count, timestamp = \
+                server.FRAME_HEADER.unpack_from(self.buffer, offset)
+            if magic != server.FRAME_MAGIC:
+                raise server.FrameError(f"Invalid frame magic: {bytes(magic)!r}")
+            if version != server.FRAME_VERSION:
+                raise server.FrameError(f"Unsupported frame version: {version}")
+            end = offset + header_size + payload_length
+            if len(self.buffer) < end:
+                break
+            payload, quality = server.split_quality(flags, point_count, bytes(self.buffer[offset + header_size:end]))
+            frames.append(server.Frame(version, frame_type, flags, point_count, timestamp, payload, quality))
+            offset = end
+        if offset:
+            del self.buffer[:offset]
+        return frames
+
+
+def make_frames(rotation, count, encoding, checksum, rng):
+    """`count` frames of slightly different rotations; the timestamp is the rotation number."""
+    compress, _ = client.make_compressor(encoding=encoding, checksum=checksum)
+    frames, expected = [], []
+    for index in range(count):
+        dist = [max(0, d + rng.randint(-20, 20)) if d else 0 for d in rotation.dist]
+        frames.append(bytes(compress(rotation._replace(start_time=index, dist=dist))))
+        expected.append([(theta, d) for theta, d in zip(rotation.theta, dist) if theta or d])
+    return frames, expected
+
+
+def corrupt(frames, rate, rng):
+    """Damage about `rate` of the frames; returns (stream, numbers of the frames that were changed)."""
+    parts, damaged = [], set()
+    for index, frame in enumerate(frames):
+        if rng.random() >= rate:
+            parts.append(frame)
+            continue
+        frame = bytearray(frame)
+        kind = rng.choice(CORRUPTIONS)
+        if kind != "garbage":
+            damaged.add(index)  # 前にゴミが入っただけのフレームは壊れていない
+        if kind == "payload":
+            frame[rng.randrange(server.FRAME_HEADER.size, len(frame))] ^= 1 << rng.randrange(8)
+        elif kind == "header":
+            frame[rng.randrange(server.FRAME_HEADER.size)] ^= 1 << rng.randrange(8)
+        elif kind == "truncate":
+            del frame[rng.randrange(1, len(frame)):]
+        else:
+            frame[:0] = bytes(rng.randrange(256) for _ in range(rng.randint(1, 64)))
+        parts.append(bytes(frame))
+    return b"".join(parts), damaged
+
+
+def feed_stream(parser, stream, rng):
+    """Feed in random chunks like recv(); returns the decoded rotations (up to a FrameError)."""
+    rotations = []
+    offset = 0
+    try:
+        while offset < len(stream):
+            size = rng.randint(1, 4096)
+            rotations.extend(parser.feed(stream[offset:offset + size]))
+            offset += size
+    except server.FrameError:
+        pass  # 従来はここで接続が切れた
+    return rotations
+
+
+def classify(rotations, expected):
+    correct = wrong = 0
+    seen = set()
+    for timestamp, points, _ in rotations:
+        decoded = [(round(theta * 100), dist) for theta, dist in points]
+        if timestamp < len(expected) and timestamp not in seen and decoded == expected[timestamp]:
+            correct += 1
+            seen.add(timestamp)
+        else:
+            wrong += 1
+    return correct, wrong, seen
+
+
+def measure(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=500)
+    parser.add_argument("--rotations", type=int, default=1000)
+    parser.add_argument("--corrupt", type=float, default=0.01, help="fraction of damaged frames")
+    args = parser.parse_args()
+    server.load_numpy()
+
+    rotation = load_rotation()
+    with tempfile.TemporaryDirectory() as log_dir:
+        server.logging_setup(log_dir)
+        server.logger.setLevel(logging.ERROR)  # 壊れたフレームごとの警告は出さない
+        print(f"{len(rotation.theta)} points per rotation")
+        print(f"{'encoding':<10}{'bytes':>7}{'append_crc us':>15}{'split us':>10}{'split+crc us':>14}{'decode us':>11}"
+              f"{'crc/decode':>12}")
+        for name, encoding in ENCODINGS:
+            plain = bytes(client.make_compressor(encoding=encoding, checksum=False)[0](rotation))
+            checked = bytes(client.append_crc(bytearray(plain)))
+            frame = server.FrameParser().split(plain)[0]
+            append = measure(lambda: client.append_crc(bytearray(plain)), args.repeat)
+            split = measure(lambda: server.FrameParser().split(plain), args.repeat)
+            split_crc = measure(lambda: server.FrameParser().split(checked), args.repeat)
+            decode = measure(lambda: server.decode_frame(frame), args.repeat)
+            print(f"{name:<10}{len(checked):>7}{append:>15.2f}{split:>10.2f}{split_crc:>14.2f}{decode:>11.1f}"
+                  f"{(split_crc - split) / decode:>12.2%}")
+
+        print(f"\n{args.rotations} rotations (rice), {args.corrupt:.1%} of the frames damaged")
+        print(f"{'parser':<10}{'correct':>9}{'wrong':>7}{'lost':>7}")
+        for name, parser_class, checksum in (("before", LegacySplitParser, False),
+                                             ("no-crc", server.FrameParser, False),
+                                             ("crc", server.FrameParser, True)):
+            rng = random.Random(args.seed)
+            frames, expected = make_frames(rotation, args.rotations, client.ENCODING_RICE, checksum, rng)
+            stream, _ = corrupt(frames, args.corrupt, rng)
+            correct, wrong, _ = classify(feed_stream(parser_class(), stream, rng), expected)
+            print(f"{name:<10}{correct:>9}{wrong:>7}{args.rotations - correct:>7}")
+        server.logging_shutdown()
+
+
+if __name__ == "__main__":
+    main()
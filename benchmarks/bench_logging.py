@@ -0,0 +1,113 @@
+"""
+Benchmark for the logging overhead on the hot path of client and server.
+
+Rotations from test.txt are pushed `--rotations` times through
+  * server: LidarServer.process_rotation (no viewers connected)
+  * client: process_lidar_data of bench_client_pipeline, the client loop
+            on one thread (the replayed rotations as its source, sendall
+            discarded)
+with the logging configurations
+  * off:        DEBUG disabled (no per-rotation dump)
+  * sync:       logging_setup() as before, every record written and flushed in place
+  * async:      logging_setup(async_logging=True)
+  * async+1/10: async with point_sample_rate=0.1
+  * async+raw:  async with the binary RawDataRecorder instead of the text dump
+The time per rotation in the calling thread and the time to drain the
+writer threads afterwards are reported.  Logs go to a temporary directory.
+
+    python benchmarks/bench_logging.py --rotations 2000
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lidar import client, server  # noqa: E402
+from bench_client_pipeline import process_lidar_data  # noqa: E402
+
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test.txt")
+
+CONFIGS = [
+    ("off", {}),
+    ("sync", {}),
+    ("async", {"async_logging": True}),
+    ("async+1/10", {"async_logging": True, "point_sample_rate": 0.1}),
+    ("async+raw", {"async_logging": True, "raw_data": True}),
+]
+
+
+class NullSocket:
+    def sendall(self, data):
+        pass
+
+
+def load_rotations():
+    parser = client.StdoutRotationParser()
+    with open(TEST_FILE, "rb") as f:
+        rotations = parser.feed(f.read() + b"\n")  # 最後の S 行で一周が完成する
+    return [rotation for rotation in rotations if 300 <= len(rotation.theta) <= 650]
+
+
+def setup(module, name, options, log_dir):
+    options = dict(options)
+    if options.pop("raw_data", False):
+        options["raw_data_path"] = os.path.join(log_dir, "raw.bin")
+    module.logging_setup(log_dir, **options)
+    if name == "off":
+        module.logger.setLevel(logging.INFO)
+
+
+def run_server(rotations, count, name, options, log_dir):
+    decoded = [[(theta / 100, dist) for theta, dist in zip(rotation.theta, rotation.dist)]
+               for rotation in rotations]
+    lidar_server = server.LidarServer(metrics_port=None)
+    manager = lidar_server.monitor_manager
+    setup(server, name, options, log_dir)
+    start = time.perf_counter()
+    for index in range(count):
+        lidar_server.process_rotation(index, decoded[index % len(decoded)], manager)
+    elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    server.logging_shutdown()
+    return elapsed, time.perf_counter() - start
+
+
+def run_client(rotations, count, name, options, log_dir):
+    def replay():
+        for index in range(count):
+            yield rotations[index % len(rotations)]
+
+    setup(client, name, options, log_dir)
+    start = time.perf_counter()
+    process_lidar_data(NullSocket(), source=replay())
+    elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    client.logging_shutdown()
+    return elapsed, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rotations", type=int, default=2000)
+    args = parser.parse_args()
+    server.load_numpy()
+
+    rotations = load_rotations()
+    print(f"{len(rotations)} rotations in test.txt, {args.rotations} per run")
+    print(f"{'side':<8}{'config':<12}{'ms/rotation':>13}{'drain ms':>10}{'log MB':>9}")
+    for side, run in (("server", run_server), ("client", run_client)):
+        for name, options in CONFIGS:
+            with tempfile.TemporaryDirectory() as log_dir:
+                elapsed, drain = run(rotations, args.rotations, name, options, log_dir)
+                size = sum(os.path.getsize(os.path.join(root, f))
+                           for root, _, files in os.walk(log_dir) for f in files)
+            print(f"{side:<8}{name:<12}{elapsed / args.rotations * 1e3:>13.3f}"
+                  f"{drain * 1e3:>10.1f}{size / 1e6:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Benchmark for the ultra_simple stdout parsing stage of the client.
+
+test.txt is replayed `--repeat` times through
+  * legacy:  text readline + substring checks + re.match per line, a second
+             re.match/float() in process_lidar_data and a third in compress_data;
+             validate_rotation sorts the angles of every rotation
+  * chunked: client.StdoutRotationParser reading large binary chunks, with
+             the parsed arrays handed straight to codec.compress_points;
+             check_rotation uses the RotationStats of the RotationAssembler
+and the lines per second of each path are reported (single core).
+
+`--verify` first checks that check_rotation accepts and rejects exactly the
+rotations the sorting validate_rotation did, on test.txt and on random
+variants of it (cut angle ranges, dropped and shuffled points).
+
+    python benchmarks/bench_parser.py --verify --repeat 200
+"""
+import argparse
+import io
+import logging
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lidar import client, codec  # noqa: E402
+
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test.txt")
+
+
+def legacy_validate(theta_list):
+    """validate_rotation() before RotationAssembler (sorts the angles of every rotation)"""
+    if not theta_list:
+        return False
+    theta_list.sort()
+    if theta_list[0] / 100.0 > 10.0 or theta_list[-1] / 100.0 < 350.0:
+        return False
+    for i in range(len(theta_list) - 1):
+        if (theta_list[i + 1] - theta_list[i]) > 1000:
+            return False
+    return True
+
+
+def legacy_check(theta_list):
+    data_count = len(theta_list)
+    return 300 <= data_count <= 650 and legacy_validate(theta_list)
+
+
+def legacy_pipeline(data, encode):
+    """get_lidar_data() + process_lidar_data() + compress_data() before the chunked parser."""
+    rotations = 0
+    lines = []
+    theta_list = []
+    stream = io.TextIOWrapper(io.BytesIO(data), encoding="utf-8")
+    for line in iter(stream.readline, ""):
+        line = line.strip()
+        if "theta: 0.00" in line and "Dist: 00000.00" in line and "Q: 0" in line:
+            continue
+        if not (re.match(r"theta:\s*\d+\.\d+\s+Dist:\s*\d+", line) or "S" in line):
+            continue
+
+        if "S" in line:
+            if lines:
+                if legacy_check(theta_list) and encode:
+                    codec.compress_data(lines, 0)
+                rotations += 1
+            lines = []
+            theta_list = []
+        else:
+            match = re.match(r"theta:\s*(\d+\.\d+)\s+Dist:\s*\d+", line)
+            if match:
+                theta_list.append(int(float(match.group(1)) * 100))
+                lines.append(line)
+    return rotations
+
+
+def chunked_pipeline(data, encode):
+    rotations = 0
+    parser = client.StdoutRotationParser()
+    stream = io.BytesIO(data)
+    while True:
+        completed = parser.read_from(stream)
+        if completed is None:
+            break
+        for rotation in completed:
+            if client.check_rotation(rotation) and encode:
+                codec.compress_points(rotation.theta, rotation.dist, rotation.start_time)
+            rotations += 1
+    return rotations
+
+
+def verify(data, count, seed):
+    rng = random.Random(seed)
+    base = client.StdoutRotationParser().feed(data + b"\n")
+    checked = 0
+    for index in range(count):
+        rotation = base[index % len(base)]
+        points = list(zip(rotation.theta, rotation.dist, rotation.quality))
+        if index >= len(base):
+            kind = rng.randrange(4)
+            if kind == 0:  # 角度の範囲を切り取る（抜けや端の欠け）
+                start = rng.randrange(0, 36000)
+                width = rng.choice((rng.randrange(500, 1500), rng.randrange(995, 1006) * 10))
+                points = [p for p in points if not start <= p[0] < start + width]
+            elif kind == 1:
+                points = rng.sample(points, rng.randrange(250, len(points) + 1))
+            elif kind == 2:
+                points = points + [(rng.randrange(0, 37500), 1000, 10) for _ in range(rng.randrange(0, 60))]
+            else:
+                points = points[:rng.randrange(0, len(points) + 1)]
+            rng.shuffle(points)
+        assembler = client.RotationAssembler()
+        for point in points:
+            assembler.add(*point)
+        theta_list = [p[0] for p in points]
+        expected = legacy_check(list(theta_list))
+        assert client.check_rotation(assembler.finish(0)) == expected, f"verdict mismatch in rotation {index}"
+        assert client.check_rotation(client.Rotation(0, theta_list, [], [])) == expected  # RotationStats なし
+        checked += 1
+    print(f"verify: {checked} rotations OK (seed={seed})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=200, help="how many times test.txt is replayed")
+    parser.add_argument("--input", default=TEST_FILE)
+    parser.add_argument("--verify", action="store_true", help="run the validation check first")
+    parser.add_argument("--count", type=int, default=2000, help="rotations for --verify")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.getLogger("MyLogger").setLevel(logging.CRITICAL)
+    with open(args.input, "rb") as f:
+        data = f.read()
+    if args.verify:
+        verify(data, args.count, args.seed)
+    data *= args.repeat
+    line_count = data.count(b"\n")
+
+    print(f"{line_count} lines, {len(data) / 1e6:.1f} MB")
+    for encode in (False, True):
+        for name, pipeline in (("legacy", legacy_pipeline), ("chunked", chunked_pipeline)):
+            start = time.perf_counter()
+            rotations = pipeline(data, encode)
+            elapsed = time.perf_counter() - start
+            label = f"{name}{' + encode' if encode else ''}"
+            print(f"{label:<18} {rotations:>6} rotations {elapsed:8.3f} s {line_count / elapsed:12.0f} lines/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""
+Benchmark for the adaptive rate control (client.RateController driven by
+the server's FEEDBACK frames).
+
+client.ClientPipeline replays test.txt at 10 Hz (fixed encoding) to
+LidarServer.handle_lidar_client over loopback, in two overloaded setups:
+  * link:   a relay that forwards at most `--bandwidth` bytes/s (the fixed
+            encoding needs about 21 kB/s)
+  * server: process_rotation takes `--server-ms` longer per rotation
+Each runs with and without `rate_control`.  Reported: rotations forwarded
+by the server, p50 / p99 / max of the delay it prints on 8002, the
+rotations the client thinned out, the level changes and the final level.
+
+`--verify` checks the RateController steps on scripted feedback, that a
+FEEDBACK frame from FrameParser.control_frames() reaches the controller,
+and that every RATE_LEVELS step sends every Nth rotation in frames the
+server decodes within the quantization error.
+
+    python benchmarks/bench_rate_control.py --verify
+    python benchmarks/bench_rate_control.py --rotations 300 --bandwidth 8000 --server-ms 200
+"""
+import argparse
+import logging
+import os
+import re
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lidar import client, codec, server  # noqa: E402
+from bench_e2e import forward_back, percentile  # noqa: E402
+
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test.txt")
+DELAY_PATTERN = re.compile(r"Delay: (-?[\d.]+)sec")
+
+
+def load_rotation():
+    parser = client.StdoutRotationParser()
+    with open(TEST_FILE, "rb") as f:
+        return parser.feed(f.read() + b"\n")[0]  # 最後の S 行で一周が完成する
+
+
+class ThrottledRelay(threading.Thread):
+    """Forward one client connection to the server at no more than `bandwidth` bytes/s."""
+    def __init__(self, target_port, bandwidth):
+        super().__init__(daemon=True)
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen()
+        self.port = self.listener.getsockname()[1]
+        self.target_port = target_port
+        self.bandwidth = bandwidth
+
+    def run(self):
+        connection, _ = self.listener.accept()
+        with connection, socket.create_connection(("127.0.0.1", self.target_port)) as upstream:
+            back = threading.Thread(target=forward_back, args=(upstream, connection), daemon=True)
+            back.start()
+            start = time.monotonic()
+            forwarded = 0
+            try:
+                while True:
+                    data = connection.recv(1024)
+                    if not data:
+                        break
+                    forwarded += len(data)
+                    time.sleep(max(0.0, start + forwarded / self.bandwidth - time.monotonic()))
+                    upstream.sendall(data)
+            except ConnectionError:
+                pass
+            upstream.shutdown(socket.SHUT_WR)  # サーバーが読み終えて閉じるまで TIME_PING を読み続ける
+            back.join(timeout=30)
+
+
+class CollectingManager:
+    """Receives what would go to the viewers; keeps the printed delays."""
+    def __init__(self):
+        self.delays = []
+
+    def broadcast_8001(self, message):
+        pass
+
+    def broadcast_8002(self, message):
+        self.delays.append(float(DELAY_PATTERN.search(message).group(1)))
+
+
+def run_end_to_end(rotations, rate_control, bandwidth=None, server_delay=0.0):
+    manager = CollectingManager()
+    lidar_server = server.LidarServer(metrics_port=None)
+    lidar_server.monitor_manager = manager
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+
+    def accept():
+        connection, _ = listener.accept()
+        lidar_server.handle_lidar_client(connection)
+    handler = threading.Thread(target=accept, daemon=True)
+    handler.start()
+    port = listener.getsockname()[1]
+    if bandwidth:
+        relay = ThrottledRelay(port, bandwidth)
+        relay.start()
+        port = relay.port
+
+    if server_delay:
+        process_rotation = lidar_server.process_rotation
+
+        def slow_process_rotation(*args, **kwargs):
+            time.sleep(server_delay)  # 重い処理の代わり
+            return process_rotation(*args, **kwargs)
+        lidar_server.process_rotation = slow_process_rotation
+    try:
+        source = client.ReplaySource(TEST_FILE, 1.0, rotations)
+        pipeline = client.ClientPipeline("127.0.0.1", port, source=source, rate_control=rate_control)
+        pipeline.run()
+        handler.join(timeout=120)  # 溜まった周を全部転送するまで
+    finally:
+        listener.close()
+    controller = pipeline.rate_controller
+    return {
+        "forwarded": len(manager.delays),
+        "p50": percentile(manager.delays, 0.50),
+        "p99": percentile(manager.delays, 0.99),
+        "max": max(manager.delays, default=float("nan")),
+        "thinned": pipeline.thinned_count,
+        "changes": controller.change_count if controller else 0,
+        "level": controller.level if controller else 0,
+    }
+
+
+class FixedLevel(client.RateController):
+    """Always the same step, for checking what the pipeline sends at each level."""
+    def __init__(self, level):
+        super().__init__()
+        self.level = level
+
+    def level_for(self, queued, now):
+        return self.level
+
+
+def verify_controller():
+    controller = client.RateController(target_lag=0.2)
+    assert controller.level_for(0, 0.0) == 0, "no feedback must keep level 0"
+    controller.feedback(0.5, 0, 10.0)
+    assert controller.level_for(0, 10.0) == 1, "lag over the target must step up"
+    assert controller.level_for(0, 11.4) == 1, "the next step must wait RATE_STEP_INTERVAL + the lag"
+    assert controller.level_for(0, 11.5) == 2
+    controller.feedback(0.3, 0, 12.0)
+    assert controller.level_for(0, 13.0) == 2, "a falling lag must hold the level"
+    controller.feedback(0.1, client.RATE_MAX_BACKLOG * 3, 13.0)
+    assert controller.level_for(0, 13.0) == 3, "a decode backlog must step up"
+    assert controller.level_for(0, 15.0) == 3, "no step beyond the last level"
+    controller.feedback(0.15, 0, 13.0)
+    assert controller.level_for(0, 30.0) == 3, "a lag between target / 2 and the target must hold the level"
+    controller.feedback(0.01, 0, 30.0)
+    assert controller.level_for(0, 30.0) == 3
+    assert controller.level_for(0, 30.0 + client.RATE_RECOVER_SECONDS - 0.1) == 3, "stepped down too early"
+    assert controller.level_for(0, 30.0 + client.RATE_RECOVER_SECONDS) == 2, "calm must step down"
+    assert controller.level_for(client.RATE_MAX_QUEUED + 1, 36.0) == 3, "a send queue must step up"
+    # 古い FEEDBACK は使わない: 遅れが残っていても，送信待ちがなければ落ち着いているとみなす
+    controller = client.RateController(target_lag=0.2)
+    controller.feedback(1.0, 10, 0.0)
+    assert controller.level_for(0, 0.0) == 1
+    now = client.RATE_FEEDBACK_TIMEOUT + 0.1
+    assert controller.level_for(0, now) == 1
+    assert controller.level_for(0, now + client.RATE_RECOVER_SECONDS) == 0, "stale feedback must be ignored"
+
+
+def verify_feedback():
+    sensor_metrics = server.SensorMetrics()
+    sensor_metrics.lag_seconds, sensor_metrics.backlog = 0.345, 7
+    parser = server.FrameParser(sensor_metrics)
+    parser.timed = True
+    pipeline = client.ClientPipeline("127.0.0.1", 0, source=[], rate_control=True)
+    server_end, client_end = socket.socketpair()
+    with server_end, client_end:
+        responder = threading.Thread(target=pipeline._answer_pings, args=(client_end,))
+        responder.start()
+        server_end.sendall(parser.control_frames(0.0))
+        pong = server_end.recv(65536)  # TIME_PING の応答（FEEDBACK を読み終えた後に届く）
+        server_end.shutdown(socket.SHUT_WR)
+        responder.join(timeout=5)
+    assert parser.split(pong) == [], "the TIME_PONG must be taken by the parser"
+    assert parser.pongs_received == 1
+    controller = pipeline.rate_controller
+    assert (round(controller.lag, 6), controller.backlog) == (0.345, 7), "FEEDBACK not received"
+
+    # TIME_PONG がいくつ失われても，応答したことのあるクライアントには FEEDBACK を送り続ける
+    parser.pings_sent += server.TIME_SYNC_MAX_UNANSWERED
+    frames = parser.control_frames(10.0)
+    assert len(frames) == codec.FRAME_HEADER.size + codec.FEEDBACK.size and \
+        codec.FRAME_HEADER.unpack_from(frames)[2] == codec.FRAME_TYPE_FEEDBACK, "FEEDBACK stopped after lost pongs"
+
+
+def verify_levels(rotation):
+    for level, (quantization, every) in enumerate(client.RATE_LEVELS):
+        pipeline = client.ClientPipeline("127.0.0.1", 0, source=[], rate_control=True)
+        pipeline.rate_controller = FixedLevel(level)
+        parser = server.FrameParser()
+        sent = []
+        for index in range(8):
+            compress = pipeline._rate_compressor(rotation._replace(start_time=index))
+            if compress is not None:
+                sent.append(index)
+                decoded = parser.feed_frame(bytes(compress(rotation._replace(start_time=index))))
+                timestamp, points, _ = decoded[0]
+                assert timestamp == index, f"level {level}: timestamp {timestamp} != {index}"
+                angle_error, dist_error = (0.0, 0.0) if quantization is None else \
+                    codec.quantization_max_error(quantization)
+                measured = [(theta / 100, dist) for theta, dist in zip(rotation.theta, rotation.dist)]
+                for theta, dist in points:
+                    assert any(abs(theta - t) <= angle_error + 1e-9 and abs(dist - d) <= dist_error
+                               for t, d in measured), f"level {level}: point ({theta}, {dist}) not measured"
+        assert len(sent) == 8 // every and pipeline.thinned_count == 8 - len(sent), \
+            f"level {level}: sent {sent} for every {every}"
+
+
+def verify(rotation):
+    verify_controller()
+    verify_feedback()
+    verify_levels(rotation)
+    print(f"verify: controller, feedback and {len(client.RATE_LEVELS)} levels OK")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--verify", action="store_true", help="run the controller / level check first")
+    parser.add_argument("--rotations", type=int, default=200, help="rotations replayed at 10 Hz per run")
+    parser.add_argument("--bandwidth", type=int, default=12000, help="bytes/s of the link setup")
+    parser.add_argument("--server-ms", type=float, default=150.0, help="extra ms per rotation of the server setup")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as log_dir:
+        server.logging_setup(log_dir)
+        server.load_numpy()
+        server.logger.setLevel(logging.ERROR)
+        client.logger.setLevel(logging.ERROR)
+        if args.verify:
+            verify(load_rotation())
+
+        print(f"{args.rotations} rotations at 10 Hz (fixed encoding); delay in seconds")
+        print(f"{'setup':<28}{'control':<9}{'forwarded':>10}{'p50':>8}{'p99':>8}{'max':>8}{'thinned':>9}"
+              f"{'changes':>9}{'level':>7}")
+        for name, bandwidth, server_delay in ((f"link {args.bandwidth} B/s", args.bandwidth, 0.0),
+                                              (f"server +{args.server_ms:g} ms", None, args.server_ms / 1e3)):
+            for rate_control in (False, True):
+                result = run_end_to_end(args.rotations, rate_control, bandwidth, server_delay)
+                print(f"{name:<28}{'on' if rate_control else 'off':<9}{result['forwarded']:>10}{result['p50']:>8.3f}"
+                      f"{result['p99']:>8.3f}{result['max']:>8.3f}{result['thinned']:>9}{result['changes']:>9}"
+                      f"{result['level']:>7}")
+        server.logging_shutdown()
+
+
+if __name__ == "__main__":
+    main()
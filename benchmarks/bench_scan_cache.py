@@ -0,0 +1,107 @@
+"""
+Benchmark for the server's ScanCache and occupancy grid.
+
+Rotations from test.txt (randomly perturbed, as a moving scene) are fed to
+SensorScanCache with the pure-Python arrays and with NumPy, with and
+without the occupancy grid.  Reported: the update time per rotation and
+the time of the queries latest_scan(), sector_min() (a 30° sector over the
+last 3 rotations) and grid_snapshot(), called directly and over HTTP
+(/scan, /sector, /grid on the metrics server).  That both variants hold
+the same bins and find the same sector minimum is checked by
+tests/test_scan_cache.py.
+
+    python benchmarks/bench_scan_cache.py
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lidar import client, http_api, server  # noqa: E402
+
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test.txt")
+
+
+def load_rotation():
+    parser = client.StdoutRotationParser()
+    with open(TEST_FILE, "rb") as f:
+        rotation = parser.feed(f.read() + b"\n")[0]  # 最後の S 行で一周が完成する
+    return [(theta / 100, dist) for theta, dist in zip(rotation.theta, rotation.dist)]
+
+
+def perturbed(base, rng):
+    return [(theta, max(0, dist + rng.randint(-30, 30)) if dist else 0) for theta, dist in base]
+
+
+class NumPySwitch:
+    """Run with server.np set (numpy) or None (pure Python)."""
+    def __init__(self, use_numpy):
+        self.numpy = server.np if use_numpy else None
+
+    def __enter__(self):
+        self.saved, server.np = server.np, self.numpy
+
+    def __exit__(self, *exc):
+        server.np = self.saved
+
+
+def timed(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=500)
+    args = parser.parse_args()
+    server.load_numpy()
+
+    base = load_rotation()
+    if server.np is None:
+        print("NumPy is not installed: numpy rows are the pure-Python fallback")
+
+    rng = random.Random(args.seed)
+    rotations = [perturbed(base, rng) for _ in range(16)]
+    print(f"{len(base)} points per rotation, {server.SCAN_CACHE_BINS} bins, "
+          f"grid {server.GRID_SIZE}x{server.GRID_SIZE} x {server.GRID_RESOLUTION} mm")
+    print(f"{'variant':<8}{'grid':<6}{'update us':>11}{'scan us':>10}{'sector us':>11}{'grid us':>10}")
+    for use_numpy in (False, True):
+        for grid in (False, True):
+            with NumPySwitch(use_numpy):
+                cache = server.SensorScanCache(grid=grid)
+                counter = iter(range(10 ** 9))
+                update = timed(lambda: cache.update(0, rotations[next(counter) % len(rotations)]), args.repeat)
+                scan = timed(cache.latest_scan, args.repeat)
+                sector = timed(lambda: cache.sector_min(345.0, 15.0, 3), args.repeat)
+                snapshot = timed(cache.grid_snapshot, args.repeat) if grid else float("nan")
+            print(f"{'numpy' if use_numpy else 'python':<8}{'yes' if grid else 'no':<6}{update:>11.1f}{scan:>10.1f}"
+                  f"{sector:>11.1f}{snapshot:>10.1f}")
+
+    # HTTP（/metrics と同じサーバー）での往復
+    with tempfile.TemporaryDirectory() as log_dir:
+        server.logging_setup(log_dir)
+        server.logger.setLevel(logging.ERROR)
+        lidar_server = server.LidarServer(occupancy_grid=True, metrics_port=None)
+        for points in rotations:
+            lidar_server.scan_cache.update("bench", 0, points)
+        httpd = http_api.start_metrics_server(lidar_server, 0)
+        port = httpd.server_address[1]
+        print(f"{'HTTP query':<36}{'us':>10}")
+        for path in ("/scan", "/sector?start=345&end=15&rotations=3", "/grid?format=binary", "/grid"):
+            url = f"http://127.0.0.1:{port}{path}"
+            print(f"{path:<36}{timed(lambda: urllib.request.urlopen(url).read(), 100):>10.0f}")
+        httpd.shutdown()
+        server.logging_shutdown()
+
+
+if __name__ == "__main__":
+    main()
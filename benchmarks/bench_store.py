@@ -0,0 +1,125 @@
+"""
+Benchmark for the rotation store of the server.
+
+`--rotations` rotations (test.txt with jittered distances, spread over
+`--sensors` sensor IDs at 10 Hz) are appended with server.RotationStore,
+then server.RotationStoreReader
+  * seeks `--seeks` random one-second windows and reads them
+  * replays the whole store once
+and the write rate, the latency of a seek and the replay rate are reported.
+For comparison the same rotations are written as the text dump of
+lidar_data.log and the time to find one timestamp in it by scanning is shown.
+`--verify` checks that every rotation is read back unchanged.
+
+    python benchmarks/bench_store.py --rotations 20000 --verify
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lidar import client, server  # noqa: E402
+
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test.txt")
+START_TIME = 1_700_000_000_000_000
+
+
+def load_points():
+    parser = client.StdoutRotationParser()
+    with open(TEST_FILE, "rb") as f:
+        rotation = parser.feed(f.read() + b"\n")[0]
+    return [(theta / 100, dist) for theta, dist in zip(rotation.theta, rotation.dist)]
+
+
+def make_rotations(points, count, sensors, rng):
+    rotations = []
+    for index in range(count):
+        timestamp = START_TIME + (index // sensors) * 100_000 + rng.randrange(1000)
+        jittered = [(theta, max(0, dist + rng.randint(-20, 20))) for theta, dist in points]
+        rotations.append((timestamp, f"sensor-{index % sensors}", jittered))
+    return rotations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rotations", type=int, default=20000)
+    parser.add_argument("--sensors", type=int, default=4)
+    parser.add_argument("--seeks", type=int, default=200)
+    parser.add_argument("--segment-mb", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verify", action="store_true")
+    args = parser.parse_args()
+    server.load_numpy()
+    logging.getLogger("MyLogger").setLevel(logging.ERROR)
+
+    rng = random.Random(args.seed)
+    rotations = make_rotations(load_points(), args.rotations, args.sensors, rng)
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        store = server.RotationStore(store_dir, segment_bytes=args.segment_mb * 1024 * 1024,
+                                     max_queue=args.rotations + 1)
+        start = time.perf_counter()
+        for timestamp, sensor_id, points in rotations:
+            store.append(timestamp, sensor_id, points)
+        store.stop()
+        write_time = time.perf_counter() - start
+        size = sum(os.path.getsize(os.path.join(store_dir, name)) for name in os.listdir(store_dir))
+        print(f"write:  {args.rotations / write_time:10.0f} rotations/s  "
+              f"{size / 1e6:.1f} MB in {len(server.store_segment_paths(store_dir))} segments")
+
+        with server.RotationStoreReader(store_dir) as reader:
+            first, last = reader.time_range()
+            start = time.perf_counter()
+            found = 0
+            for _ in range(args.seeks):
+                window_start = rng.randrange(first, last)
+                found += sum(1 for _ in reader.read(window_start, window_start + 1_000_000))
+            seek_time = time.perf_counter() - start
+            print(f"seek:   {seek_time / args.seeks * 1e3:10.3f} ms per 1 s window "
+                  f"({found / args.seeks:.1f} rotations each)")
+
+            start = time.perf_counter()
+            points = sum(len(rotation.theta) for rotation in reader.read())
+            replay_time = time.perf_counter() - start
+            print(f"replay: {len(reader) / replay_time:10.0f} rotations/s  {points / replay_time:.0f} points/s")
+
+            if args.verify:
+                expected = sorted(rotations, key=lambda rotation: rotation[0])
+                stored = list(reader.read())
+                assert len(stored) == len(expected), (len(stored), len(expected))
+                by_key = {(timestamp, sensor_id): points for timestamp, sensor_id, points in rotations}
+                for rotation in stored:
+                    points = by_key[(rotation.timestamp, rotation.sensor_id)]
+                    assert list(rotation.theta) == [round(theta * 100) for theta, _ in points]
+                    assert list(rotation.dist) == [dist for _, dist in points]
+                timestamps = [rotation.timestamp for rotation in stored]
+                assert timestamps == sorted(timestamps)
+                window = list(reader.read(expected[100][0], expected[200][0], sensor_id="sensor-0"))
+                assert all(r.sensor_id == "sensor-0" and expected[100][0] <= r.timestamp < expected[200][0]
+                           for r in window)
+                print("verify: OK")
+
+    # 比較: lidar_data.log のテキストから同じ時刻を探す
+    with tempfile.TemporaryDirectory() as log_dir:
+        path = os.path.join(log_dir, "lidar_data.log")
+        with open(path, "w", encoding="utf-8") as f:
+            for timestamp, sensor_id, points in rotations:
+                message = server.RotationMessage(timestamp, points, sensor_id)
+                f.write(f"{message.text()}\n{server.format_timestamp(timestamp)}\n")
+        target = server.format_timestamp(rotations[len(rotations) * 3 // 4][0]).split(" Delay")[0]
+        start = time.perf_counter()
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.startswith(target):
+                    break
+        print(f"text:   {(time.perf_counter() - start) * 1e3:10.3f} ms to find one timestamp "
+              f"({os.path.getsize(path) / 1e6:.1f} MB log)")
+
+
+if __name__ == "__main__":
+    main()
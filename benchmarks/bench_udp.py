@@ -0,0 +1,230 @@
+"""
+Benchmark for the UDP transport under packet loss, over loopback.
+
+server.py is started as a subprocess and client.py replays test.txt at the
+sensor rate (`--speed 1` = 10 Hz) through a loss-injecting relay:
+  * tcp: every chunk the relay reads is lost with probability `--loss`;
+         the relay then holds it for `--rto` ms before forwarding, as TCP
+         would until the retransmission, so all later rotations wait too
+  * udp: client.py --transport udp; every datagram is dropped with
+         probability `--loss` and the rest are delayed by a random
+         0-`--jitter` ms, so they can arrive out of order
+Reported: rotations on the 8002 output, rotations counted as lost / stale
+by the server (lidar_rotations_dropped_total on /metrics), the delay p50 /
+p99 / max printed on 8002, and the share of rotations later than one
+rotation period (100 ms).
+
+`--verify` first runs UDP without jitter and checks that the server
+counts exactly the rotations hit by an injected loss as dropped (lost or
+stale), then with jitter that every rotation is either received or
+dropped exactly once.  The first and the last rotation are never dropped
+(nor the first delayed) there, since a loss before the first or after
+the last delivered rotation cannot be seen.  The same accounting of
+DatagramReassembler alone, without sockets and timing, is checked by
+tests/test_datagram.py.
+
+    python benchmarks/bench_udp.py --verify --rotations 100
+    python benchmarks/bench_udp.py --rotations 300 --loss 0.02
+    python benchmarks/bench_udp.py --loss 0.05 --jitter 50 --asyncio
+"""
+import argparse
+import heapq
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench_e2e import ROOT, TEST_FILE, DelayViewer, connect, forward_back, free_port, percentile  # noqa: E402
+from lidar import codec  # noqa: E402
+
+DROPPED_PATTERN = re.compile(r'^lidar_rotations_dropped_total\{sensor="[^"]*",reason="(\w+)"\} (\d+)', re.MULTILINE)
+
+
+class TcpLossRelay(threading.Thread):
+    """Forward one TCP connection, holding a "lost" chunk (and everything after it) for the RTO."""
+    def __init__(self, target_port, loss, rto, rng):
+        super().__init__(daemon=True)
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen()
+        self.port = self.listener.getsockname()[1]
+        self.target_port = target_port
+        self.loss = loss
+        self.rto = rto
+        self.rng = rng
+        self.lost = 0
+
+    def run(self):
+        connection, _ = self.listener.accept()
+        with connection, socket.create_connection(("127.0.0.1", self.target_port)) as upstream:
+            back = threading.Thread(target=forward_back, args=(upstream, connection), daemon=True)
+            back.start()
+            try:
+                while True:
+                    data = connection.recv(65536)
+                    if not data:
+                        break
+                    if self.rng.random() < self.loss:
+                        self.lost += 1
+                        time.sleep(self.rto)  # 再送されるまで後ろのデータも届かない
+                    upstream.sendall(data)
+            except ConnectionError:
+                pass
+            upstream.shutdown(socket.SHUT_WR)  # サーバーが読み終えて閉じるまで待つ
+            back.join(timeout=30)
+
+
+class UdpLossRelay(threading.Thread):
+    """Forward datagrams, dropping some and delaying the rest by a random jitter."""
+    def __init__(self, target_port, loss, jitter, rng, keep_seqs=()):
+        super().__init__(daemon=True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.target = ("127.0.0.1", target_port)
+        self.loss = loss
+        self.jitter = jitter
+        self.rng = rng
+        self.keep_seqs = set(keep_seqs)  # 捨てない周の seq
+        self.lost = 0
+        self.lost_seqs = set()  # 断片を捨てた周の seq
+        self.heap = []  # (送る時刻, 番号, データグラム)
+        self.condition = threading.Condition()
+        threading.Thread(target=self._send, daemon=True).start()
+
+    def run(self):
+        count = 0
+        while True:
+            data, _ = self.sock.recvfrom(65535)
+            seq = codec.DATAGRAM_HEADER.unpack_from(data)[3]
+            if self.rng.random() < self.loss and seq not in self.keep_seqs:
+                self.lost += 1
+                self.lost_seqs.add(seq)
+                continue
+            count += 1
+            with self.condition:
+                jitter = 0.0 if seq in self.keep_seqs else self.rng.uniform(0, self.jitter)  # 最初の周を追い越させない
+                heapq.heappush(self.heap, (time.monotonic() + jitter, count, data))
+                self.condition.notify()
+
+    def _send(self):
+        while True:
+            with self.condition:
+                while not self.heap:
+                    self.condition.wait()
+                due, _, data = self.heap[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                heapq.heappop(self.heap)
+            self.sock.sendto(data, self.target)
+
+
+def dropped_counts(metrics_port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics", timeout=5) as response:
+        text = response.read().decode("utf-8")
+    counts = {}
+    for reason, count in DROPPED_PATTERN.findall(text):
+        counts[reason] = counts.get(reason, 0) + int(count)
+    return counts
+
+
+def run_transport(transport, args, log_dir, seed, keep_seqs=()):
+    lidar_port, data_port, delay_port, metrics_port = free_port(), free_port(), free_port(), free_port()
+    server_cmd = [sys.executable, os.path.join(ROOT, "server.py"), "--lidar-port", str(lidar_port),
+                  "--monitor-ports", str(data_port), str(delay_port), "--log-dir", log_dir,
+                  "--monitor-queue-size", str(args.rotations + 100), "--metrics-port", str(metrics_port)]
+    if args.asyncio:
+        server_cmd.append("--asyncio")
+
+    rng = random.Random(seed)
+    server = subprocess.Popen(server_cmd)
+    try:
+        viewer = DelayViewer(delay_port)
+        viewer.start()
+        connect(lidar_port).close()  # 8000番ポートの準備ができるまで待つ
+        if transport == "tcp":
+            relay = TcpLossRelay(lidar_port, args.loss, args.rto / 1e3, rng)
+        else:
+            relay = UdpLossRelay(lidar_port, args.loss, args.jitter / 1e3, rng, keep_seqs)
+        relay.start()
+
+        client_cmd = [sys.executable, os.path.join(ROOT, "client.py"), "127.0.0.1", str(relay.port),
+                      "--replay", TEST_FILE, "--speed", str(args.speed), "--rotations", str(args.rotations),
+                      "--log-dir", log_dir, "--transport", transport] + args.client_args
+        subprocess.run(client_cmd, check=True)
+        time.sleep(max(args.rto, args.jitter) / 1e3 + 0.5)  # 遅れているデータが届くまで待つ
+        dropped = dropped_counts(metrics_port)
+    finally:
+        server.terminate()
+        server.wait()
+
+    delays = viewer.delays
+    return {
+        "received": len(delays),
+        "injected": relay.lost,
+        "injected_rotations": len(relay.lost_seqs) if transport == "udp" else 0,
+        "lost": dropped.get("lost", 0),
+        "stale": dropped.get("stale", 0),
+        "p50": percentile(delays, 0.50) * 1e3,
+        "p99": percentile(delays, 0.99) * 1e3,
+        "max": max(delays) * 1e3 if delays else float("nan"),
+        "late": sum(delay > 0.1 for delay in delays) / max(len(delays), 1),
+    }
+
+
+def verify(args):
+    keep_seqs = (0, args.rotations - 1)
+    for jitter in (0.0, args.jitter):
+        with tempfile.TemporaryDirectory() as log_dir:
+            result = run_transport("udp", argparse.Namespace(**{**vars(args), "jitter": jitter}), log_dir,
+                                   args.seed, keep_seqs)
+        dropped = result["lost"] + result["stale"]
+        assert result["received"] + dropped == args.rotations, \
+            f"jitter {jitter} ms: {result['received']} received + {dropped} dropped != {args.rotations} sent"
+        if not jitter:
+            assert dropped == result["injected_rotations"], \
+                f"{dropped} rotations dropped, {result['injected_rotations']} hit by an injected loss"
+        print(f"verify: jitter {jitter:.0f} ms, {result['injected_rotations']} rotations hit by "
+              f"{result['injected']} lost datagrams, {result['lost']} lost + {result['stale']} stale OK")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rotations", type=int, default=300)
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--loss", type=float, default=0.02, help="loss probability per chunk / datagram")
+    parser.add_argument("--rto", type=float, default=200.0, help="ms a lost TCP chunk is held back")
+    parser.add_argument("--jitter", type=float, default=20.0, help="max extra delay of a datagram in ms")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--asyncio", action="store_true", help="server.py --asyncio")
+    parser.add_argument("--verify", action="store_true", help="check the lost / stale accounting first")
+    parser.add_argument("--client-args", nargs=argparse.REMAINDER, default=[],
+                        help="passed to client.py, e.g. --client-args --encoding rice")
+    args = parser.parse_args()
+
+    if args.verify:
+        verify(args)
+    print(f"{args.rotations} rotations at {args.speed * 10:.0f} Hz, loss {args.loss:.1%}, "
+          f"TCP RTO {args.rto:.0f} ms, UDP jitter {args.jitter:.0f} ms")
+    print(f"{'transport':<11}{'recv':>6}{'injected':>10}{'lost':>6}{'stale':>7}{'p50 ms':>9}{'p99 ms':>9}"
+          f"{'max ms':>9}{'late':>8}")
+    for transport in ("tcp", "udp"):
+        with tempfile.TemporaryDirectory() as log_dir:
+            result = run_transport(transport, args, log_dir, args.seed)
+        print(f"{transport:<11}{result['received']:>6}{result['injected']:>10}{result['lost']:>6}{result['stale']:>7}"
+              f"{result['p50']:>9.1f}{result['p99']:>9.1f}{result['max']:>9.1f}{result['late']:>8.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+"""
+LiDAR streaming: the wire format (lidar.codec), the ingest server
+(lidar.server.LidarServer) and the Pi-side pipeline (lidar.client.ClientPipeline).
+
+Importing the package loads nothing else; NumPy, asyncio, http.server and
+multiprocessing are imported only when a server or pipeline needs them.
+"""
@@ -0,0 +1,353 @@
+"""
+The asyncio ingest server (ServerConfig.use_asyncio): many LiDAR clients
+and the viewers on one event loop.
+
+LidarServer.serve_forever() imports this module only for that server, so
+the default threaded server does not load asyncio.
+"""
+import asyncio
+import collections
+import logging
+import time
+
+from .codec import CRC, FRAME_HEADER, FRAME_MAGIC, FRAME_TYPE_HELLO, FRAME_TYPE_ROTATION, FRAME_VERSION, HELLO
+from .server import (
+    FORMAT_REQUEST_WAIT, FORMAT_TEXT, MONITOR_QUEUE_SIZE, POLICY_DISCONNECT, POLICY_DROP_OLDEST, DatagramReceiver,
+    FrameParser, LegacyStreamParser, http_response_header, log_filter_summary, parse_format_request,
+)
+
+logger = logging.getLogger("MyLogger")
+
+
+class AsyncMonitorClient:
+    """
+    asyncio版のビューア（MonitorClientHandler と同じ上限と溢れた時の方針）
+    """
+    def __init__(self, writer, max_queue=MONITOR_QUEUE_SIZE, policy=POLICY_DROP_OLDEST, output_format=FORMAT_TEXT):
+        self.writer = writer
+        self.format = output_format
+        self.peer = f"{writer.get_extra_info('peername')}"
+        self.message_queue = collections.deque()
+        self.max_queue = max_queue
+        self.policy = policy
+        self.ready = asyncio.Event()
+        self.running = True
+        self.sent_count = 0
+        self.dropped_count = 0
+
+    async def run(self):
+        logger.info(f"Send to {self.peer} task is starting")
+        try:
+            while True:
+                await self.ready.wait()
+                if not self.running:
+                    break
+                if not self.message_queue:
+                    self.ready.clear()
+                    continue
+                self.writer.write(self.message_queue.popleft())
+                await self.writer.drain()
+                self.sent_count += 1
+        except (ConnectionError, OSError) as e:
+            logger.warning(f"task stop:{e}")
+        finally:
+            self.running = False
+            self.writer.close()
+
+    def send(self, message):
+        if not self.running:
+            return
+        if len(self.message_queue) >= self.max_queue:
+            self.dropped_count += 1
+            if self.policy == POLICY_DISCONNECT:
+                logger.warning(f"Viewer {self.peer} is too slow, disconnecting...")
+                self.stop()
+                self.writer.transport.abort()  # drain で止まっているタスクを起こす
+                return
+            self.message_queue.popleft()
+        self.message_queue.append(message)
+        self.ready.set()
+
+    def queue_depth(self):
+        return len(self.message_queue)
+
+    def stop(self):
+        self.running = False
+        self.ready.set()
+
+
+class AsyncMonitorManager:
+    """
+    asyncio版の監視クライアント管理（ビューアごとのスレッドを作らない）
+
+    `broadcast_8001` / `broadcast_8002` は MonitorManager と同じインターフェース。
+    """
+    def __init__(self, max_queue=MONITOR_QUEUE_SIZE, policy=POLICY_DROP_OLDEST):
+        self.clients_8001 = {}  # writer -> AsyncMonitorClient
+        self.clients_8002 = {}
+        self.max_queue = max_queue
+        self.policy = policy
+        self.tasks = set()
+        self.closed = False
+
+    def add_client(self, writer, port, output_format=FORMAT_TEXT):
+        clients = self.clients_8001 if port == 8001 else self.clients_8002
+        client = AsyncMonitorClient(writer, self.max_queue, self.policy, output_format)
+        clients[writer] = client
+        task = asyncio.ensure_future(self._send_messages(client, clients))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def _send_messages(self, client, clients):
+        try:
+            await client.run()
+        finally:
+            clients.pop(client.writer, None)
+            logger.info(f"Viewer {client.peer} closed "
+                        f"(sent: {client.sent_count}, dropped: {client.dropped_count})")
+
+    def broadcast_8001(self, message):
+        """8001番ポートのクライアントに RotationMessage を各自の形式で送信"""
+        for client in list(self.clients_8001.values()):
+            client.send(message.encode(client.format))  # 形式ごとに1回だけ変換して共有する
+
+    def broadcast_8002(self, message):
+        """8002番ポートのクライアントにメッセージを送信"""
+        data = message.encode("utf-8")
+        for client in list(self.clients_8002.values()):
+            client.send(data)
+
+    def dropped_counts(self):
+        """ビューアごとの捨てたメッセージの数"""
+        return {client.peer: client.dropped_count
+                for client in list(self.clients_8001.values()) + list(self.clients_8002.values())}
+
+    def viewers(self):
+        """(ポート, ビューア) のリスト"""
+        return ([("8001", client) for client in list(self.clients_8001.values())] +
+                [("8002", client) for client in list(self.clients_8002.values())])
+
+    async def close(self):
+        self.closed = True
+        for client in list(self.clients_8001.values()) + list(self.clients_8002.values()):
+            client.stop()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+class AsyncLidarServer:
+    """
+    Multi-sensor ingest server running on a single asyncio event loop.
+
+    Serves the ports of `lidar_server` (a LidarServer, whose config, metrics
+    and rotation handling it uses).  Any number of LiDAR clients can stream
+    to the LiDAR port at once; each connection is tagged with a sensor ID
+    ("host:sensor_id" from its FRAME_TYPE_HELLO, see _claim_sensor_id).  The monitoring ports are served from the
+    same loop.
+    With `decode_workers` > 0 frames are decoded and filtered in a
+    DecodePool instead of on the loop (not for `legacy_stream`).
+    With `udp` the same port also receives datagrams (DatagramReceiver).
+    """
+    def __init__(self, lidar_server):
+        config = lidar_server.config
+        self.lidar_server = lidar_server
+        self.host = config.host
+        self.udp = config.udp
+        self.udp_transport = None
+        self.decode_workers = 0 if config.legacy_stream else config.decode_workers
+        self.decode_pool = None
+        self.slot_freed = None
+        self.lidar_port = config.lidar_port
+        self.monitor_port = list(config.monitor_ports)
+        self.legacy_stream = config.legacy_stream
+        self.manager = AsyncMonitorManager(config.monitor_queue_size, config.monitor_policy)
+        self.rotation_counts = collections.Counter()  # sensor_id -> 受信した周の数
+        self.connected = set()  # 接続中の TCP センサーの sensor_id
+        self.connection_tasks = set()  # _handle_lidar / _handle_monitor のタスク（close() で止める）
+        self.servers = []
+
+    async def start(self):
+        if self.decode_workers:
+            loop = asyncio.get_running_loop()
+            self.slot_freed = asyncio.Event()
+            from .decode_pool import DecodePool  # multiprocessing はワーカーを使う時だけ読み込む
+            self.decode_pool = DecodePool(self.decode_workers,
+                                          lambda message: loop.call_soon_threadsafe(self._on_decoded, message),
+                                          self.lidar_server.filter_rules_for,
+                                          use_numpy=self.lidar_server.config.use_numpy)
+            logger.info(f"Decoding with {self.decode_workers} worker processes")
+        lidar_server = await asyncio.start_server(self._handle_lidar, self.host, self.lidar_port)
+        self.servers.append(lidar_server)
+        self.lidar_port = lidar_server.sockets[0].getsockname()[1]  # port=0 の場合に実際のポートを記録
+        self.lidar_server.lidar_port = self.lidar_port
+        logger.info(f"LiDAR server listening on port {self.lidar_port}")
+        if self.udp:
+            self.udp_transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: DatagramReceiver(self.lidar_server, self.manager, self.decode_pool),
+                local_addr=(self.host, self.lidar_port))
+            logger.info(f"LiDAR UDP server listening on port {self.lidar_port}")
+
+        for index, port in enumerate(self.monitor_port):
+            logical_port = (8001, 8002)[index]
+            monitor_server = await asyncio.start_server(
+                lambda reader, writer, p=logical_port: self._handle_monitor(reader, writer, p),
+                self.host, port)
+            self.servers.append(monitor_server)
+            self.monitor_port[index] = monitor_server.sockets[0].getsockname()[1]
+            self.lidar_server.monitor_ports[index] = self.monitor_port[index]
+            logger.info(f"Lidar Data Monitoring server listening on port {self.monitor_port[index]}")
+
+    async def serve_forever(self):
+        if not self.servers:
+            await self.start()
+        await asyncio.gather(*(server.serve_forever() for server in self.servers))
+
+    async def close(self):
+        if self.udp_transport is not None:
+            self.udp_transport.close()
+            self.udp_transport = None
+        for server in self.servers:
+            server.close()
+        await self.manager.close()
+        # まだ接続しているクライアントのタスクを止め，後片付け（finally）が終わるまで待つ
+        for task in self.connection_tasks:
+            task.cancel()
+        await asyncio.gather(*self.connection_tasks, return_exceptions=True)
+        for server in self.servers:
+            await server.wait_closed()
+        self.servers = []
+        if self.decode_pool is not None:
+            self.decode_pool.close()
+            self.decode_pool = None
+
+    async def _read_hello(self, reader):
+        """
+        Read the FRAME_TYPE_HELLO a client sends first; returns (its sensor ID or None, the bytes left for the parser).
+        """
+        try:
+            data = await reader.readexactly(FRAME_HEADER.size)
+        except asyncio.IncompleteReadError as e:
+            return None, e.partial
+        magic, version, frame_type, _, payload_length, _, _ = FRAME_HEADER.unpack(data)
+        if magic != FRAME_MAGIC or version != FRAME_VERSION or frame_type != FRAME_TYPE_HELLO or \
+                payload_length > HELLO.size + CRC.size:
+            return None, data  # HELLO を送らないクライアント: 最初のフレームとして処理する
+        try:
+            data += await reader.readexactly(payload_length)
+        except asyncio.IncompleteReadError as e:
+            return None, data + e.partial
+        frames = FrameParser().split(data)
+        if len(frames) != 1 or len(frames[0].payload) != HELLO.size:
+            return None, data
+        return HELLO.unpack(frames[0].payload)[0], b""
+
+    def _track_connection(self):
+        """Register the running connection handler so close() can stop it."""
+        task = asyncio.current_task()
+        self.connection_tasks.add(task)
+        task.add_done_callback(self.connection_tasks.discard)
+
+    def _claim_sensor_id(self, host, sensor):
+        """
+        The metrics / cache key of a TCP connection: "host:sensor" like the UDP datagrams, or the host
+        for a client without FRAME_TYPE_HELLO.  It stays the same over reconnects (the peer port does
+        not); a second connection with the same key while the first is open gets "#2", "#3", ...
+        """
+        base = host if sensor is None else f"{host}:{sensor}"
+        sensor_id = base
+        number = 1
+        while sensor_id in self.connected:
+            number += 1
+            sensor_id = f"{base}#{number}"
+        self.connected.add(sensor_id)
+        self.lidar_server.register_sensor(sensor_id, host)  # フィルターのプロファイルはホストで選ぶ
+        return sensor_id
+
+    async def _handle_lidar(self, reader, writer):
+        self._track_connection()
+        host = writer.get_extra_info("peername")[0]
+        sensor_id = None
+        try:
+            sensor, pending = (None, b"") if self.legacy_stream else await self._read_hello(reader)
+            sensor_id = self._claim_sensor_id(host, sensor)
+            logger.info(f"LiDAR Client connected: {sensor_id} ({writer.get_extra_info('peername')})")
+            sensor_metrics = self.lidar_server.metrics.sensor(sensor_id)
+            parser = LegacyStreamParser(sensor_metrics) if self.legacy_stream else FrameParser(sensor_metrics)
+            while True:
+                data = pending or await reader.read(65536)
+                pending = b""
+                if not data:
+                    break
+                sensor_metrics.bytes_in += len(data)
+                control = parser.control_frames(time.monotonic())
+                if control:
+                    writer.write(control)  # 時刻合わせの応答は TIME_PONG として受信データに混ざって届く
+
+                if self.decode_pool is not None:
+                    for frame in parser.split(data):
+                        if frame.frame_type != FRAME_TYPE_ROTATION:
+                            continue
+                        while not self.decode_pool.submit(sensor_id, frame):
+                            self.slot_freed.clear()  # ワーカーが空くまで待つ（このセンサーの受信も止まる）
+                            await self.slot_freed.wait()
+                        sensor_metrics.backlog += 1
+                    continue
+
+                for timestamp, decompressed_data, quality in parser.feed(data):
+                    self.rotation_counts[sensor_id] += 1
+                    self.lidar_server.process_rotation(timestamp, decompressed_data, self.manager, sensor_id, quality)
+        except asyncio.CancelledError:
+            pass  # close() で止めた（接続のコールバックのタスクなので，キャンセルを伝える先はない）
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            writer.close()
+            if sensor_id is not None:
+                self.connected.discard(sensor_id)
+                if self.decode_pool is not None:
+                    self.decode_pool.release(sensor_id)
+                logger.warning(f"LiDAR Client disconnected: {sensor_id}")
+
+    def _on_decoded(self, message):
+        """DecodePool の結果（ループのスレッドで，センサーごとに受信した順に呼ばれる）"""
+        if self.decode_pool is None:
+            return  # close() の後に届いた結果
+        rotation = self.decode_pool.read_result(message)
+        self.slot_freed.set()
+        sensor_metrics = self.lidar_server.metrics.sensor(rotation.sensor_id)
+        sensor_metrics.backlog -= 1
+        if rotation.error is not None:
+            logger.error(f"Error decoding a frame from {rotation.sensor_id}: {rotation.error}")
+            return
+        sensor_metrics.decode_seconds.observe(rotation.decode_seconds)
+        if rotation.points is None:
+            sensor_metrics.rotations_dropped["missing_reference"] += 1
+            return
+        if rotation.delete_count:
+            for reason, count in rotation.reasons.items():
+                sensor_metrics.points_filtered[reason] += count
+            log_filter_summary(rotation.sensor_id, rotation.delete_count, rotation.reasons)
+
+        self.rotation_counts[rotation.sensor_id] += 1
+        self.lidar_server.forward_rotation(rotation.timestamp, rotation.total_count, rotation.points,
+                                           rotation.delete_count, self.manager, rotation.sensor_id)
+
+    async def _handle_monitor(self, reader, writer, port):
+        self._track_connection()
+        output_format = FORMAT_TEXT
+        try:
+            if port == 8001:
+                try:
+                    request = await asyncio.wait_for(reader.read(1024), FORMAT_REQUEST_WAIT)
+                except asyncio.TimeoutError:
+                    request = b""
+                output_format, is_http = parse_format_request(request)
+                if is_http:
+                    writer.write(http_response_header(output_format))
+                logger.info(f"Viewer {writer.get_extra_info('peername')} selected format: {output_format}")
+            if self.manager.closed:
+                writer.close()  # 形式を待っている間にサーバーが閉じられた
+                return
+            await self.manager.add_client(writer, port, output_format)
+        except asyncio.CancelledError:
+            writer.close()  # close() で止めた
@@ -0,0 +1,1092 @@
+import argparse
+import logging.handlers
+import socket
+import subprocess
+import re
+import time
+import logging
+import array
+import collections
+import os
+import sys
+import threading
+
+from . import codec, logging_util
+from .codec import (
+    ENCODING_FIXED, ENCODING_RICE, ENCODING_VARINT, FEEDBACK, FLAG_PREDICTED, FRAME_HEADER, FRAME_MAGIC,
+    FRAME_TYPE_FEEDBACK, FRAME_TYPE_TIME_PING, PredictiveEncoder, Quantization, append_crc, append_quality,
+    append_timing, build_hello, build_time_pong, compress_points, compress_points_adaptive, compress_points_lossy,
+    compress_points_numpy, split_datagrams,
+)
+from .config import load_config
+from .logging_util import RAW_RECORD_HEADER, RAW_RECORD_MAGIC, logger, logging_shutdown, setup_logging
+
+
+
+def logging_setup(log_dir="/home/lidar/logs", async_logging=False, point_sample_rate=1.0, raw_data_path=None):
+    """
+    Configure the logger: points and INFO to info_logs/info.log, warnings to error_logs/error.log.
+
+    The options are those of logging_util.setup_logging().
+    """
+    setup_logging(os.path.join(log_dir, "info_logs", "info.log"), logging.WARNING,
+                  os.path.join(log_dir, "error_logs", "error.log"), logging.WARNING,
+                  async_logging, point_sample_rate, raw_data_path)
+    logger.debug("Logger setuped")
+
+
+# 🔹 **一周の検証**（角度は0.01°単位）
+ROTATION_MIN_POINTS = 300
+ROTATION_MAX_POINTS = 650
+ROTATION_START_MAX = 1000  # 最小の角度が10°以下
+ROTATION_END_MIN = 35000   # 最大の角度が350°以上
+ROTATION_MAX_GAP = 1000    # 隣り合う角度の差が10°以下
+
+RotationStats = collections.namedtuple("RotationStats", "count theta_min theta_max max_gap")
+Rotation = collections.namedtuple("Rotation", "start_time theta dist quality stats end_time", defaults=(None, None))
+
+
+class RotationAssembler:
+    """
+    Collect the samples of one rotation and keep what validation needs.
+
+    ultra_simple prints a rotation in ascending angle order, so while that
+    holds the first and last angle are the min / max and the largest step
+    between consecutive samples is the largest gap: finish() summarizes the
+    rotation in O(1) instead of sorting its angles.  If a sample goes
+    backwards the gap is found from an occupancy bitmap of ROTATION_MAX_GAP
+    wide angle bins with the lowest / highest angle of each bin.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.theta = array.array("i")
+        self.dist = array.array("i")
+        self.quality = array.array("i")
+        self.last = None     # 直前の角度
+        self.max_step = 0    # 連続した点の角度の差の最大
+        self.ordered = True  # 角度が昇順に並んでいるか
+
+    def add(self, theta, dist, quality):
+        self.theta.append(theta)
+        self.dist.append(dist)
+        self.quality.append(quality)
+        if self.last is not None:
+            step = theta - self.last
+            if step > self.max_step:
+                self.max_step = step
+            elif step < 0:
+                self.ordered = False
+        self.last = theta
+
+    def __len__(self):
+        return len(self.theta)
+
+    def stats(self):
+        """RotationStats of the points so far."""
+        if not self.theta:
+            return RotationStats(0, None, None, 0)
+        if self.ordered:
+            return RotationStats(len(self.theta), self.theta[0], self.last, self.max_step)
+        return RotationStats(len(self.theta), min(self.theta), max(self.theta), binned_max_gap(self.theta))
+
+    def finish(self, start_time, end_time=None):
+        """Return the collected Rotation (with its stats) and start a new one."""
+        rotation = Rotation(start_time, self.theta, self.dist, self.quality, self.stats(), end_time)
+        self.reset()
+        return rotation
+
+    @classmethod
+    def stats_of(cls, theta_values):
+        """RotationStats of a rotation that was not built by an assembler (e.g. a raw record)."""
+        assembler = cls()
+        for theta in theta_values:
+            assembler.add(theta, 0, 0)
+        return assembler.stats()
+
+
+def binned_max_gap(theta_values):
+    """
+    Largest gap between sorted angles, without sorting.
+
+    Angles go into ROTATION_MAX_GAP wide bins (an occupancy bitmap plus the
+    lowest / highest angle per bin).  A gap wider than a bin cannot hide
+    inside one, so the gaps between neighbouring occupied bins give the
+    exact answer whenever it exceeds ROTATION_MAX_GAP (smaller gaps may be
+    reported smaller, which does not change the check).
+    """
+    occupied = 0
+    bin_low = {}
+    bin_high = {}
+    for theta in theta_values:
+        index = theta // ROTATION_MAX_GAP
+        bit = 1 << index
+        if occupied & bit:
+            if theta < bin_low[index]:
+                bin_low[index] = theta
+            elif theta > bin_high[index]:
+                bin_high[index] = theta
+        else:
+            occupied |= bit
+            bin_low[index] = bin_high[index] = theta
+
+    max_gap = 0
+    previous_high = None
+    index = 0
+    while occupied:
+        if occupied & 1:
+            if previous_high is not None and bin_low[index] - previous_high > max_gap:
+                max_gap = bin_low[index] - previous_high
+            previous_high = bin_high[index]
+        occupied >>= 1
+        index += 1
+    return max_gap
+
+
+# 1行ずつではなくチャンク全体に1回だけ適用する（"S" を含む行は周の区切り）
+STDOUT_PATTERN = re.compile(
+    rb"^[ \t]*theta:[ \t]*(\d+\.\d+)[ \t]+Dist:[ \t]*(\d+)[^\nQS]*(?:Q:[ \t]*(\d+))?[^\nS]*$"
+    rb"|^[^\nS]*(S)[^\n]*$",
+    re.MULTILINE)
+
+
+class StdoutRotationParser:
+    """
+    Parse the raw stdout of ultra_simple into per-rotation typed arrays.
+
+    Chunks are read into one preallocated buffer and scanned with a single
+    regex pass; an incomplete trailing line is moved to the front of the
+    buffer for the next read.  Every line is parsed exactly once.
+    """
+    def __init__(self, chunk_size=65536):
+        self.buffer = bytearray(chunk_size)
+        self.view = memoryview(self.buffer)
+        self.pending = 0  # バッファ先頭にある未完成の行のバイト数
+        self.theta_cache = {}  # b"12.34" -> 1234（int(float(x) * 100) と同じ値）
+        self.rotation_start_time = None
+        self.assembler = RotationAssembler()
+
+    def read_from(self, stream):
+        """
+        Read one chunk from a binary stream; returns completed rotations, or None at EOF.
+        """
+        if self.pending == len(self.buffer):
+            self.pending = 0  # 改行のない長すぎる行は捨てる
+        size = stream.readinto(self.view[self.pending:])
+        if not size:
+            if self.pending:
+                return self._parse(self.pending, final=True)  # 改行で終わらない最後の行
+            return None
+        return self._parse(self.pending + size)
+
+    def feed(self, data):
+        """
+        Parse `data` (bytes) that is already in memory; returns completed rotations.
+        """
+        rotations = []
+        view = memoryview(data)
+        while len(view):
+            if self.pending == len(self.buffer):
+                self.pending = 0
+            size = min(len(view), len(self.buffer) - self.pending)
+            self.view[self.pending:self.pending + size] = view[:size]
+            view = view[size:]
+            rotations.extend(self._parse(self.pending + size))
+        return rotations
+
+    def _parse(self, filled, final=False):
+        end = filled if final else self.buffer.rfind(b"\n", 0, filled) + 1
+        rotations = []
+        now = int(time.time() * 1e6)  # チャンクを受け取った時刻（マイクロ秒）
+        theta_cache = self.theta_cache
+        assembler = self.assembler
+        # RotationAssembler.add() をこのループに展開する（1点ごとの呼び出しを避ける）
+        theta_values, dist_values, quality_values = assembler.theta, assembler.dist, assembler.quality
+        last, max_step, ordered = assembler.last, assembler.max_step, assembler.ordered
+
+        for match in STDOUT_PATTERN.finditer(self.buffer, 0, end):
+            theta_text, dist_text, quality_text, start_marker = match.groups()
+            if start_marker:
+                if theta_values:
+                    assembler.last, assembler.max_step, assembler.ordered = last, max_step, ordered
+                    rotations.append(assembler.finish(self.rotation_start_time, now))  # 次の S 行で一周が揃う
+                    theta_values, dist_values, quality_values = assembler.theta, assembler.dist, assembler.quality
+                    last, max_step, ordered = assembler.last, assembler.max_step, assembler.ordered
+                # 🔹 新しい一周が始まるので、その瞬間の時刻を取得
+                self.rotation_start_time = now
+                continue
+
+            dist = int(dist_text)
+            quality = int(quality_text) if quality_text else 0
+            theta = theta_cache.get(theta_text)
+            if theta is None:
+                theta = theta_cache[theta_text] = int(float(theta_text) * 100)
+            if theta == 0 and dist == 0 and quality == 0:
+                continue  # "theta: 0.00 Dist: 00000.00 Q: 0" は無効なデータ
+
+            if self.rotation_start_time is None:
+                self.rotation_start_time = now  # 最初の計測時に時間を取得
+            theta_values.append(theta)
+            dist_values.append(dist)
+            quality_values.append(quality)
+            if last is not None:
+                step = theta - last
+                if step > max_step:
+                    max_step = step
+                elif step < 0:
+                    ordered = False
+            last = theta
+
+        assembler.last, assembler.max_step, assembler.ordered = last, max_step, ordered
+        # 未完成の行をバッファの先頭へ移動
+        self.pending = filled - end
+        self.buffer[:self.pending] = self.buffer[end:filled]
+        return rotations
+
+
+# 🔹 **LiDAR のプロセス**（ultra_simple の場所とシリアルポート）
+ULTRA_SIMPLE_PATH = "/home/lidar/rplidar_sdk/output/Linux/Release/ultra_simple"
+SERIAL_PORT = "/dev/ttyUSB0"
+SERIAL_BAUDRATE = 460800
+
+
+def lidar_command(path=ULTRA_SIMPLE_PATH, serial_port=SERIAL_PORT, baudrate=SERIAL_BAUDRATE):
+    """The ultra_simple command line for the LiDAR on `serial_port`."""
+    return [path, "--channel", "--serial", serial_port, str(baudrate)]
+
+
+class LidarProcess:
+    """
+    The ultra_simple process of one pipeline: rotations() (re)starts it and yields what it prints.
+    """
+    def __init__(self, command=None):
+        self.command = list(command) if command is not None else lidar_command()
+        self.process = None
+
+    def rotations(self):
+        self.terminate()  # 🔹 **古いプロセスを終了**
+        self.process = process = subprocess.Popen(self.command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                                  bufsize=0)
+        parser = StdoutRotationParser()
+        while True:
+            rotations = parser.read_from(process.stdout)
+            if rotations is None:
+                break
+            yield from rotations
+
+    def terminate(self):
+        process, self.process = self.process, None
+        if process is not None and process.poll() is None:  # まだ動作中なら終了
+            process.terminate()
+            try:
+                process.wait(timeout=5)  # 終了を待つ（最大5秒）
+            except subprocess.TimeoutExpired:
+                logger.warning("Forcing LiDAR process kill...")
+                process.kill()  # 強制終了
+            except Exception as e:
+                logger.exception(e)
+
+
+def get_lidar_data(source=None, lidar_process=None):
+    """
+    Run the LiDAR process (a new LidarProcess unless one is given) and yield complete rotations in real-time.
+
+    With `source` (e.g. ReplaySource) its rotations are yielded instead.
+    """
+    if source is not None:
+        yield from source
+        return
+    if lidar_process is None:
+        lidar_process = LidarProcess()
+    yield from lidar_process.rotations()
+
+
+def read_raw_records(path):
+    """
+    Read the rotations written by RawDataRecorder.
+    """
+    with open(path, "rb") as f:
+        return list(iter_raw_records(f))
+
+
+def iter_raw_records(stream):
+    """
+    Yield the rotations of a RawDataRecorder file one by one from a binary stream.
+    """
+    offset = 0
+    while True:
+        header = stream.read(RAW_RECORD_HEADER.size)
+        if len(header) < RAW_RECORD_HEADER.size:
+            break
+        magic, has_quality, count, start_time = RAW_RECORD_HEADER.unpack(header)
+        if magic != RAW_RECORD_MAGIC:
+            raise ValueError(f"Invalid raw record at offset {offset}")
+        size = count * (9 if has_quality else 8)
+        data = stream.read(size)
+        if len(data) < size:
+            break  # 書き込み途中の周
+        offset += RAW_RECORD_HEADER.size + size
+        theta = array.array("i", data[:count * 4])
+        dist = array.array("i", data[count * 4:count * 8])
+        if sys.byteorder == "big":
+            theta.byteswap()
+            dist.byteswap()
+        quality = array.array("i", iter(data[count * 8:] if has_quality else bytes(count)))  # uint8 から
+        yield Rotation(start_time, theta, dist, quality, RotationAssembler.stats_of(theta))
+
+
+class ReplaySource:
+    """
+    Replay a capture in place of ultra_simple, for tests and benchmarks.
+
+    `path` is either ultra_simple stdout (like test.txt) or a RawDataRecorder
+    file.  The rotations are yielded in order, `count` rotations in total
+    (the capture is repeated; None plays it once), each stamped with the time
+    it is yielded.  `speed=1.0` keeps the recorded pace (`rotation_period`
+    for text captures, which have no time), 2.0 is twice as fast and 0 does
+    not wait at all.
+    """
+    def __init__(self, path, speed=1.0, count=None, rotation_period=0.1):
+        self.speed = speed
+        self.count = count
+        self.exhausted = False
+        with open(path, "rb") as f:
+            is_raw = f.read(len(RAW_RECORD_MAGIC)) == RAW_RECORD_MAGIC
+        if is_raw:
+            self.rotations = read_raw_records(path)
+            start_times = [rotation.start_time for rotation in self.rotations]
+            self.periods = [max(0, (b - a) / 1e6) for a, b in zip(start_times, start_times[1:])] + [rotation_period]
+        else:
+            parser = StdoutRotationParser()
+            with open(path, "rb") as f:
+                self.rotations = parser.feed(f.read() + b"\n")  # 最後の行が S の場合も一周として扱う
+            self.periods = [rotation_period] * len(self.rotations)
+        if not self.rotations:
+            raise ValueError(f"No rotations in {path}")
+
+    def __iter__(self):
+        self.exhausted = False
+        total = self.count if self.count is not None else len(self.rotations)
+        next_time = time.perf_counter()
+        for index in range(total):
+            position = index % len(self.rotations)
+            if self.speed > 0:
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                next_time += self.periods[position] / self.speed
+            rotation = self.rotations[position]
+            now = int(time.time() * 1e6)
+            yield rotation._replace(start_time=now, end_time=now)  # 記録は揃った一周なので待ち時間はない
+        self.exhausted = True
+
+
+class RotationDump:
+    """Point dump of one rotation, built only when a handler actually writes it."""
+    def __init__(self, rotation):
+        self.rotation = rotation
+
+    def __str__(self):
+        rotation = self.rotation
+        return "\n".join(f"theta: {theta / 100:.2f} Dist: {dist:05d}.00 Q: {quality}"
+                         for theta, dist, quality in zip(rotation.theta, rotation.dist, rotation.quality))
+
+
+def make_compressor(legacy_format=False, encoding=ENCODING_FIXED, keyframe_interval=None, send_quality=False,
+                    quantization=None, checksum=True, timing=False):
+    """
+    Return (compress, encoder) for one connection.
+
+    compress(rotation) gives the bytes to send (or None); `encoder` is the
+    PredictiveEncoder in the predictive mode, otherwise None.  With a
+    `quantization` the lossy mode is used (Rice coding unless `encoding`
+    is ENCODING_VARINT; not with the legacy format or the predictive mode).
+    `checksum` ends every frame with a CRC32 (append_crc; not the legacy format).
+    `timing` adds when the rotation was complete and when it was encoded (append_timing).
+    """
+    encoder = None
+    if quantization is not None:
+        if legacy_format or keyframe_interval:
+            raise ValueError("The lossy mode cannot be combined with the legacy format or the predictive mode")
+        lossy_encoding = ENCODING_VARINT if encoding == ENCODING_VARINT else ENCODING_RICE
+
+        def compress_rotation(rotation):
+            return compress_points_lossy(rotation.theta, rotation.dist, rotation.start_time, quantization,
+                                         lossy_encoding, rotation.quality if send_quality else None)
+    else:
+        if keyframe_interval and not legacy_format:
+            # 🔹 予測モード（接続ごとに新しいエンコーダー → 最初のフレームはキーフレーム）
+            encoder = PredictiveEncoder(keyframe_interval)
+
+            def compress_points_for(theta, dist, start_time):
+                return encoder.encode(theta, dist, start_time)
+        elif encoding != ENCODING_FIXED and not legacy_format:
+            def compress_points_for(theta, dist, start_time):
+                return compress_points_adaptive(theta, dist, start_time, encoding)
+        else:
+            compress_fixed = compress_points_numpy if codec.np is not None else compress_points
+
+            def compress_points_for(theta, dist, start_time):
+                return compress_fixed(theta, dist, start_time, framed=not legacy_format)
+
+        def compress_rotation(rotation):
+            compressed_data = compress_points_for(rotation.theta, rotation.dist, rotation.start_time)
+            if compressed_data and send_quality and not legacy_format:
+                compressed_data = append_quality(compressed_data, rotation.theta, rotation.dist, rotation.quality)
+            return compressed_data
+
+    if legacy_format or not (checksum or timing):
+        return compress_rotation, encoder
+
+    def compress(rotation):
+        compressed_data = compress_rotation(rotation)
+        if not compressed_data:
+            return compressed_data
+        if timing:
+            end_time = rotation.end_time if rotation.end_time is not None else rotation.start_time
+            compressed_data = append_timing(compressed_data, end_time - rotation.start_time,
+                                            int(time.time() * 1e6) - rotation.start_time)
+        return append_crc(compressed_data) if checksum else compressed_data
+
+    return compress, encoder
+
+
+def log_rotation(rotation):
+    if logging_util.raw_recorder is not None:
+        # テキストの代わりにバイナリで記録
+        logging_util.raw_recorder.record(rotation.start_time, rotation.theta, rotation.dist, rotation.quality)
+    elif logger.isEnabledFor(logging.DEBUG) and logging_util.point_sampler.sample():
+        logger.debug("%s", RotationDump(rotation))  # 取得データを表示（文字列化は出力時）
+
+
+def check_rotation(rotation, min_points=ROTATION_MIN_POINTS, max_points=ROTATION_MAX_POINTS):
+    """
+    Check if the rotation data is complete and continuous, from its RotationStats (no sort).
+    """
+    stats = rotation.stats if rotation.stats is not None else RotationAssembler.stats_of(rotation.theta)
+    # 🔹 送信前に異常な週をスキップ（データ数 & 角度のチェック）
+    if not (min_points <= stats.count <= max_points):
+        logger.warning(f"Warning: Skipping this rotation due to invalid data... Data Count: {stats.count}")
+        return False
+
+    # 角度データが 0° 付近から 360° 付近まで含まれているか
+    if stats.theta_min > ROTATION_START_MAX or stats.theta_max < ROTATION_END_MIN:
+        logger.warning(f"Warning: Invalid rotation detected (theta range abnormal: {stats.theta_min / 100.0:.2f} - "
+                       f"{stats.theta_max / 100.0:.2f}), skipping... Data Count: {stats.count}")
+        return False
+
+    # 角度の連続性チェック（大きな抜けがないか）
+    if stats.max_gap > ROTATION_MAX_GAP:  # 10°以上の抜けがある場合
+        logger.warning(f"Warning: Large gap detected in theta values, skipping rotation... Data Count: {stats.count}")
+        return False
+
+    return True  # 正常なデータ
+
+
+PIPELINE_QUEUE_SIZE = 16  # ステージ間で保持する周の最大数（1.6秒分）
+POLICY_DROP_OLDEST = "drop_oldest"  # 溢れたら一番古い周を捨てる（前のステージは待たない）
+POLICY_BLOCK = "block"              # 溢れたら空くまで前のステージを待たせる（再生を最大速度で送る時など）
+SOCKET_TIMEOUT = 10    # 送信が止まってから接続を切るまでの秒数
+RECONNECT_DELAY = 1.0  # 再接続を試みる間隔（秒）
+TRANSPORT_TCP = "tcp"
+TRANSPORT_UDP = "udp"  # 1周ごとのデータグラム（失われた周は送り直さない）
+
+# 🔹 **送信量の調整**（サーバーの FEEDBACK と送信待ちのフレームから段階を選ぶ）
+RateLevel = collections.namedtuple("RateLevel", "quantization every")
+RATE_LEVELS = (
+    RateLevel(None, 1),                     # 設定どおり
+    RateLevel(Quantization(50, 10), 1),     # 非可逆（0.5°, 10mm）
+    RateLevel(Quantization(100, 20), 2),    # 非可逆（1°, 20mm）で2周に1周
+    RateLevel(Quantization(100, 50), 4),    # 非可逆（1°, 50mm）で4周に1周
+)
+RATE_TARGET_LAG = 0.2         # サーバーが返す遅れ（network + decode）の目標 [秒]
+RATE_MAX_BACKLOG = 2          # サーバーで解凍を待つフレームがこれを超えたら混んでいる
+RATE_MAX_QUEUED = 2           # 送信を待つフレームがこれを超えたら混んでいる
+RATE_STEP_INTERVAL = 1.0      # 段階を上げる最小の間隔（上げた効果が FEEDBACK に出るまで待つ）
+RATE_RECOVER_SECONDS = 5.0    # 遅れが目標の半分未満のままこれだけ続いたら段階を1つ下げる
+RATE_FEEDBACK_TIMEOUT = 2.0   # これより古い FEEDBACK は使わない（送信待ちのフレームだけで判断する）
+
+
+class StageQueue:
+    """
+    Bounded FIFO between two pipeline stages.
+
+    With POLICY_DROP_OLDEST put() never blocks: when the queue is full the
+    oldest item is dropped and counted, so a slow stage never stalls the
+    one before it.  get() returns None once the queue is closed and empty.
+    """
+    def __init__(self, max_size=PIPELINE_QUEUE_SIZE, policy=POLICY_DROP_OLDEST):
+        self.items = collections.deque()
+        self.max_size = max_size
+        self.policy = policy
+        self.condition = threading.Condition()
+        self.closed = False
+        self.dropped_count = 0
+
+    def put(self, item):
+        with self.condition:
+            if self.policy == POLICY_BLOCK:
+                while not self.closed and len(self.items) >= self.max_size:
+                    self.condition.wait()
+            if self.closed:
+                return
+            if len(self.items) >= self.max_size:
+                self.items.popleft()
+                self.dropped_count += 1
+            self.items.append(item)
+            self.condition.notify_all()
+
+    def get(self):
+        with self.condition:
+            while not self.items and not self.closed:
+                self.condition.wait()
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            self.condition.notify_all()
+            return item
+
+    def close(self):
+        """残りの周は get() で取り出せる（取り出し終わると None）"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class RateController:
+    """
+    Choose the RATE_LEVELS step for the next rotation.
+
+    The server's FEEDBACK (the lag from sending a rotation to forwarding it,
+    and its decode backlog) is stored by the responder thread; the
+    compressor thread calls level_for() with the number of frames waiting
+    to be sent.  When either is over its limit the level goes up one step,
+    but only while the load is not already falling since the last change,
+    and not before RATE_STEP_INTERVAL plus the lag at that change has
+    passed (the rotations queued before it still report the old lag);
+    after RATE_RECOVER_SECONDS with the lag below half of `target_lag` and
+    nothing waiting it goes down one.
+    """
+    def __init__(self, target_lag=RATE_TARGET_LAG, levels=RATE_LEVELS):
+        self.target_lag = target_lag
+        self.levels = levels
+        self.level = 0
+        self.lag = 0.0
+        self.backlog = 0
+        self.feedback_time = None  # 最後に FEEDBACK を受け取った時刻（time.monotonic）
+        self.changed_time = float("-inf")
+        self.changed_load = 0.0  # 最後に段階を変えたときの負荷（目標に対する比）
+        self.changed_lag = 0.0
+        self.calm_since = None
+        self.change_count = 0
+
+    def feedback(self, lag, backlog, now):
+        self.lag, self.backlog, self.feedback_time = lag, backlog, now
+
+    def level_for(self, queued, now):
+        lag, backlog = self.lag, self.backlog
+        if self.feedback_time is None or now - self.feedback_time > RATE_FEEDBACK_TIMEOUT:
+            lag, backlog = 0.0, 0
+        load = max(lag / self.target_lag, backlog / RATE_MAX_BACKLOG, queued / RATE_MAX_QUEUED)
+        if load > 1.0:
+            self.calm_since = None
+            if self.level < len(self.levels) - 1 and load >= self.changed_load \
+                    and now - self.changed_time >= RATE_STEP_INTERVAL + self.changed_lag:
+                self._change(self.level + 1, now, load, lag, f"lag {lag:.3f}s, backlog {backlog}, queued {queued}")
+        elif lag < self.target_lag / 2 and not backlog and not queued:
+            if self.calm_since is None:
+                self.calm_since = now
+            elif self.level > 0 and now - self.calm_since >= RATE_RECOVER_SECONDS:
+                self._change(self.level - 1, now, load, lag, f"lag {lag:.3f}s")
+                self.calm_since = now
+        else:
+            self.calm_since = None
+        return self.level
+
+    def _change(self, level, now, load, lag, reason):
+        logger.info(f"Rate level {self.level} -> {level} ({reason})")
+        self.level = level
+        self.changed_time = now
+        self.changed_load = load
+        self.changed_lag = lag
+        self.change_count += 1
+
+
+class ClientPipeline:
+    """
+    Read, compress and send rotations in three stages.
+
+    The reader thread only parses the ultra_simple output, so a stalled
+    network never fills its stdout pipe; the compressor thread validates
+    and encodes; the sender (run(), on the calling thread) writes the frames
+    and reconnects by itself, without restarting the LiDAR process.  The
+    stages are joined by StageQueue.  In the predictive mode a new
+    connection or a dropped frame makes the next frame a keyframe, and
+    predicted frames are skipped until it is sent.
+
+    With TRANSPORT_UDP every frame goes out as datagrams (split_datagrams)
+    tagged with `sensor_id` and a sequence number; nothing is resent, so a
+    lost rotation never holds back the later ones.
+
+    With `time_sync` the frames carry their FLAG_TIMING trailer, and over
+    TCP a responder thread per connection answers the server's TIME_PING
+    frames, so the server can estimate this clock's offset and drift
+    (the sender and the responder share `send_lock`).
+
+    With `rate_control` (TCP with `time_sync` only) a RateController fed by
+    the server's FEEDBACK frames picks a RATE_LEVELS step per rotation:
+    under load the rotations are sent in the lossy mode and then only every
+    Nth of them, so the delay stays bounded instead of growing until the
+    connection times out.
+
+    Without a `source` the pipeline runs its own LidarProcess
+    (`lidar_command`); rotations outside `min_points`..`max_points` points
+    are not sent.  from_config() builds one from a ClientConfig.
+    """
+    def __init__(self, server_ip, server_port, legacy_format=False, encoding=ENCODING_FIXED, keyframe_interval=None,
+                 source=None, send_quality=False, queue_size=PIPELINE_QUEUE_SIZE, queue_policy=POLICY_DROP_OLDEST,
+                 quantization=None, transport=TRANSPORT_TCP, sensor_id=0, checksum=True, time_sync=True,
+                 rate_control=False, lidar_command=None, min_points=ROTATION_MIN_POINTS,
+                 max_points=ROTATION_MAX_POINTS):
+        if transport not in (TRANSPORT_TCP, TRANSPORT_UDP):
+            raise ValueError(f"Unknown transport: {transport}")
+        if queue_policy not in (POLICY_DROP_OLDEST, POLICY_BLOCK):
+            raise ValueError(f"Unknown queue policy: {queue_policy}")
+        if not 0 <= sensor_id <= 0xFFFF:
+            raise ValueError("The sensor ID must be 0-65535")
+        if transport == TRANSPORT_UDP and legacy_format:
+            raise ValueError("The legacy format cannot be sent over UDP")
+        if rate_control and (transport == TRANSPORT_UDP or legacy_format or not time_sync):
+            raise ValueError("Rate control needs the server's feedback (TCP, framed, with time sync)")
+        self.server_address = (server_ip, server_port)
+        self.transport = transport
+        self.legacy_format = legacy_format
+        self.sensor_id = sensor_id
+        self.datagram_seq = 0
+        self.source = source
+        self.lidar_process = LidarProcess(lidar_command)
+        self.min_points = min_points
+        self.max_points = max_points
+        self.checksum = checksum
+        self.time_sync = time_sync and not legacy_format
+        self.compress, self.encoder = make_compressor(legacy_format, encoding, keyframe_interval, send_quality,
+                                                      quantization, checksum, self.time_sync)
+        self.send_lock = threading.Lock()
+        self.pong_count = 0
+        self.rate_controller = RateController() if rate_control else None
+        self.rate_level = 0
+        self.rate_compressors = {0: self.compress}
+        self.rate_options = (encoding, send_quality, checksum)
+        self.rate_counter = 0
+        self.thinned_count = 0  # 送信量を減らすために送らなかった周の数
+        self.rotation_queue = StageQueue(queue_size, queue_policy)
+        self.frame_queue = StageQueue(queue_size, queue_policy)
+        self.keyframe_needed = threading.Event()
+        self.running = True
+        self.sent_count = 0
+        self.skipped_count = 0    # キーフレームを待つ間に捨てた予測フレームの数
+        self.reconnect_count = 0
+        self.reader = threading.Thread(target=self._read_rotations, daemon=True)
+        self.compressor = threading.Thread(target=self._compress_rotations, daemon=True)
+
+    @classmethod
+    def from_config(cls, config, source=None):
+        """
+        The pipeline for a ClientConfig; settings that cannot work together raise ValueError.
+
+        NumPy is imported here (with `use_numpy`), before the compressors are chosen.
+        """
+        encoding = ENCODING_NAMES.get(config.encoding, config.encoding)
+        if encoding not in ENCODING_NAMES.values():
+            raise ValueError(f"Unknown encoding: {config.encoding}")
+        if config.use_numpy:
+            codec.load_numpy()
+        return cls(config.server_ip, config.server_port, config.legacy_format, encoding, config.keyframe_interval,
+                   source, config.send_quality, config.queue_size, config.queue_policy,
+                   quantization_from_steps(config.angle_step, config.dist_step), config.transport, config.sensor_id,
+                   config.checksum, config.time_sync, config.rate_control,
+                   lidar_command(config.ultra_simple, config.serial_port, config.baudrate), config.min_points,
+                   config.max_points)
+
+    def _read_rotations(self):
+        while self.running:
+            try:
+                for rotation in get_lidar_data(self.source, self.lidar_process):
+                    log_rotation(rotation)
+                    self.rotation_queue.put(rotation)
+                    if not self.running:
+                        break
+            except Exception as e:
+                logger.exception(e)
+            if self.source is not None:
+                break  # 再生は一度だけ
+            if self.running:
+                logger.warning("LiDAR process exited, restarting...")
+                time.sleep(RECONNECT_DELAY)
+        self.rotation_queue.close()
+
+    def _compress_rotations(self):
+        while True:
+            rotation = self.rotation_queue.get()
+            if rotation is None:
+                break
+            if not check_rotation(rotation, self.min_points, self.max_points):
+                continue
+            compress = self.compress
+            if self.rate_controller is not None:
+                compress = self._rate_compressor(rotation)
+                if compress is None:
+                    continue
+            if self.keyframe_needed.is_set():
+                self.keyframe_needed.clear()
+                self.encoder.reset()
+            try:
+                frame = compress(rotation)
+            except Exception as e:
+                logger.exception(e)
+                continue
+            if frame:
+                self.frame_queue.put(frame)
+        self.frame_queue.close()
+
+    def _rate_compressor(self, rotation):
+        """The compressor for the current rate level, or None if this rotation is not sent."""
+        level = self.rate_controller.level_for(len(self.frame_queue), time.monotonic())
+        if level != self.rate_level:
+            if level == 0 and self.encoder is not None:
+                self.keyframe_needed.set()  # 非可逆の間は予測の参照する周を送っていない
+            self.rate_level = level
+        quantization, every = self.rate_controller.levels[level]
+        self.rate_counter += 1
+        if self.rate_counter % every:
+            self.thinned_count += 1
+            return None
+        compress = self.rate_compressors.get(level)
+        if compress is None:
+            encoding, send_quality, checksum = self.rate_options
+            compress, _ = make_compressor(False, encoding, None, send_quality, quantization, checksum, True)
+            self.rate_compressors[level] = compress
+        return compress
+
+    def _connect(self):
+        """
+        Connect to the server, retrying every RECONNECT_DELAY seconds; None once stopped.
+
+        A framed connection starts with FRAME_TYPE_HELLO (`sensor_id`).
+        """
+        while self.running:
+            try:
+                client_socket = socket.create_connection(self.server_address, timeout=SOCKET_TIMEOUT)
+                if not self.legacy_format:
+                    try:
+                        client_socket.sendall(build_hello(self.sensor_id, self.checksum))
+                    except OSError:
+                        client_socket.close()
+                        raise
+            except OSError as e:
+                logger.error(f"Connection failed: {e}. Retrying...")
+                time.sleep(RECONNECT_DELAY)
+                continue
+            logger.debug("Connected to the server")
+            return client_socket
+        return None
+
+    def _answer_pings(self, client_socket):
+        """Responder thread of one connection: answer every TIME_PING (and pass on FEEDBACK) until it is closed."""
+        buffer = bytearray()
+        answering = True
+        while self.running:
+            try:
+                data = client_socket.recv(4096)
+            except socket.timeout:
+                continue  # 問い合わせがないだけ
+            except OSError:
+                break
+            if not data:
+                break
+            received_time = int(time.time() * 1e6)
+            buffer.extend(data)
+            while len(buffer) >= FRAME_HEADER.size:
+                magic, version, frame_type, _, payload_length, _, ping_time = FRAME_HEADER.unpack_from(buffer)
+                if magic != FRAME_MAGIC:
+                    logger.warning("Warning: Invalid frame from the server, ignoring it...")
+                    buffer.clear()
+                    break
+                end = FRAME_HEADER.size + payload_length
+                if len(buffer) < end:
+                    break
+                payload = bytes(buffer[FRAME_HEADER.size:end])
+                del buffer[:end]
+                if frame_type == FRAME_TYPE_FEEDBACK:
+                    if self.rate_controller is not None and len(payload) == FEEDBACK.size:
+                        lag_us, backlog = FEEDBACK.unpack(payload)
+                        self.rate_controller.feedback(lag_us / 1e6, backlog, time.monotonic())
+                    continue
+                if frame_type != FRAME_TYPE_TIME_PING or not answering:
+                    continue
+                try:
+                    with self.send_lock:
+                        client_socket.sendall(build_time_pong(ping_time, received_time, self.checksum))
+                except OSError:
+                    answering = False  # 送信側が閉じた（再接続する）: サーバーが閉じるまで読むだけにする
+                    continue
+                self.pong_count += 1
+
+    def _finish_connection(self, client_socket, responder):
+        """
+        Close after the last frame: send FIN, then read until the server closes its side.
+
+        Closing with TIME_PING / FEEDBACK frames still unread would reset the
+        connection, and the server would lose the frames it has not read yet.
+        """
+        try:
+            client_socket.shutdown(socket.SHUT_WR)
+        except OSError:
+            return
+        if responder is not None:
+            responder.join(timeout=SOCKET_TIMEOUT)  # 応答スレッドがサーバーの FIN まで読む
+            return
+        deadline = time.monotonic() + SOCKET_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                if not client_socket.recv(4096):
+                    break
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+
+    def _needs_keyframe(self, frame):
+        """Predicted frame that the server cannot decode (its reference was not sent)?"""
+        flags = FRAME_HEADER.unpack_from(frame)[3]
+        return bool(flags & FLAG_PREDICTED)
+
+    def _send_datagrams(self):
+        """UDP sender: no connection to keep, a frame that cannot be sent is lost."""
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_socket:
+            udp_socket.connect(self.server_address)
+            while self.running:
+                frame = self.frame_queue.get()
+                if frame is None:
+                    break
+                try:
+                    for datagram in split_datagrams(frame, self.sensor_id, self.datagram_seq):
+                        udp_socket.send(datagram)
+                except (OSError, ValueError) as e:
+                    logger.error(f"Error during data transmission: {e}")
+                else:
+                    self.sent_count += 1
+                self.datagram_seq += 1  # 送れなかった周も seq を進める（サーバーで lost になる）
+
+    def run(self):
+        """
+        Send frames until the source is exhausted or stop() is called.
+        """
+        self.reader.start()
+        self.compressor.start()
+        if self.transport == TRANSPORT_UDP:
+            try:
+                self._send_datagrams()
+            finally:
+                self.stop()
+            logger.info(f"Client pipeline stopped (sent: {self.sent_count}, "
+                        f"dropped: {self.rotation_queue.dropped_count + self.frame_queue.dropped_count})")
+            return
+        frame = None  # 送れなかったフレームは次の接続で送り直す
+        finished = False
+        try:
+            while self.running and not finished:
+                client_socket = self._connect()
+                if client_socket is None:
+                    break
+                responder = None
+                if self.time_sync:
+                    responder = threading.Thread(target=self._answer_pings, args=(client_socket,), daemon=True)
+                    responder.start()
+                with client_socket:
+                    # 新しい接続ではサーバーに前の周がない
+                    waiting_keyframe = self.encoder is not None
+                    if waiting_keyframe:
+                        self.keyframe_needed.set()
+                    dropped_count = self.frame_queue.dropped_count
+                    while self.running:
+                        if frame is None:
+                            frame = self.frame_queue.get()
+                            if frame is None:
+                                finished = True
+                                break
+                        if self.encoder is not None:
+                            if self.frame_queue.dropped_count != dropped_count:
+                                dropped_count = self.frame_queue.dropped_count
+                                waiting_keyframe = True
+                                self.keyframe_needed.set()
+                            if waiting_keyframe and self._needs_keyframe(frame):
+                                self.skipped_count += 1
+                                frame = None
+                                continue
+                            waiting_keyframe = False
+                        try:
+                            with self.send_lock:
+                                client_socket.sendall(frame)
+                        except OSError as e:
+                            logger.error(f"Error during data transmission: {e}. Reconnecting...")
+                            self.reconnect_count += 1
+                            break
+                        frame = None
+                        self.sent_count += 1
+                    if finished:
+                        self._finish_connection(client_socket, responder)
+                    elif responder is not None:
+                        try:
+                            client_socket.shutdown(socket.SHUT_RDWR)  # recv() で待っている応答スレッドを起こす
+                        except OSError:
+                            pass
+                        responder.join(timeout=SOCKET_TIMEOUT)
+        finally:
+            self.stop()
+        logger.info(f"Client pipeline stopped (sent: {self.sent_count}, "
+                    f"dropped: {self.rotation_queue.dropped_count + self.frame_queue.dropped_count}, "
+                    f"skipped: {self.skipped_count}, thinned: {self.thinned_count}, "
+                    f"reconnects: {self.reconnect_count})")
+
+    def stop(self):
+        self.running = False
+        self.rotation_queue.close()
+        self.frame_queue.close()
+        if self.source is None:
+            self.lidar_process.terminate()  # ultra_simple の stdout を閉じて読み取りスレッドを終わらせる
+
+
+def quantization_from_steps(angle_step=None, dist_step=None):
+    """
+    Quantization of the lossy mode from an angle step [°] and a distance step [mm]; None if neither is given.
+    """
+    if angle_step is None and dist_step is None:
+        return None
+    angle_step = round((angle_step or 0.01) * 100)
+    dist_step = dist_step or 1
+    if not (1 <= angle_step <= 0xFFFF and 1 <= dist_step <= 0xFFFF):
+        raise ValueError("The angle step must be 0.01-655.35 and the distance step 1-65535")
+    return Quantization(angle_step, dist_step)
+
+
+ENCODING_NAMES = {"fixed": ENCODING_FIXED, "rice": ENCODING_RICE, "varint": ENCODING_VARINT}
+
+ClientConfig = collections.namedtuple(
+    "ClientConfig",
+    "server_ip server_port ultra_simple serial_port baudrate encoding keyframe_interval legacy_format send_quality "
+    "queue_size queue_policy angle_step dist_step transport sensor_id checksum time_sync rate_control min_points "
+    "max_points use_numpy log_dir async_logging point_sample_rate raw_data_path",
+    defaults=("192.168.201.6", 8000, ULTRA_SIMPLE_PATH, SERIAL_PORT, SERIAL_BAUDRATE, "fixed", None, False, False,
+              PIPELINE_QUEUE_SIZE, POLICY_DROP_OLDEST, None, None, TRANSPORT_TCP, 0, True, True, False,
+              ROTATION_MIN_POINTS, ROTATION_MAX_POINTS, True, "/home/lidar/logs", False, 1.0, None))
+ClientConfig.__doc__ = """
+Settings of the client; load_config(ClientConfig, "client") reads them
+from a JSON file and LIDAR_CLIENT_* environment variables.
+
+`ultra_simple`, `serial_port` and `baudrate` start the LiDAR process.
+`encoding` is a name of ENCODING_NAMES (or the ENCODING_* value);
+`keyframe_interval` selects the predictive mode, `angle_step` [°] /
+`dist_step` [mm] the lossy mode and `legacy_format` the headerless format.
+`send_quality` adds the Q of every point to the frames; `queue_size` and
+`queue_policy` configure the queues between the ClientPipeline stages.
+`transport` "udp" sends datagrams tagged with `sensor_id` instead of the TCP stream.
+`checksum=False` leaves out the CRC32 of every frame (for servers without FLAG_CRC).
+`time_sync=False` leaves out the FLAG_TIMING trailer and does not answer TIME_PING.
+`rate_control` lowers the RATE_LEVELS step while the server reports that it lags behind.
+Rotations with fewer than `min_points` or more than `max_points` points are
+not sent.  `use_numpy` imports NumPy for the fixed encoding.
+The last four are passed to logging_setup().
+"""
+
+
+def client_main(config=None, source=None, **options):
+    """
+    Connect to the server and keep sending rotations.
+
+    `config` is a ClientConfig (by default loaded with load_config(), i.e.
+    from $LIDAR_CONFIG and the LIDAR_CLIENT_* variables); `options` override
+    single fields.  With a `source` such as ReplaySource the client stops
+    once it is exhausted.
+    """
+    if config is None:
+        config = load_config(ClientConfig, "client")
+    config = config._replace(**options)
+    pipeline = ClientPipeline.from_config(config, source)
+    logging_setup(config.log_dir, config.async_logging, config.point_sample_rate, config.raw_data_path)
+    try:
+        pipeline.run()
+    finally:
+        pipeline.stop()
+        if source is not None and source.exhausted:
+            logger.info("Replay finished")
+        logging_shutdown()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Send RPLidar C1 rotations to the LiDAR server.", argument_default=argparse.SUPPRESS,
+        epilog="Settings left out here come from the \"client\" object of the --config file (or $LIDAR_CONFIG) "
+               "and from LIDAR_CLIENT_<SETTING> variables, e.g. LIDAR_CLIENT_SERVER_IP=192.168.201.6.")
+    parser.add_argument("server_ip", nargs="?", default=None)
+    parser.add_argument("server_port", nargs="?", type=int, default=None)
+    parser.add_argument("--config", default=None, help="設定ファイル（JSON）")
+    parser.add_argument("--encoding", choices=sorted(ENCODING_NAMES))
+    parser.add_argument("--keyframe-interval", type=int, help="予測モード（N周ごとにキーフレーム）")
+    parser.add_argument("--legacy-format", action="store_true", help="ヘッダーなしの旧形式で送る")
+    parser.add_argument("--quality", dest="send_quality", action="store_true", help="点ごとの Q も送る")
+    parser.add_argument("--no-crc", dest="checksum", action="store_false",
+                        help="フレームに CRC32 を付けない（古いサーバー向け）")
+    parser.add_argument("--no-time-sync", dest="time_sync", action="store_false",
+                        help="処理時刻を付けず，時刻合わせに応答しない（古いサーバー向け）")
+    parser.add_argument("--adaptive", dest="rate_control", action="store_true",
+                        help="サーバーの遅れに合わせて非可逆モードや間引きで送る量を減らす（TCP のみ）")
+    parser.add_argument("--angle-step", type=float, metavar="DEG",
+                        help="非可逆モード: 角度をこの幅のビンにまとめる（例: 0.5）")
+    parser.add_argument("--dist-step", type=int, metavar="MM", help="非可逆モード: 距離の量子化幅")
+    parser.add_argument("--replay", default=None, metavar="PATH", help="ultra_simple の代わりに記録したデータを再生する")
+    parser.add_argument("--speed", type=float, default=1.0, help="再生速度（0 は待たずに送る）")
+    parser.add_argument("--rotations", type=int, default=None, help="再生する周の数（記録を繰り返す）")
+    parser.add_argument("--queue-size", type=int, help="ステージ間のキューの長さ")
+    parser.add_argument("--queue-policy", choices=[POLICY_DROP_OLDEST, POLICY_BLOCK])
+    parser.add_argument("--transport", choices=[TRANSPORT_TCP, TRANSPORT_UDP],
+                        help="udp: 1周ごとのデータグラムで送る（遅れた周を待たない）")
+    parser.add_argument("--sensor-id", type=int, help="UDP で送るセンサーID（0-65535）")
+    parser.add_argument("--ultra-simple", metavar="PATH", help="ultra_simple の場所")
+    parser.add_argument("--serial-port")
+    parser.add_argument("--baudrate", type=int)
+    parser.add_argument("--min-points", type=int, help="点がこれより少ない周は送らない")
+    parser.add_argument("--max-points", type=int, help="点がこれより多い周は送らない")
+    parser.add_argument("--no-numpy", dest="use_numpy", action="store_false", help="NumPy を読み込まない")
+    parser.add_argument("--log-dir")
+    parser.add_argument("--async-logging", action="store_true")
+    parser.add_argument("--point-sample-rate", type=float)
+    parser.add_argument("--raw-data-path")
+    args = parser.parse_args(argv)
+    for name in ("server_ip", "server_port"):
+        if getattr(args, name) is None:
+            delattr(args, name)  # 省略した時は設定ファイル / 環境変数の値を使う
+    return args
+
+
+def main(argv=None):
+    """Command line: the settings are loaded with load_config() and the options override them."""
+    options = vars(parse_args(argv))
+    path = options.pop("config")
+    replay, speed, rotations = options.pop("replay"), options.pop("speed"), options.pop("rotations")
+    try:
+        config = load_config(ClientConfig, "client", path, **options)
+        source = ReplaySource(replay, speed, rotations) if replay else None
+        ClientPipeline.from_config(config, source)  # 設定の誤りは LiDAR を起動する前に報告する
+    except (OSError, ValueError) as e:
+        sys.exit(f"error: {e}")
+    client_main(config, source)
+
+
+if __name__ == "__main__":
+#    client_main(server_ip="192.168.100.152") # デバック用
+    main()
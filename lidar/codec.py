@@ -0,0 +1,917 @@
+"""
+Wire format shared by the client and the server: the frame header and its
+flags, the encodings of one rotation (fixed, Rice, varint, predictive,
+lossy) and their decoders.
+
+NumPy is optional and is not imported with this module: load_numpy()
+turns the vectorised paths on (LidarServer and ClientPipeline call it when
+they start).
+"""
+import collections
+import logging
+import re
+import struct
+import time
+import zlib
+
+np = None  # load_numpy() で読み込む（NumPy がない環境では None のまま純Python版を使う）
+logger = logging.getLogger("MyLogger")
+
+
+def load_numpy():
+    """
+    Import NumPy for the vectorised paths on the first call; returns it, or None if it is not installed.
+    """
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:  # NumPy がない環境（Raspberry Pi など）では純Python版を使う
+            return None
+        np = numpy
+    return np
+
+
+# 🔹 **フレームヘッダー**: magic(2) + version(1) + 種別(1) + flags(2) + payload長(4) + 点数(2) + 一周の開始時刻(8)
+FRAME_MAGIC = b"\xa5\x5a"
+FRAME_VERSION = 1
+FRAME_TYPE_ROTATION = 0
+FRAME_TYPE_TIME_PING = 1  # サーバー → クライアント: 時刻合わせの問い合わせ（ヘッダーの時刻 = サーバーの送信時刻）
+FRAME_TYPE_TIME_PONG = 2  # クライアント → サーバー: その応答（ヘッダーの時刻 = クライアントの送信時刻）
+FRAME_TYPE_FEEDBACK = 3   # サーバー → クライアント: 受信側の遅れ（RateController が送る量を調整する）
+FRAME_TYPE_HELLO = 4      # クライアント → サーバー: TCP 接続の最初のフレーム（センサーID）
+FRAME_HEADER = struct.Struct(">2sBBHIHQ")
+TIME_PONG = struct.Struct(">QQ")  # 問い合わせの時刻（そのまま返す）, クライアントが受け取った時刻 [μs]
+FEEDBACK = struct.Struct(">IH")   # 最新の周の送信から転送までの遅れ [μs], サーバーで解凍を待っているフレームの数
+HELLO = struct.Struct(">H")       # センサーID（UDP のデータグラムと同じ）
+
+# 🔹 **flags の下位4ビット**: payload の符号化方式
+FLAG_ENCODING_MASK = 0x000F
+ENCODING_FIXED = 0   # 11ビット角度差分 + 16ビット距離差分（従来形式）
+ENCODING_RICE = 1    # zigzag + Rice 符号（周ごとにパラメータ k を選ぶ）
+ENCODING_VARINT = 2  # zigzag + 可変長バイト（LEB128）
+
+RICE_ESCAPE = 24    # 商がこの値以上なら RICE_RAW_BITS ビットの生値で送る
+RICE_RAW_BITS = 24
+
+# 🔹 **予測モード**（前の周との差で距離を送る．Rice 符号と組み合わせる）
+FLAG_KEYFRAME = 0x0010   # 前の周を参照しないフレーム
+FLAG_PREDICTED = 0x0020  # 前の周を参照するフレーム
+PREDICTION_HEADER = struct.Struct(">HH")  # このフレームの seq, 参照するフレームの seq
+PREDICTION_BINS = 3600   # 0.1°ごとの角度ビン
+
+# 🔹 **Q（品質）**: payload の最後に点ごとの uint8 Q を付ける（サーバーのフィルターで使う）
+FLAG_QUALITY = 0x0040
+
+# 🔹 **非可逆モード**: 角度をビンにまとめ（ビンごとに最小の距離），距離を量子化して Rice 符号 / varint で送る
+FLAG_LOSSY = 0x0080
+LOSSY_HEADER = struct.Struct(">HH")  # 角度ビンの幅 [0.01°], 距離の量子化幅 [mm]
+
+# 🔹 **CRC32**: フレームの最後にヘッダーと payload の CRC32 を付ける（壊れたフレームをサーバーが捨てて次のフレームから読み直す）
+FLAG_CRC = 0x0100
+CRC = struct.Struct(">I")
+FRAME_MAX_POINTS = 8192     # 一周の点数の上限（これを超える点数 / payload 長のヘッダーは壊れている）
+FRAME_MAX_POINT_BYTES = 24  # 1点あたりの payload の上限（varint の最悪 + Q）
+FRAME_MAX_EXTRA_BYTES = 64  # 点数によらない部分（予測 / 非可逆のヘッダー，Rice のパラメータ，処理時刻，CRC）
+
+# 🔹 **処理時刻**: 一周の開始時刻からの経過（一周が揃った時刻, 圧縮が終わった時刻）を CRC の前に付ける（サーバーで遅延を段階に分ける）
+FLAG_TIMING = 0x0200
+TIMING = struct.Struct(">II")  # μs
+
+# 🔹 **UDP**: 1周のフレームを断片に分け，それぞれにこのヘッダーを付けて1データグラムで送る
+DATAGRAM_MAGIC = b"LU"
+DATAGRAM_VERSION = 1
+DATAGRAM_HEADER = struct.Struct(">2sBHIBB")  # magic, version, センサーID, seq, 断片の番号, 断片の数
+DATAGRAM_SEQ_MASK = 0xFFFFFFFF
+DATAGRAM_PAYLOAD_SIZE = 1400  # 断片の最大サイズ（イーサネットの MTU に収まるように）
+
+Frame = collections.namedtuple("Frame", "version frame_type flags point_count timestamp payload quality",
+                               defaults=(None,))
+
+
+class FrameError(ValueError):
+    """受信ストリームが正しいフレームとして解釈できない場合の例外"""
+
+
+def compress_data(lines, rotation_start_time, framed=True):
+    """
+    Compress LiDAR data into binary format with 11-bit and 16-bit fixed fields.
+
+    With `framed=True` the payload is wrapped in a versioned frame header;
+    `framed=False` emits the legacy headerless stream (payload + 8-byte timestamp).
+    """
+    theta_values = []
+    dist_values = []
+    for line in lines:
+        match = re.match(r"theta:\s*(\d+\.\d+)\s+Dist:\s*(\d+)", line)
+        if match:
+            theta_values.append(int(float(match.group(1)) * 100))  # Scale theta to integer
+            dist_values.append(int(match.group(2)))  # Distance as integer
+
+    return compress_points(theta_values, dist_values, rotation_start_time, framed)
+
+
+def compress_points(theta_values, dist_values, rotation_start_time, framed=True):
+    """
+    Compress already parsed points (theta in 0.01 deg, dist in mm) of one rotation.
+    """
+    compressed = bytearray()
+    point_count = 0
+    prev_theta = None
+    prev_dist = None
+    bit_buffer = 0
+    bit_count = 0
+
+    def write_bits(value, num_bits):
+        """
+        Helper function to write `value` into `bit_buffer` with `num_bits` bits.
+        """
+        nonlocal bit_buffer, bit_count
+        if value < 0:
+            value = (1 << num_bits) + value  # 符号付き整数の補数表現
+
+        bit_buffer = (bit_buffer << num_bits) | (value & ((1 << num_bits) - 1))
+        bit_count += num_bits
+
+        while bit_count >= 8:
+            compressed.append((bit_buffer >> (bit_count - 8)) & 0xFF)
+            bit_count -= 8
+        bit_buffer &= (1 << bit_count) - 1
+
+    for theta, dist in zip(theta_values, dist_values):
+        # **🔹 theta と dist が 0 のデータを除外**
+        if theta == 0 and dist == 0:
+            continue
+
+        if prev_theta is None:
+            # 初期値（11ビット角度 + 16ビット距離）
+            write_bits(theta, 11)
+            write_bits(dist, 16)
+        else:
+            # 差分（11ビット角度差分 + 16ビット距離差分）
+            theta_diff = theta - prev_theta
+            dist_diff = dist - prev_dist
+
+            # **🔹 追加: 差分の範囲チェック**
+            if not (-1024 <= theta_diff <= 1023) or not (-32768 <= dist_diff <= 32767):
+                logger.warning(f"Warning: Invalid difference detected (Theta: {theta_diff}, Dist: {dist_diff}), skipping this rotation...")
+                return None  # **この回転データを破棄**
+
+            write_bits(theta_diff, 11)
+            write_bits(dist_diff, 16)
+
+        prev_theta = theta
+        prev_dist = dist
+        point_count += 1
+
+    # バッファに残ったビットをフラッシュ
+    if bit_count > 0:
+        compressed.append(bit_buffer << (8 - bit_count))
+
+    return build_frame(compressed, point_count, rotation_start_time, framed)
+
+
+def build_frame(payload, point_count, rotation_start_time, framed=True, flags=0):
+    """
+    Wrap an encoded rotation in the frame header (or the legacy timestamp trailer).
+    """
+    if framed:
+        header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, FRAME_TYPE_ROTATION, flags,
+                                   len(payload), point_count, rotation_start_time)
+        return bytearray(header) + payload
+
+    # 🔹 「一周の開始時刻」を最後に追加（旧形式）
+    payload.extend(struct.pack(">Q", rotation_start_time))  # 64ビット（8バイト）でエンコード
+
+    return payload
+
+
+def append_quality(frame, theta_values, dist_values, quality_values):
+    """
+    Append one uint8 Q per encoded point to a frame and set FLAG_QUALITY.
+
+    The (0, 0) points are skipped here exactly as the encoders skip them.
+    """
+    quality = bytes(min(quality, 255) for theta, dist, quality in zip(theta_values, dist_values, quality_values)
+                    if theta or dist)
+    magic, version, frame_type, flags, payload_length, point_count, start_time = FRAME_HEADER.unpack_from(frame)
+    FRAME_HEADER.pack_into(frame, 0, magic, version, frame_type, flags | FLAG_QUALITY,
+                           payload_length + len(quality), point_count, start_time)
+    frame += quality
+    return frame
+
+
+def append_crc(frame):
+    """
+    Set FLAG_CRC and append the CRC32 of the header and payload; the last step when building a frame.
+    """
+    magic, version, frame_type, flags, payload_length, point_count, start_time = FRAME_HEADER.unpack_from(frame)
+    FRAME_HEADER.pack_into(frame, 0, magic, version, frame_type, flags | FLAG_CRC,
+                           payload_length + CRC.size, point_count, start_time)
+    frame += CRC.pack(zlib.crc32(frame))
+    return frame
+
+
+def append_timing(frame, captured_us, encoded_us):
+    """
+    Set FLAG_TIMING and append when the rotation was complete and when it was encoded (us after its start).
+    """
+    magic, version, frame_type, flags, payload_length, point_count, start_time = FRAME_HEADER.unpack_from(frame)
+    FRAME_HEADER.pack_into(frame, 0, magic, version, frame_type, flags | FLAG_TIMING,
+                           payload_length + TIMING.size, point_count, start_time)
+    frame += TIMING.pack(min(max(0, captured_us), 0xFFFFFFFF), min(max(0, encoded_us), 0xFFFFFFFF))
+    return frame
+
+
+def build_hello(sensor_id, checksum=True):
+    """
+    First frame of a TCP connection: the sensor ID, so the server keeps the sensor's state over reconnects.
+    """
+    frame = bytearray(FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, FRAME_TYPE_HELLO, 0, HELLO.size, 0,
+                                        int(time.time() * 1e6)))
+    frame += HELLO.pack(sensor_id)
+    return append_crc(frame) if checksum else frame
+
+
+def build_time_pong(ping_time, received_time, checksum=True):
+    """
+    Answer to a FRAME_TYPE_TIME_PING; stamped with the send time, so build it right before sending.
+    """
+    frame = bytearray(FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, FRAME_TYPE_TIME_PONG, 0, TIME_PONG.size, 0,
+                                        int(time.time() * 1e6)))
+    frame += TIME_PONG.pack(ping_time, received_time)
+    return append_crc(frame) if checksum else frame
+
+
+def split_datagrams(frame, sensor_id, seq, payload_size=DATAGRAM_PAYLOAD_SIZE):
+    """
+    Split one frame into datagrams of at most `payload_size` bytes plus DATAGRAM_HEADER.
+    """
+    count = max(1, -(-len(frame) // payload_size))
+    if count > 255:
+        raise ValueError(f"Frame too large for datagrams: {len(frame)} bytes")
+    return [DATAGRAM_HEADER.pack(DATAGRAM_MAGIC, DATAGRAM_VERSION, sensor_id, seq & DATAGRAM_SEQ_MASK, index, count)
+            + frame[index * payload_size:(index + 1) * payload_size] for index in range(count)]
+
+
+LINE_PATTERN = re.compile(r"^theta:\s*(\d+\.\d+)\s+Dist:\s*(\d+)", re.MULTILINE)
+
+
+def rotation_to_arrays(lines):
+    """
+    Parse one rotation into int64 arrays (theta in 0.01 deg, dist in mm).
+    """
+    matches = LINE_PATTERN.findall("\n".join(lines))
+    theta = (np.array([m[0] for m in matches], dtype=np.float64) * 100).astype(np.int64)
+    dist = np.array([m[1] for m in matches], dtype=np.int64)
+    return theta, dist
+
+
+def pack_records_numpy(theta, dist):
+    """
+    Pack theta/dist arrays into 27-bit records (11-bit theta + 16-bit dist deltas) in bulk.
+
+    Returns None when a delta does not fit its field, like compress_data.
+    """
+    if len(theta) == 0:
+        return bytearray()
+
+    theta_field = np.empty_like(theta)
+    dist_field = np.empty_like(dist)
+    theta_field[0], dist_field[0] = theta[0], dist[0]  # 初期値
+    theta_field[1:] = np.diff(theta)  # 差分
+    dist_field[1:] = np.diff(dist)
+
+    # **🔹 差分の範囲チェック**
+    invalid = (theta_field[1:] < -1024) | (theta_field[1:] > 1023) | \
+              (dist_field[1:] < -32768) | (dist_field[1:] > 32767)
+    if invalid.any():
+        index = int(np.argmax(invalid)) + 1
+        logger.warning(f"Warning: Invalid difference detected (Theta: {theta_field[index]}, Dist: {dist_field[index]}), skipping this rotation...")
+        return None
+
+    records = ((theta_field & 0x7FF) << 16) | (dist_field & 0xFFFF)  # 負の値は2の補数になる
+    bits = ((records[:, None] >> np.arange(26, -1, -1)) & 1).astype(np.uint8)
+    return bytearray(np.packbits(bits.ravel()).tobytes())  # 余りのビットは0で埋められる
+
+
+def compress_data_numpy(lines, rotation_start_time, framed=True):
+    """
+    NumPy version of compress_data; produces bit-identical output.
+    """
+    theta, dist = rotation_to_arrays(lines)
+    return compress_points_numpy(theta, dist, rotation_start_time, framed)
+
+
+def compress_points_numpy(theta_values, dist_values, rotation_start_time, framed=True):
+    """
+    NumPy version of compress_points (accepts arrays or array.array without copying).
+    """
+    theta = np.asarray(theta_values, dtype=np.int64)
+    dist = np.asarray(dist_values, dtype=np.int64)
+
+    # **🔹 theta と dist が 0 のデータを除外**
+    keep = (theta != 0) | (dist != 0)
+    theta, dist = theta[keep], dist[keep]
+
+    compressed = pack_records_numpy(theta, dist)
+    if compressed is None:
+        return None
+    return build_frame(compressed, len(theta), rotation_start_time, framed)
+
+
+def zigzag(value):
+    """符号付き整数を 0, -1, 1, -2, ... → 0, 1, 2, 3, ... に変換する"""
+    return value << 1 if value >= 0 else ((-value) << 1) - 1
+
+
+def rice_cost(values, k):
+    """Rice 符号（パラメータ k）で `values` を符号化したときのビット数"""
+    cost = 0
+    for value in values:
+        quotient = value >> k
+        cost += quotient + 1 + k if quotient < RICE_ESCAPE else RICE_ESCAPE + RICE_RAW_BITS
+    return cost
+
+
+def rice_parameter(values):
+    """
+    Pick the Rice parameter k (0-15) with the smallest encoded size.
+
+    Only the candidates around log2(median) are evaluated exactly; the
+    median keeps a few large jumps from inflating the estimate.
+    """
+    if not values:
+        return 0
+    guess = sorted(values)[len(values) // 2].bit_length()
+    candidates = range(max(0, guess - 2), min(15, guess + 1) + 1)
+    return min(candidates, key=lambda k: rice_cost(values, k))
+
+
+def rice_bits(values, k, parts):
+    """`values` を Rice 符号のビット列（文字列）として `parts` に追加する"""
+    for value in values:
+        quotient = value >> k
+        if quotient < RICE_ESCAPE:
+            parts.append("1" * quotient + "0")
+            if k:
+                parts.append(format(value & ((1 << k) - 1), f"0{k}b"))
+        else:
+            parts.append("1" * RICE_ESCAPE + format(value, f"0{RICE_RAW_BITS}b"))
+
+
+def bits_to_bytes(bits):
+    """'0'/'1' の文字列をバイト列に変換する（余りのビットは0で埋める）"""
+    if not bits:
+        return bytearray()
+    bits += "0" * (-len(bits) % 8)
+    return bytearray(int(bits, 2).to_bytes(len(bits) // 8, "big"))
+
+
+def split_deltas(theta_values, dist_values):
+    """
+    Drop the (0, 0) points and return (first_theta, first_dist, theta_deltas, dist_deltas, count).
+    """
+    points = [(theta, dist) for theta, dist in zip(theta_values, dist_values) if theta or dist]
+    if not points:
+        return 0, 0, [], [], 0
+    theta_deltas = [points[i][0] - points[i - 1][0] for i in range(1, len(points))]
+    dist_deltas = [points[i][1] - points[i - 1][1] for i in range(1, len(points))]
+    return points[0][0], points[0][1], theta_deltas, dist_deltas, len(points)
+
+
+def prediction_bin(theta):
+    return min(max(theta // 10, 0), PREDICTION_BINS - 1)
+
+
+def build_reference(theta_values, dist_values):
+    """
+    Resample one rotation onto PREDICTION_BINS angle bins.
+
+    Empty bins take the distance of the nearest preceding point (wrapping
+    around 360 deg), so every bin has a prediction.
+    """
+    reference = [None] * PREDICTION_BINS
+    for theta, dist in zip(theta_values, dist_values):
+        if theta or dist:
+            reference[prediction_bin(theta)] = dist
+
+    last = next((dist for dist in reversed(reference) if dist is not None), 0)
+    for index, dist in enumerate(reference):
+        if dist is None:
+            reference[index] = last
+        else:
+            last = dist
+    return reference
+
+
+def encode_rice(theta_values, dist_values, reference=None):
+    """
+    Rice payload: k_theta(4) k_dist(4), first theta(16), first dist(16),
+    then all zigzag theta residuals followed by all zigzag dist deltas.
+
+    The angular step is almost constant, so theta is coded as the change of
+    the delta (second-order difference), which is usually 0 or +-1.
+
+    With a `reference` (see build_reference) the first dist is omitted and
+    the dist channel holds, for every point, the residual against the
+    reference at the same angle bin.
+    """
+    first_theta, first_dist, theta_deltas, dist_deltas, count = split_deltas(theta_values, dist_values)
+    if count == 0:
+        return bytearray(), 0
+    if not (0 <= first_theta <= 0xFFFF and 0 <= first_dist <= 0xFFFF):
+        logger.warning(f"Warning: Invalid first value detected (Theta: {first_theta}, Dist: {first_dist}), skipping this rotation...")
+        return None, 0
+
+    theta_zigzag = [zigzag(value - prev) for prev, value in zip([0] + theta_deltas, theta_deltas)]
+    if reference is None:
+        dist_zigzag = [zigzag(value) for value in dist_deltas]
+    else:
+        dist_zigzag = [zigzag(dist - reference[prediction_bin(theta)])
+                       for theta, dist in zip(theta_values, dist_values) if theta or dist]
+    k_theta = rice_parameter(theta_zigzag)
+    k_dist = rice_parameter(dist_zigzag)
+
+    parts = [format(k_theta, "04b"), format(k_dist, "04b"), format(first_theta, "016b")]
+    if reference is None:
+        parts.append(format(first_dist, "016b"))
+    rice_bits(theta_zigzag, k_theta, parts)
+    rice_bits(dist_zigzag, k_dist, parts)
+    return bits_to_bytes("".join(parts)), count
+
+
+class PredictiveEncoder:
+    """
+    Encode rotations as distance residuals against the previous rotation.
+
+    A keyframe (coded without reference) is sent first, every
+    `keyframe_interval` rotations and after `reset()`.  Frames carry their
+    own sequence number and the one they reference, so the server can
+    detect a missing reference and wait for the next keyframe.
+    """
+    def __init__(self, keyframe_interval=10):
+        self.keyframe_interval = keyframe_interval
+        self.seq = 0
+        self.reference = None
+        self.frames_since_keyframe = 0
+
+    def reset(self):
+        """次のフレームをキーフレームにする（フレームを送れなかった時など）"""
+        self.reference = None
+
+    def encode(self, theta_values, dist_values, rotation_start_time):
+        keyframe = self.reference is None or self.frames_since_keyframe + 1 >= self.keyframe_interval
+        seq = (self.seq + 1) & 0xFFFF
+        if keyframe:
+            payload, point_count = encode_rice(theta_values, dist_values)
+            prefix = PREDICTION_HEADER.pack(seq, seq)
+            flags = ENCODING_RICE | FLAG_KEYFRAME
+        else:
+            payload, point_count = encode_rice(theta_values, dist_values, self.reference)
+            prefix = PREDICTION_HEADER.pack(seq, self.seq)
+            flags = ENCODING_RICE | FLAG_PREDICTED
+        if payload is None:
+            return None
+
+        self.seq = seq
+        self.reference = build_reference(theta_values, dist_values)
+        self.frames_since_keyframe = 0 if keyframe else self.frames_since_keyframe + 1
+        return build_frame(bytearray(prefix) + payload, point_count, rotation_start_time, True, flags)
+
+
+def encode_varint(theta_values, dist_values):
+    """
+    Varint payload: first theta and first dist, then (theta delta, dist delta)
+    per point, each as a zigzag LEB128 varint.
+    """
+    first_theta, first_dist, theta_deltas, dist_deltas, count = split_deltas(theta_values, dist_values)
+    payload = bytearray()
+    if count == 0:
+        return payload, 0
+
+    def write_varint(value):
+        value = zigzag(value)
+        while value >= 0x80:
+            payload.append((value & 0x7F) | 0x80)
+            value >>= 7
+        payload.append(value)
+
+    write_varint(first_theta)
+    write_varint(first_dist)
+    for theta_diff, dist_diff in zip(theta_deltas, dist_deltas):
+        write_varint(theta_diff)
+        write_varint(dist_diff)
+    return payload, count
+
+
+def compress_points_adaptive(theta_values, dist_values, rotation_start_time, encoding=ENCODING_RICE):
+    """
+    Compress one rotation with a variable-length encoding; the mode is stored in the frame flags.
+    """
+    if encoding == ENCODING_RICE:
+        payload, point_count = encode_rice(theta_values, dist_values)
+    elif encoding == ENCODING_VARINT:
+        payload, point_count = encode_varint(theta_values, dist_values)
+    else:
+        raise ValueError(f"Unknown encoding: {encoding}")
+
+    if payload is None:
+        return None
+    return build_frame(payload, point_count, rotation_start_time, True, flags=encoding)
+
+
+Quantization = collections.namedtuple("Quantization", "angle_step dist_step")
+Quantization.__doc__ = """
+Settings of the lossy mode: angle bin width in 0.01 deg, distance step in mm.
+
+Every decoded point is within angle_step / 2 and dist_step / 2 of a
+measured point (see quantization_max_error); the other points of its bin
+are dropped.
+"""
+
+
+def quantization_max_error(quantization):
+    """Guaranteed maximum error of the lossy mode: (degrees, mm)."""
+    return quantization.angle_step / 200.0, quantization.dist_step / 2.0
+
+
+def quantize_points(theta_values, dist_values, quantization):
+    """
+    Bin one rotation onto the angle grid and quantize the distances.
+
+    Returns (bin_indices, dist_steps, source_indices): one point per bin
+    that has a return, ascending by angle, holding the smallest distance
+    of the bin (the nearest obstacle).  Distances that round to 0 count as
+    no return, like the (0, 0) points ultra_simple prints.
+    """
+    angle_step, dist_step = quantization
+    half_step = dist_step // 2
+    nearest = {}  # ビン -> (量子化した距離, 元の点の番号)
+    for index, (theta, dist) in enumerate(zip(theta_values, dist_values)):
+        dist_q = (dist + half_step) // dist_step
+        if dist_q <= 0:
+            continue
+        bin_index = theta // angle_step
+        current = nearest.get(bin_index)
+        if current is None or dist_q < current[0]:
+            nearest[bin_index] = (dist_q, index)
+
+    bins = sorted(nearest)
+    return bins, [nearest[b][0] for b in bins], [nearest[b][1] for b in bins]
+
+
+def compress_points_lossy(theta_values, dist_values, rotation_start_time, quantization, encoding=ENCODING_RICE,
+                          quality_values=None):
+    """
+    Compress one rotation in the lossy mode (FLAG_LOSSY).
+
+    The payload is LOSSY_HEADER followed by the bin indices and quantized
+    distances coded like compress_points_adaptive; server.decode_frame
+    turns them back into (bin centre, distance) points.  With
+    `quality_values` the Q of the kept points is appended (FLAG_QUALITY).
+    """
+    bins, dist_steps, source_indices = quantize_points(theta_values, dist_values, quantization)
+    if encoding == ENCODING_RICE:
+        payload, point_count = encode_rice(bins, dist_steps)
+    elif encoding == ENCODING_VARINT:
+        payload, point_count = encode_varint(bins, dist_steps)
+    else:
+        raise ValueError(f"Lossy mode needs ENCODING_RICE or ENCODING_VARINT, not {encoding}")
+
+    if payload is None:
+        return None
+    payload = bytearray(LOSSY_HEADER.pack(*quantization)) + payload
+    frame = build_frame(payload, point_count, rotation_start_time, True, flags=encoding | FLAG_LOSSY)
+    if quality_values is not None:
+        frame = append_quality(frame, bins, dist_steps, [quality_values[index] for index in source_indices])
+    return frame
+
+
+def decode_points(payload, point_count=None):
+    """
+    Decode the packed 11-bit / 16-bit delta records into (theta, dist) tuples.
+
+    When `point_count` is given exactly that many records are read; otherwise
+    records are read until the payload is exhausted (legacy stream).
+    """
+    decompressed = []
+    buffer = memoryview(payload)
+    current_theta = None
+    current_dist = None
+    bit_buffer = 0
+    bit_count = 0
+    data_index = 0
+
+    def read_bits(num_bits):
+        """
+        Helper function to read `num_bits` bits from `bit_buffer`.
+        """
+        nonlocal bit_buffer, bit_count, data_index
+
+        while bit_count < num_bits:
+            if data_index < len(buffer):
+                bit_buffer = (bit_buffer << 8) | buffer[data_index]
+                data_index += 1
+                bit_count += 8
+            else:
+                raise ValueError("Not enough data to read")
+        
+        value = (bit_buffer >> (bit_count - num_bits)) & ((1 << num_bits) - 1)
+        bit_count -= num_bits
+
+        # 符号付き整数の補正
+        if value & (1 << (num_bits - 1)):
+            value -= (1 << num_bits)
+
+        return value
+
+
+    while True:
+        if point_count is None:
+            if not (data_index < len(buffer) or bit_count >= 11):
+                break
+        elif len(decompressed) >= point_count:
+            break
+
+        if current_theta is None:
+            # 初期値（11ビット角度 + 16ビット距離）
+            theta = read_bits(11)
+            dist = read_bits(16)
+            current_theta = theta / 100.0
+            current_dist = dist
+        else:
+            # 差分適用（11ビット角度差分 + 16ビット距離差分）
+            theta_diff = read_bits(11)
+            dist_diff = read_bits(16)
+            current_theta += theta_diff / 100.0
+            current_dist += dist_diff
+
+        decompressed.append((current_theta, current_dist))
+
+    return decompressed
+
+
+def decompress_data(data):
+    """
+    Decompress binary data into human-readable format.
+    """
+    # 🔹 最後の64ビット（8バイト）をタイムスタンプとして取り出す
+    if len(data) < 8:
+        raise ValueError("Not enough data for timestamp")
+    
+    buffer = memoryview(data)
+    timestamp = struct.unpack(">Q", buffer[-8:])[0]  # 64ビット整数を取得
+    return timestamp, decode_points(buffer[:-8])  # タイムスタンプ部分を除いたデータ
+
+
+def decode_points_numpy(payload, point_count):
+    """
+    NumPy version of decode_points: unpack all 27-bit records in bulk.
+    """
+    if point_count == 0:
+        return []
+    bit_length = point_count * 27
+    raw = np.frombuffer(payload, dtype=np.uint8)
+    if raw.size * 8 < bit_length:
+        raise ValueError("Not enough data to read")
+
+    bits = np.unpackbits(raw)[:bit_length].reshape(point_count, 27).astype(np.int64)
+    records = bits @ (np.int64(1) << np.arange(26, -1, -1, dtype=np.int64))
+    theta = records >> 16
+    dist = records & 0xFFFF
+
+    # 符号付き整数の補正
+    theta[theta >= 1024] -= 2048
+    dist[dist >= 32768] -= 65536
+
+    # 先頭から順に足し合わせる（decode_points と同じ浮動小数点の加算順）
+    current_theta = np.cumsum(theta / 100.0)
+    current_dist = np.cumsum(dist)
+    return list(zip(current_theta.tolist(), current_dist.tolist()))
+
+
+def unzigzag(value):
+    return -((value + 1) >> 1) if value & 1 else value >> 1
+
+
+def accumulate_points(first_theta, first_dist, theta_deltas, dist_deltas):
+    """
+    Rebuild (theta, dist) from the first values and the deltas (same float order as decode_points).
+    """
+    current_theta = first_theta / 100.0
+    current_dist = first_dist
+    decompressed = [(current_theta, current_dist)]
+    for theta_diff, dist_diff in zip(theta_deltas, dist_deltas):
+        current_theta += theta_diff / 100.0
+        current_dist += dist_diff
+        decompressed.append((current_theta, current_dist))
+    return decompressed
+
+
+def read_rice_payload(payload, point_count, predicted=False):
+    """
+    Parse a Rice payload (see client.encode_rice).
+
+    Returns (first_theta, first_dist, theta_deltas, dist_values) where
+    dist_values are the deltas, or for a predicted payload the residuals of
+    every point (first_dist is then None).
+    """
+    if point_count == 0:
+        return 0, None, [], []
+    header_bits = 24 if predicted else 40
+    bits = format(int.from_bytes(payload, "big"), f"0{len(payload) * 8}b") if payload else ""
+    if len(bits) < header_bits:
+        raise ValueError("Not enough data to read")
+    k_theta = int(bits[0:4], 2)
+    k_dist = int(bits[4:8], 2)
+    first_theta = int(bits[8:24], 2)
+    first_dist = None if predicted else int(bits[24:40], 2)
+    position = header_bits
+
+    def read_values(k, count):
+        nonlocal position
+        values = []
+        for _ in range(count):
+            end = bits.find("0", position, position + RICE_ESCAPE)
+            if end < 0:
+                # エスケープ: RICE_ESCAPE 個の1の後に生値
+                start = position + RICE_ESCAPE
+                position = start + RICE_RAW_BITS
+                if position > len(bits):
+                    raise ValueError("Not enough data to read")
+                value = int(bits[start:position], 2)
+            else:
+                quotient = end - position
+                position = end + 1 + k
+                if position > len(bits):
+                    raise ValueError("Not enough data to read")
+                value = (quotient << k) | (int(bits[end + 1:position], 2) if k else 0)
+            values.append(unzigzag(value))
+        return values
+
+    theta_deltas = read_values(k_theta, point_count - 1)
+    dist_values = read_values(k_dist, point_count if predicted else point_count - 1)
+
+    # 角度は「差分の差分」で送られているので差分に戻す
+    theta_diff = 0
+    for index, residual in enumerate(theta_deltas):
+        theta_diff += residual
+        theta_deltas[index] = theta_diff
+    return first_theta, first_dist, theta_deltas, dist_values
+
+
+def decode_rice(payload, point_count):
+    """
+    Decode a Rice payload (see client.encode_rice); theta is second-order coded.
+    """
+    if point_count == 0:
+        return []
+    first_theta, first_dist, theta_deltas, dist_deltas = read_rice_payload(payload, point_count)
+    return accumulate_points(first_theta, first_dist, theta_deltas, dist_deltas)
+
+
+class PredictionState:
+    """
+    Reference rotation of one sensor for decoding predicted frames.
+    """
+    def __init__(self):
+        self.seq = None
+        self.reference = None
+        self.missing_count = 0  # 参照する周がなく捨てたフレームの数
+
+
+def decode_predicted(frame, state):
+    """
+    Decode a keyframe or predicted frame and update `state`.
+
+    Returns None when the referenced rotation is not available; decoding
+    resumes with the next keyframe.
+    """
+    seq, reference_seq = PREDICTION_HEADER.unpack_from(frame.payload)
+    payload = memoryview(frame.payload)[PREDICTION_HEADER.size:]
+    predicted = bool(frame.flags & FLAG_PREDICTED)
+    if predicted and (state.reference is None or state.seq != reference_seq):
+        state.missing_count += 1
+        logger.warning(f"Warning: Reference rotation {reference_seq} is missing (last: {state.seq}), waiting for keyframe...")
+        return None
+
+    first_theta, first_dist, theta_deltas, dist_values = read_rice_payload(payload, frame.point_count, predicted)
+    theta_values = [first_theta]
+    for theta_diff in theta_deltas:
+        theta_values.append(theta_values[-1] + theta_diff)
+
+    if predicted:
+        reference = state.reference
+        dist_values = [reference[prediction_bin(theta)] + residual
+                       for theta, residual in zip(theta_values, dist_values)]
+    elif frame.point_count:
+        dist_deltas = dist_values
+        dist_values = [first_dist]
+        for dist_diff in dist_deltas:
+            dist_values.append(dist_values[-1] + dist_diff)
+
+    state.seq = seq
+    state.reference = build_reference(theta_values, dist_values)
+    if not frame.point_count:
+        return []
+    dist_deltas = [b - a for a, b in zip(dist_values, dist_values[1:])]
+    return accumulate_points(first_theta, dist_values[0], theta_deltas, dist_deltas)
+
+
+def read_varint_payload(payload, point_count):
+    """
+    Parse a zigzag LEB128 payload into (first_theta, first_dist, theta_deltas, dist_deltas).
+    """
+    values = []
+    value = 0
+    shift = 0
+    for byte in payload:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        values.append(unzigzag(value))
+        value = 0
+        shift = 0
+
+    if len(values) < point_count * 2:
+        raise ValueError("Not enough data to read")
+    return values[0], values[1], values[2:point_count * 2:2], values[3:point_count * 2:2]
+
+
+def decode_varint(payload, point_count):
+    """
+    Decode a zigzag LEB128 payload (see client.encode_varint).
+    """
+    if point_count == 0:
+        return []
+    return accumulate_points(*read_varint_payload(payload, point_count))
+
+
+def decode_lossy(frame):
+    """
+    Decode a FLAG_LOSSY frame (see client.compress_points_lossy).
+
+    Each point comes back as (centre of its angle bin, quantized distance),
+    within half a bin and half a distance step of the measured point.
+    """
+    if frame.point_count == 0:
+        return []
+    angle_step, dist_step = LOSSY_HEADER.unpack_from(frame.payload)
+    payload = memoryview(frame.payload)[LOSSY_HEADER.size:]
+    encoding = frame.flags & FLAG_ENCODING_MASK
+    if encoding == ENCODING_RICE:
+        first_bin, first_dist, bin_deltas, dist_deltas = read_rice_payload(payload, frame.point_count)
+    elif encoding == ENCODING_VARINT:
+        first_bin, first_dist, bin_deltas, dist_deltas = read_varint_payload(payload, frame.point_count)
+    else:
+        raise FrameError(f"Unknown lossy encoding: {encoding}")
+
+    bin_index = first_bin
+    dist = first_dist
+    decompressed = [((bin_index * angle_step + angle_step / 2) / 100.0, dist * dist_step)]
+    for bin_diff, dist_diff in zip(bin_deltas, dist_deltas):
+        bin_index += bin_diff
+        dist += dist_diff
+        decompressed.append(((bin_index * angle_step + angle_step / 2) / 100.0, dist * dist_step))
+    return decompressed
+
+
+def decode_frame(frame, state=None):
+    """
+    Decode one complete frame into (timestamp, [(theta, dist), ...]).
+
+    Predicted frames need the sensor's PredictionState; the points are None
+    when the frame cannot be decoded until the next keyframe.
+    """
+    if frame.flags & (FLAG_KEYFRAME | FLAG_PREDICTED):
+        if state is None:
+            raise FrameError("Predicted frame without prediction state")
+        return frame.timestamp, decode_predicted(frame, state)
+
+    if frame.flags & FLAG_LOSSY:
+        return frame.timestamp, decode_lossy(frame)
+
+    encoding = frame.flags & FLAG_ENCODING_MASK
+    if encoding == ENCODING_RICE:
+        return frame.timestamp, decode_rice(frame.payload, frame.point_count)
+    if encoding == ENCODING_VARINT:
+        return frame.timestamp, decode_varint(frame.payload, frame.point_count)
+    if encoding != ENCODING_FIXED:
+        raise FrameError(f"Unknown encoding: {encoding}")
+
+    if np is not None:
+        return frame.timestamp, decode_points_numpy(frame.payload, frame.point_count)
+    return frame.timestamp, decode_points(frame.payload, frame.point_count)
+
+
+def split_quality(flags, point_count, payload):
+    """
+    Separate the trailing per-point Q bytes of a FLAG_QUALITY frame: returns (payload, quality or None).
+    """
+    if not flags & FLAG_QUALITY:
+        return payload, None
+    if len(payload) < point_count:
+        raise FrameError("Quality section is longer than the payload")
+    return payload[:len(payload) - point_count], payload[len(payload) - point_count:]
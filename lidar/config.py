@@ -0,0 +1,65 @@
+"""
+Settings of the server and the client from a JSON file and the environment.
+
+The file holds one object per program and is named by --config or
+LIDAR_CONFIG:
+
+    {"server": {"lidar_port": 9000, "store_dir": "/data/store"},
+     "client": {"server_ip": "10.0.0.2", "encoding": "rice"}}
+
+LIDAR_SERVER_<FIELD> / LIDAR_CLIENT_<FIELD> environment variables (e.g.
+LIDAR_SERVER_LIDAR_PORT=9000) override the file; their values are JSON
+(numbers, lists, null), true / false, or else plain strings.
+"""
+import json
+import os
+
+CONFIG_ENV = "LIDAR_CONFIG"
+ENV_PREFIX = "LIDAR_"
+BOOLEAN_WORDS = {"true": True, "yes": True, "on": True, "false": False, "no": False, "off": False}
+
+
+def parse_value(text):
+    """環境変数の値: true / false の語, JSON, それ以外は文字列のまま"""
+    word = text.strip().lower()
+    if word in BOOLEAN_WORDS:
+        return BOOLEAN_WORDS[word]
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def load_config(config_type, section, path=None, environ=None, **overrides):
+    """
+    Build a `config_type` (a namedtuple with defaults) for `section` ("server" / "client").
+
+    Each source overrides the ones before it: the defaults, the `section`
+    object of the JSON file at `path` (default: $LIDAR_CONFIG), the
+    LIDAR_<SECTION>_* variables of `environ` (default: os.environ) and
+    `overrides`.  JSON lists become tuples.  An unknown setting or an
+    unreadable file raises ValueError.
+    """
+    environ = os.environ if environ is None else environ
+    values = {}
+    path = path or environ.get(CONFIG_ENV)
+    if path:
+        try:
+            with open(path, encoding="utf-8") as f:
+                document = json.load(f)
+        except OSError as e:
+            raise ValueError(f"Cannot read the config file: {e}") from e
+        section_values = document.get(section, {}) if isinstance(document, dict) else None
+        if not isinstance(section_values, dict):
+            raise ValueError(f"{path}: \"{section}\" must be an object")
+        values.update(section_values)
+    prefix = f"{ENV_PREFIX}{section.upper()}_"
+    values.update((name[len(prefix):].lower(), parse_value(text))
+                  for name, text in environ.items() if name.startswith(prefix))
+    values.update(overrides)
+
+    unknown = set(values) - set(config_type._fields)
+    if unknown:
+        raise ValueError(f"Unknown {section} settings: {', '.join(sorted(unknown))}")
+    return config_type()._replace(**{name: tuple(value) if isinstance(value, list) else value
+                                     for name, value in values.items()})
@@ -0,0 +1,221 @@
+"""
+Decoding in worker processes for the asyncio server (decode_workers > 0).
+
+Imported by AsyncLidarServer only when workers are configured, so the
+default server does not load multiprocessing.  The workers are spawned and
+import this module (and lidar.server) themselves.
+"""
+import array
+import collections
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from multiprocessing import shared_memory
+
+from .codec import Frame, PredictionState, decode_frame, split_quality
+from .server import FILTER_REASONS, filter_invalid_data, load_numpy
+
+DECODE_SLOT_SIZE = 16384  # 共有メモリの1スロットのバイト数（フレーム / 解凍結果）
+DECODE_SLOTS = 64         # ワーカーごとのスロット数（同時に処理中のフレームの上限）
+DecodedRotation = collections.namedtuple(
+    "DecodedRotation", "sensor_id timestamp total_count points delete_count reasons decode_seconds error")
+
+
+def _decode_worker(shm_name, slot_size, requests, results, use_numpy=True):
+    """
+    Worker process: decode + filter frames written to shared memory.
+
+    A spawned worker starts without NumPy; it is loaded here like in the
+    parent (`use_numpy`).
+
+    Prediction state is kept per sensor, which is why a sensor always goes
+    to the same worker.  Decoded points are written back as float64 theta
+    and int32 dist to the output half of the same slot.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C は親プロセスが受けて close() で止める
+    logging.getLogger("MyLogger").addHandler(logging.NullHandler())
+    logging.getLogger("MyLogger").propagate = False  # 削除の理由は親プロセスがまとめて記録する
+    load_numpy(use_numpy)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    output_base = shm.size // 2
+    states = {}
+    rules = {}  # sensor_id -> FilterRules（親プロセスの設定）
+    try:
+        while True:
+            request = requests.get()
+            if request is None:
+                break
+            if request[0] == "rules":
+                rules[request[1]] = request[2]
+                continue
+            if request[0] == "close":
+                states.pop(request[1], None)
+                rules.pop(request[1], None)
+                continue
+
+            _, sensor_id, slot, frame_header, inline_payload = request
+            start = time.perf_counter()
+            points = None
+            total_count = delete_count = 0
+            reasons = dict.fromkeys(FILTER_REASONS, 0)
+            error = None
+            try:
+                version, frame_type, flags, point_count, timestamp, length = frame_header
+                if inline_payload is None:
+                    payload = bytes(shm.buf[slot * slot_size:slot * slot_size + length])
+                else:
+                    payload = inline_payload
+                payload, quality = split_quality(flags, point_count, payload)
+                frame = Frame(version, frame_type, flags, point_count, timestamp, payload, quality)
+                timestamp, decompressed_data = decode_frame(frame, states.setdefault(sensor_id, PredictionState()))
+                if decompressed_data is not None:
+                    total_count = len(decompressed_data)
+                    filtered_data, delete_count = filter_invalid_data(decompressed_data, reasons,
+                                                                      rules.get(sensor_id), quality)
+                    count = len(filtered_data)
+                    if count * 12 <= slot_size:
+                        theta_array = array.array("d", [theta for theta, _ in filtered_data])
+                        dist_array = array.array("i", [dist for _, dist in filtered_data])
+                        offset = output_base + slot * slot_size
+                        shm.buf[offset:offset + count * 8] = theta_array.tobytes()
+                        shm.buf[offset + count * 8:offset + count * 12] = dist_array.tobytes()
+                        points = count
+                    else:
+                        points = filtered_data  # スロットに入らない場合はキューで返す
+            except Exception as e:
+                timestamp = 0
+                error = repr(e)
+            results.put((sensor_id, slot, timestamp, total_count, points, delete_count, reasons,
+                         time.perf_counter() - start, error))
+    finally:
+        shm.close()
+
+
+class DecodePool:
+    """
+    Decode frames in worker processes through shared memory.
+
+    Every sensor is assigned to one worker (the one with the fewest sensors)
+    for its whole connection, so its prediction state stays in that worker
+    and its rotations come back in order.  After release() the assignment
+    is kept until the sensor's queued frames are decoded, so a sensor that
+    reconnects at once goes to the same worker, behind its old frames.  Payloads are copied into
+    shared-memory slots instead of being pickled; `on_result(message)` is
+    called from a reader thread and the owner passes the message to
+    `read_result` on its own thread, which frees the slot.  `rules_for(sensor_id)`
+    gives the FilterRules sent to the worker with the sensor's first frame.
+    The workers decode and filter with NumPy if `use_numpy`.
+    """
+    def __init__(self, workers, on_result, rules_for=None, slot_size=DECODE_SLOT_SIZE, slots_per_worker=DECODE_SLOTS,
+                 use_numpy=True):
+        context = multiprocessing.get_context("spawn")
+        self.slot_size = slot_size
+        self.slots_per_worker = slots_per_worker
+        self.shm = shared_memory.SharedMemory(create=True, size=workers * slots_per_worker * slot_size * 2)
+        self.output_base = self.shm.size // 2
+        self.results = context.Queue()
+        self.requests = []
+        self.free_slots = []
+        self.processes = []
+        for index in range(workers):
+            requests = context.Queue()
+            process = context.Process(target=_decode_worker,
+                                      args=(self.shm.name, slot_size, requests, self.results, use_numpy), daemon=True)
+            process.start()
+            self.requests.append(requests)
+            self.processes.append(process)
+            self.free_slots.append(list(range(index * slots_per_worker, (index + 1) * slots_per_worker)))
+        self.assignment = {}  # sensor_id -> ワーカー番号
+        self.sensor_counts = [0] * workers
+        self.in_flight = collections.Counter()  # sensor_id -> ワーカーに渡して結果をまだ読んでいないフレームの数
+        self.released = set()  # release() 済みで，フレームが残っているので割り当てを残しているセンサー
+        self.on_result = on_result
+        self.rules_for = rules_for
+        self.reader = threading.Thread(target=self._read_results, daemon=True)
+        self.reader.start()
+
+    def submit(self, sensor_id, frame):
+        """
+        Hand one frame to the worker of `sensor_id`; returns False if all its slots are busy.
+        """
+        worker = self.assignment.get(sensor_id)
+        if worker is None:
+            worker = self.sensor_counts.index(min(self.sensor_counts))
+            self.assignment[sensor_id] = worker
+            self.sensor_counts[worker] += 1
+            if self.rules_for is not None:
+                self.requests[worker].put(("rules", sensor_id, self.rules_for(sensor_id)))
+        elif sensor_id in self.released:
+            # 前の接続のフレームが残っている間に再接続した: 同じワーカーで続ける（"close" で消えた設定を送り直す）
+            self.released.discard(sensor_id)
+            if self.rules_for is not None:
+                self.requests[worker].put(("rules", sensor_id, self.rules_for(sensor_id)))
+        free_slots = self.free_slots[worker]
+        if not free_slots:
+            return False
+
+        slot = free_slots.pop()
+        payload = frame.payload if frame.quality is None else frame.payload + frame.quality  # Q はワーカーで分ける
+        length = len(payload)
+        inline_payload = None
+        if length <= self.slot_size:
+            self.shm.buf[slot * self.slot_size:slot * self.slot_size + length] = payload
+        else:
+            inline_payload = payload
+        frame_header = (frame.version, frame.frame_type, frame.flags, frame.point_count, frame.timestamp, length)
+        self.requests[worker].put(("frame", sensor_id, slot, frame_header, inline_payload))
+        self.in_flight[sensor_id] += 1
+        return True
+
+    def release(self, sensor_id):
+        """接続が切れたセンサーの予測の状態をワーカーから削除する"""
+        worker = self.assignment.get(sensor_id)
+        if worker is None:
+            return
+        self.requests[worker].put(("close", sensor_id))  # 残っているフレームの後に処理される
+        if self.in_flight[sensor_id]:
+            self.released.add(sensor_id)  # 割り当ては残りのフレームの結果を読んだ時に外す
+        else:
+            self._unassign(sensor_id)
+
+    def _unassign(self, sensor_id):
+        self.sensor_counts[self.assignment.pop(sensor_id)] -= 1
+        self.released.discard(sensor_id)
+        self.in_flight.pop(sensor_id, None)
+
+    def _read_results(self):
+        while True:
+            message = self.results.get()
+            if message is None:
+                break
+            self.on_result(message)
+
+    def read_result(self, message):
+        """
+        Turn a worker message into a DecodedRotation and free its slot.
+        """
+        sensor_id, slot, timestamp, total_count, points, delete_count, reasons, decode_seconds, error = message
+        if isinstance(points, int):
+            offset = self.output_base + slot * self.slot_size
+            theta_array = array.array("d")
+            dist_array = array.array("i")
+            theta_array.frombytes(self.shm.buf[offset:offset + points * 8])
+            dist_array.frombytes(self.shm.buf[offset + points * 8:offset + points * 12])
+            points = list(zip(theta_array, dist_array))
+        self.free_slots[slot // self.slots_per_worker].append(slot)
+        self.in_flight[sensor_id] -= 1
+        if not self.in_flight[sensor_id] and sensor_id in self.released:
+            self._unassign(sensor_id)
+        return DecodedRotation(sensor_id, timestamp, total_count, points, delete_count, reasons, decode_seconds, error)
+
+    def close(self):
+        for requests in self.requests:
+            requests.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
+        self.results.put(None)
+        self.reader.join()
+        self.shm.close()
+        self.shm.unlink()
@@ -0,0 +1,101 @@
+"""
+HTTP side of the LiDAR server: /metrics and the ScanCache queries.
+
+Imported by LidarServer only when a metrics port is configured, so a
+server without it does not load http.server.
+"""
+import base64
+import http.server
+import json
+import logging
+import threading
+import urllib.parse
+
+from .server import GRID_RESOLUTION, GRID_SIZE, METRICS_PORT
+
+logger = logging.getLogger("MyLogger")
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    GET /metrics, and the ScanCache queries (answered as JSON):
+      /sensors                                   sensors in the cache
+      /scan?sensor=ID                            latest rotation, distance per angle bin
+      /sector?sensor=ID&start=DEG&end=DEG[&rotations=N]  nearest point in a sector
+      /grid?sensor=ID[&format=binary]            occupancy grid snapshot
+    `sensor` may be left out while only one sensor is connected.  The
+    LidarServer answered for is `self.server.lidar_server`.
+    """
+    def do_GET(self):
+        lidar_server = self.server.lidar_server
+        scan_cache = lidar_server.scan_cache
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/metrics":
+            self._send(lidar_server.metrics.render().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8")
+            return
+        if url.path not in ("/sensors", "/scan", "/sector", "/grid"):
+            self.send_error(404)
+            return
+        if scan_cache is None:
+            self.send_error(404, "Scan cache is disabled")
+            return
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == "/sensors":
+            self._send_json({sensor_id: {"rotations": cache.count, "timestamp": cache.timestamps[cache.latest]}
+                             for sensor_id, cache in list(scan_cache.sensors.items()) if cache.latest >= 0})
+            return
+        cache = scan_cache.get(query.get("sensor"))
+        if cache is None or cache.latest < 0:
+            self.send_error(404, "Unknown sensor (or several sensors and no sensor=)")
+            return
+        try:
+            if url.path == "/scan":
+                timestamp, dist = cache.latest_scan()
+                self._send_json({"timestamp": timestamp, "bin_width": 360.0 / cache.bins, "dist": dist})
+            elif url.path == "/sector":
+                nearest = cache.sector_min(float(query["start"]), float(query["end"]),
+                                           int(query.get("rotations", 1)))
+                if nearest is None:
+                    self._send_json({"dist": None, "theta": None, "timestamp": None})
+                else:
+                    self._send_json(dict(zip(("dist", "theta", "timestamp"), nearest)))
+            else:
+                grid = cache.grid_snapshot()
+                if grid is None:
+                    self.send_error(404, "Occupancy grid is disabled")
+                elif query.get("format") == "binary":
+                    self._send(grid, "application/octet-stream")
+                else:
+                    self._send_json({"size": GRID_SIZE, "resolution": GRID_RESOLUTION, "rotations": cache.count,
+                                     "cells": base64.b64encode(grid).decode("ascii")})
+        except (KeyError, ValueError) as e:
+            self.send_error(400, f"Invalid query: {e}")
+
+    def _send_json(self, value):
+        self._send(json.dumps(value).encode("utf-8"), "application/json")
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # アクセスごとのログは出さない
+
+
+def start_metrics_server(lidar_server, port=METRICS_PORT, manager=None, host="0.0.0.0"):
+    """
+    Serve /metrics and the ScanCache queries of `lidar_server` from a background thread.
+
+    `manager` is the monitor manager whose viewer queues are exported.
+    Returns the ThreadingHTTPServer (shutdown() stops it).
+    """
+    lidar_server.metrics.manager = manager
+    httpd = http.server.ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    httpd.daemon_threads = True
+    httpd.lidar_server = lidar_server
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    logger.info(f"Metrics server listening on port {port}")
+    return httpd
@@ -0,0 +1,265 @@
+"""
+Logging shared by the client and the server.
+
+Both programs log to the process-wide "MyLogger" logger: a data log for
+the per-rotation dumps and an error log, optionally written by
+AsyncLogWriter, with the dumps thinned out by PointSampler or replaced by
+the binary RawDataRecorder.  Each program's logging_setup() chooses its
+file layout and calls setup_logging().
+"""
+import array
+import logging
+import logging.handlers
+import os
+import queue
+import struct
+import sys
+import threading
+
+logger = logging.getLogger("MyLogger")  # logging_setup() でハンドラーを設定する
+
+LOG_QUEUE_SIZE = 10000  # 書き込み待ちのログレコードの上限（溢れた分は捨てる）
+LOG_BATCH_SIZE = 256    # 書き込みスレッドが一度に処理するレコード数
+LOG_MAX_BYTES = 1024*1024*10
+LOG_BACKUP_COUNT = 5
+
+
+# 🔹 **データのログに `level` 未満のログのみを記録するフィルタ**
+class LevelBelowFilter(logging.Filter):
+    def __init__(self, level):
+        super().__init__()
+        self.level = level
+
+    def filter(self, record):
+        return record.levelno < self.level
+
+
+class BatchRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    RotatingFileHandler that is flushed once per batch by AsyncLogWriter
+    instead of once per record.
+    """
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """キューが一杯の時はブロックせずにレコードを捨てる"""
+    def __init__(self, record_queue):
+        super().__init__(record_queue)
+        self.dropped_count = 0
+
+    def prepare(self, record):
+        # 同じプロセスのスレッドに渡すだけなので，メッセージの組み立ては書き込みスレッドに任せる
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_count += 1
+
+
+class AsyncLogWriter:
+    """
+    Write log records on a dedicated thread.
+
+    The LiDAR and receiving threads only put records into a bounded queue
+    through `queue_handler`; the writer takes them in batches and flushes
+    each file once per batch, so they never wait for the disk.
+    """
+    def __init__(self, handlers, max_queue=LOG_QUEUE_SIZE, batch_size=LOG_BATCH_SIZE):
+        self.queue = queue.Queue(max_queue)
+        self.queue_handler = DroppingQueueHandler(self.queue)
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for record in batch:
+                if record is None:  # stop() から
+                    running = False
+                    continue
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            for handler in self.handlers:
+                handler.flush_batch()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+        for handler in self.handlers:
+            handler.close()
+
+
+class PointSampler:
+    """
+    Decide which point-level DEBUG dumps are written (rate 1.0 = all, 0.1 = every 10th rotation).
+    """
+    def __init__(self, rate=1.0):
+        self.rate = rate
+        self.credit = 0.0
+
+    def sample(self):
+        if self.rate >= 1.0:
+            return True
+        self.credit += self.rate
+        if self.credit >= 1.0:
+            self.credit -= 1.0
+            return True
+        return False
+
+
+RAW_RECORD_MAGIC = b"LR"
+# magic, Qの有無, 点数, 一周の開始時刻(μs)（この後に int32 角度[n](0.01°), int32 距離[n], uint8 Q[n]）
+RAW_RECORD_HEADER = struct.Struct("<2sBIQ")
+
+
+class RawDataRecorder:
+    """
+    Compact binary recorder for rotations (replaces the text dump in the data log).
+
+    Rotations are queued without blocking and written by a dedicated thread;
+    the file rotates like RotatingFileHandler (`max_bytes`, `backup_count`).
+    """
+    def __init__(self, path, max_bytes=1024*1024*50, backup_count=5, max_queue=256):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.queue = queue.Queue(max_queue)
+        self.dropped_count = 0
+        self.file = open(path, "ab")
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def record(self, start_time, theta, dist, quality=None):
+        """
+        `theta` [0.01°] と `dist` は整数の列（ジェネレーターでもよい: 変換は書き込みスレッドで行う）
+        """
+        try:
+            self.queue.put_nowait((start_time, theta, dist, quality))
+        except queue.Full:
+            self.dropped_count += 1
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self._write(*item)
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.file.flush()
+                    return
+                self._write(*item)
+            self.file.flush()
+
+    def _write(self, start_time, theta, dist, quality):
+        theta_array = array.array("i", theta)
+        dist_array = array.array("i", dist)
+        if sys.byteorder == "big":
+            theta_array.byteswap()
+            dist_array.byteswap()
+        self.file.write(RAW_RECORD_HEADER.pack(RAW_RECORD_MAGIC, quality is not None, len(theta_array), start_time))
+        self.file.write(theta_array.tobytes())
+        self.file.write(dist_array.tobytes())
+        if quality is not None:
+            self.file.write(bytes(min(value, 255) for value in quality))
+        if self.file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self.file.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        self.file = open(self.path, "wb")
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+
+log_writer = None     # 非同期ログの書き込みスレッド（async_logging=True の時）
+point_sampler = PointSampler()
+raw_recorder = None   # 点のバイナリ記録（raw_data_path を指定した時）
+
+
+def setup_logging(data_path, data_below, error_path, error_level, async_logging=False, point_sample_rate=1.0,
+                  raw_data_path=None):
+    """
+    Configure the logger with a data log (records below `data_below`) and an error log (`error_level` and up).
+
+    `async_logging` moves all file writes to AsyncLogWriter, `point_sample_rate`
+    thins out the per-rotation point dump and `raw_data_path` replaces that
+    text dump with RawDataRecorder.
+    """
+    global log_writer, point_sampler, raw_recorder
+    os.makedirs(os.path.dirname(data_path), exist_ok=True)
+    os.makedirs(os.path.dirname(error_path), exist_ok=True)
+
+    logger.setLevel(logging.DEBUG)  # すべてのログを処理対象にする
+    logging_shutdown()  # 以前の設定があれば閉じる
+
+    file_handler_class = BatchRotatingFileHandler if async_logging else logging.handlers.RotatingFileHandler
+    data_handler = file_handler_class(data_path, encoding="utf-8", maxBytes=LOG_MAX_BYTES,
+                                      backupCount=LOG_BACKUP_COUNT)
+    data_handler.setLevel(logging.DEBUG)
+    data_handler.addFilter(LevelBelowFilter(data_below))
+    error_handler = file_handler_class(error_path, encoding="utf-8", maxBytes=LOG_MAX_BYTES,
+                                       backupCount=LOG_BACKUP_COUNT)
+    error_handler.setLevel(error_level)
+
+    # 🔹 **フォーマット設定**
+    formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
+    data_handler.setFormatter(formatter)
+    error_handler.setFormatter(formatter)
+
+    # 🔹 **ロガーにハンドラーを追加**
+    if async_logging:
+        log_writer = AsyncLogWriter([data_handler, error_handler])
+        logger.addHandler(log_writer.queue_handler)
+    else:
+        logger.addHandler(data_handler)
+        logger.addHandler(error_handler)
+
+    point_sampler = PointSampler(point_sample_rate)
+    if raw_data_path:
+        raw_recorder = RawDataRecorder(raw_data_path)
+
+
+def logging_shutdown():
+    """書き込みスレッドを止めて，すべてのログを書き出す"""
+    global log_writer, raw_recorder
+    if log_writer is not None:
+        logger.removeHandler(log_writer.queue_handler)
+        log_writer.stop()
+        log_writer = None
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    if raw_recorder is not None:
+        raw_recorder.stop()
+        raw_recorder = None
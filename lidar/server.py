@@ -0,0 +1,1886 @@
+import argparse
+import logging.handlers
+import socket
+import threading
+import struct
+import time
+import datetime
+import logging
+import os
+import queue
+import collections
+import json
+import array
+import urllib.parse
+import sys
+import bisect
+import heapq
+import mmap
+import statistics
+import itertools
+import math
+import zlib
+
+from . import codec, logging_util
+from .codec import (
+    CRC, DATAGRAM_HEADER, DATAGRAM_MAGIC, DATAGRAM_SEQ_MASK, DATAGRAM_VERSION, FEEDBACK, FLAG_CRC, FLAG_TIMING,
+    FRAME_HEADER, FRAME_MAGIC, FRAME_MAX_EXTRA_BYTES, FRAME_MAX_POINT_BYTES, FRAME_MAX_POINTS, FRAME_TYPE_FEEDBACK,
+    FRAME_TYPE_ROTATION, FRAME_TYPE_TIME_PING, FRAME_TYPE_TIME_PONG, FRAME_VERSION, TIME_PONG, TIMING, Frame,
+    FrameError, PredictionState, decode_frame, decompress_data, split_quality,
+)
+from .config import load_config
+from .logging_util import logger, logging_shutdown, setup_logging
+
+np = None  # load_numpy() で codec と一緒に読み込む（NumPy がない場合は純Python版で解凍する）
+
+
+def load_numpy(enabled=True):
+    """Turn the NumPy paths of this module and the codec on (if NumPy is installed) or off."""
+    global np
+    np = codec.load_numpy() if enabled else None
+    codec.np = np
+    return np
+
+
+LEGACY_MAX_BUFFER = 65536   # 旧形式で解凍できないまま溜めるバイト数の上限
+
+DATAGRAM_REASSEMBLY_TIMEOUT = 1.0  # 揃わない断片を捨てるまでの秒数
+DATAGRAM_MAX_PENDING = 8           # センサーごとに組み立て中の周の上限
+DATAGRAM_RESTART_WINDOW = 1000     # seq がこれより大きく戻ったらクライアントの再起動とみなす
+
+# 🔹 **8001番ポートの出力形式**（ビューアが接続時に選ぶ）
+FORMAT_TEXT = "text"      # "Theta: x, Distance: y"（従来の形式）
+FORMAT_NDJSON = "ndjson"  # 一周ごとに1行のJSON
+FORMAT_BINARY = "binary"  # MONITOR_BINARY_HEADER + float32 角度[n] + uint16 距離[n]（リトルエンディアン）
+MONITOR_FORMATS = (FORMAT_TEXT, FORMAT_NDJSON, FORMAT_BINARY)
+FORMAT_REQUEST_WAIT = 0.3  # 接続直後に形式の指定を待つ秒数
+# magic, version, flags(bit0: 有効な周), 点数, 一周の開始時刻(μs), センサーIDの長さ（この後にセンサーID）
+MONITOR_BINARY_HEADER = struct.Struct("<4sBBIQH")
+MONITOR_BINARY_MAGIC = b"LDSC"
+HTTP_CONTENT_TYPES = {
+    FORMAT_TEXT: "text/plain; charset=utf-8",
+    FORMAT_NDJSON: "application/x-ndjson",
+    FORMAT_BINARY: "application/octet-stream",
+}
+
+
+def parse_format_request(request):
+    """
+    Pick the output format from the first bytes a viewer sent.
+
+    Accepts an HTTP request line ("GET /ndjson" or "GET /?format=ndjson",
+    e.g. from curl) or a bare format name ("ndjson\n", e.g. from ncat).
+    Returns (format, is_http); unknown or missing requests give text.
+    """
+    line = request.split(b"\n", 1)[0].decode("ascii", "replace").strip()
+    is_http = line.startswith("GET ")
+    if is_http:
+        parsed = urllib.parse.urlsplit(line.split()[1] if len(line.split()) > 1 else "/")
+        name = urllib.parse.parse_qs(parsed.query).get("format", [parsed.path.strip("/")])[0]
+    else:
+        name = line
+    name = name.lower()
+    return (name if name in MONITOR_FORMATS else FORMAT_TEXT), is_http
+
+
+def http_response_header(output_format):
+    return (f"HTTP/1.0 200 OK\r\nContent-Type: {HTTP_CONTENT_TYPES[output_format]}\r\n"
+            "Cache-Control: no-cache\r\n\r\n").encode("ascii")
+
+
+class RotationMessage:
+    """
+    One rotation for the port 8001 viewers.
+
+    Each output format is encoded lazily and at most once, then the same
+    bytes are shared by every viewer that asked for that format.
+    `points` is None for a rotation that was rejected by the filter.
+    """
+    def __init__(self, timestamp, points, sensor_id=None, clock_offset=0.0):
+        self.timestamp = timestamp
+        self.points = points
+        self.sensor_id = sensor_id
+        self.clock_offset = clock_offset  # センサーの時計のずれ [μs]（遅延の表示用）
+        self.encoded = {}
+        self._text = None
+
+    def encode(self, output_format):
+        data = self.encoded.get(output_format)
+        if data is None:
+            if output_format == FORMAT_NDJSON:
+                data = self._encode_ndjson()
+            elif output_format == FORMAT_BINARY:
+                data = self._encode_binary()
+            else:
+                data = self.text().encode("utf-8")
+            self.encoded[output_format] = data
+        return data
+
+    def text(self):
+        text = self._text
+        if text is None:
+            if self.points is None:
+                sensor_info = f"\nSensor: {self.sensor_id}" if self.sensor_id is not None else ""
+                text = f"{sensor_info}\n{format_timestamp(self.timestamp, self.clock_offset)} data nothing"
+            else:
+                text = "\n".join([f"Theta: {theta:.2f}, Distance: {dist}" for theta, dist in self.points]) + "\n"
+                if self.sensor_id is not None:
+                    text = f"Sensor: {self.sensor_id}\n{text}"
+            self._text = text
+        return text
+
+    def __str__(self):
+        return self.text()
+
+    def _encode_ndjson(self):
+        points = self.points or []
+        record = {
+            "timestamp": self.timestamp,
+            "sensor": self.sensor_id,
+            "valid": self.points is not None,
+            "theta": [round(theta, 2) for theta, _ in points],
+            "dist": [dist for _, dist in points],
+        }
+        return (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+
+    def _encode_binary(self):
+        points = self.points or []
+        sensor = (self.sensor_id or "").encode("utf-8")
+        theta_array = array.array("f", [theta for theta, _ in points])
+        dist_array = array.array("H", [dist for _, dist in points])
+        if sys.byteorder == "big":
+            theta_array.byteswap()
+            dist_array.byteswap()
+        header = MONITOR_BINARY_HEADER.pack(MONITOR_BINARY_MAGIC, 1, int(self.points is not None),
+                                            len(points), self.timestamp, len(sensor))
+        return header + sensor + theta_array.tobytes() + dist_array.tobytes()
+
+
+MONITOR_QUEUE_SIZE = 32            # ビューアごとに保持するメッセージの最大数
+POLICY_DROP_OLDEST = "drop_oldest"  # 溢れたら一番古いメッセージを捨てる
+POLICY_DISCONNECT = "disconnect"    # 溢れたらビューアを切断する
+
+
+class MonitorClientHandler:
+    """
+    One monitoring viewer: a bounded ring buffer drained by a sender thread.
+
+    A viewer that cannot keep up either loses its oldest messages
+    (POLICY_DROP_OLDEST) or is disconnected (POLICY_DISCONNECT), so a
+    stalled viewer never grows server memory.
+    """
+    def __init__(self, client_socket, monitor_manager, max_queue=MONITOR_QUEUE_SIZE, policy=POLICY_DROP_OLDEST,
+                 negotiate=False):
+        self.client_socket = client_socket
+        self.peer = f"{client_socket.getpeername()}"
+        self.negotiate = negotiate
+        self.format = None if negotiate else FORMAT_TEXT  # 形式が決まるまでメッセージは送らない
+        self.message_queue = collections.deque()
+        self.max_queue = max_queue
+        self.policy = policy
+        self.condition = threading.Condition()
+        self.running = True
+        self.sent_count = 0
+        self.dropped_count = 0  # 溢れて捨てたメッセージの数
+        self.thread = threading.Thread(target=self._send_messages, args=(monitor_manager,), daemon=True)
+
+    def start(self):
+        """
+        Start the sender thread; MonitorManager.add_client calls it once the handler is in its client list.
+        """
+        self.thread.start()
+
+    def _send_messages(self, monitor_manager):
+        logger.info(f"Send to {self.client_socket} thread is starting")
+        if self.negotiate and not self._negotiate_format():
+            monitor_manager.delete_client(self)
+            self.client_socket.close()
+            return
+
+        while True:
+            with self.condition:
+                while self.running and not self.message_queue:
+                    self.condition.wait()  # キューにメッセージが入るまで待つ
+                if not self.running:
+                    break
+                message = self.message_queue.popleft()
+            try:
+                self.client_socket.sendall(message)
+                self.sent_count += 1
+            except (socket.error, BrokenPipeError, ConnectionResetError) as e:
+                logger.exception(f"thread stop:{e}")
+                break
+
+        monitor_manager.delete_client(self)
+        logger.info(f"Viewer {self.peer} closed (sent: {self.sent_count}, dropped: {self.dropped_count})")
+        self.client_socket.close()
+
+    def _negotiate_format(self):
+        """接続直後に送られてきた形式の指定を読み取る（なければテキスト）"""
+        try:
+            self.client_socket.settimeout(FORMAT_REQUEST_WAIT)
+            try:
+                request = self.client_socket.recv(1024)
+            except socket.timeout:
+                request = b""
+            self.client_socket.settimeout(None)
+            output_format, is_http = parse_format_request(request)
+            if is_http:
+                self.client_socket.sendall(http_response_header(output_format))
+        except OSError as e:
+            logger.warning(f"Viewer {self.peer} closed before choosing a format: {e}")
+            return False
+        logger.info(f"Viewer {self.peer} selected format: {output_format}")
+        self.format = output_format
+        return True
+
+    def send(self, message):
+        """
+        Queue an already encoded message (bytes shared by all viewers) without blocking.
+        """
+        with self.condition:
+            if not self.running:
+                return
+            if len(self.message_queue) >= self.max_queue:
+                self.dropped_count += 1
+                if self.policy == POLICY_DISCONNECT:
+                    logger.warning(f"Viewer {self.peer} is too slow, disconnecting...")
+                    self.running = False
+                    self.condition.notify()
+                    try:
+                        self.client_socket.shutdown(socket.SHUT_RDWR)  # sendall で止まっている送信スレッドを起こす
+                    except OSError:
+                        pass
+                    return
+                self.message_queue.popleft()
+            self.message_queue.append(message)
+            self.condition.notify()
+
+    def queue_depth(self):
+        return len(self.message_queue)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
+
+# 監視クライアントの管理
+class MonitorManager:
+    """
+    Fan-out of monitoring messages to the viewers of ports 8001/8002.
+
+    Each message is encoded once and the same bytes are queued for every
+    viewer.  The client lists are immutable tuples replaced under a lock,
+    so broadcasting iterates a snapshot while viewers come and go.
+    """
+    def __init__(self, max_queue=MONITOR_QUEUE_SIZE, policy=POLICY_DROP_OLDEST):
+        self.clients_8001 = ()  # 8001のクライアント
+        self.clients_8002 = ()  # 8002のクライアント
+        self.max_queue = max_queue
+        self.policy = policy
+        self.lock = threading.Lock()
+
+    def add_client(self, client_socket, port):
+        handler = MonitorClientHandler(client_socket, self, self.max_queue, self.policy, negotiate=(port == 8001))
+        with self.lock:
+            if port == 8001:
+                self.clients_8001 += (handler,)
+            elif port == 8002:
+                self.clients_8002 += (handler,)
+        # 一覧に入れてから送信スレッドを始める（形式の指定がすぐ失敗しても delete_client で確実に外れる）
+        handler.start()
+        return handler
+
+    def delete_client(self, handler):
+        with self.lock:
+            self.clients_8001 = tuple(client for client in self.clients_8001 if client is not handler)
+            self.clients_8002 = tuple(client for client in self.clients_8002 if client is not handler)
+
+    def broadcast_8001(self, message):
+        """8001番ポートのクライアントに RotationMessage を各自の形式で送信"""
+        for client in self.clients_8001:
+            if client.format is not None:
+                client.send(message.encode(client.format))  # 形式ごとに1回だけ変換して共有する
+
+    def broadcast_8002(self, message):
+        """8002番ポートのクライアントにメッセージを送信"""
+        data = message.encode("utf-8")
+        for client in self.clients_8002:
+            client.send(data)
+
+    def dropped_counts(self):
+        """ビューアごとの捨てたメッセージの数"""
+        return {client.peer: client.dropped_count for client in self.clients_8001 + self.clients_8002}
+
+    def viewers(self):
+        """(ポート, ビューア) のリスト"""
+        return [("8001", client) for client in self.clients_8001] + [("8002", client) for client in self.clients_8002]
+
+    def close(self):
+        """すべてのビューアを切断する（LidarServer.close）"""
+        for _, client in self.viewers():
+            try:
+                client.client_socket.shutdown(socket.SHUT_RDWR)  # sendall で止まっている送信スレッドを起こす
+            except OSError:
+                pass
+            client.stop()
+
+
+def logging_setup(log_dir="./logs", async_logging=False, point_sample_rate=1.0, raw_data_path=None):
+    """
+    Configure the logger: the rotations (DEBUG) to lidar_datas/lidar_data.log, INFO and up to error_logs/error.log.
+
+    The options are those of logging_util.setup_logging().
+    """
+    setup_logging(os.path.join(log_dir, "lidar_datas", "lidar_data.log"), logging.INFO,
+                  os.path.join(log_dir, "error_logs", "error.log"), logging.INFO,
+                  async_logging, point_sample_rate, raw_data_path)
+    logger.info("Logger setuped")
+
+
+# 🔹 **受信した周の保存**: 追記専用のセグメントファイル + 時刻→オフセットの索引
+STORE_RECORD_MAGIC = b"LS"
+STORE_VERSION = 1
+# magic, バージョン, flags, 点数, 一周の開始時刻(μs), センサーIDの長さ, 予備
+# （この後にセンサーID（4バイト境界まで詰める）, int32 角度[n](0.01°), int32 距離[n]）
+STORE_RECORD_HEADER = struct.Struct("<2sBBIQH2x")
+STORE_INDEX_ENTRY = struct.Struct("<QQ")  # 一周の開始時刻(μs), セグメント内のオフセット
+STORE_SEGMENT_BYTES = 1024*1024*64
+StoredRotation = collections.namedtuple("StoredRotation", "timestamp sensor_id theta dist")
+
+
+def store_segment_paths(store_dir):
+    """セグメントファイル（rotations-000001.seg ...）を番号順に返す"""
+    names = sorted(name for name in os.listdir(store_dir)
+                   if name.startswith("rotations-") and name.endswith(".seg"))
+    return [os.path.join(store_dir, name) for name in names]
+
+
+class RotationStore:
+    """
+    Append every accepted rotation to segmented binary files.
+
+    Each segment `rotations-NNNNNN.seg` has a sidecar `.idx` of
+    (timestamp, offset) entries.  Records are queued without blocking and
+    written by a dedicated thread; a new segment is started when
+    `segment_bytes` is reached and, with `max_segments`, the oldest ones are
+    deleted.  A restarted server always begins a new segment.
+    """
+    def __init__(self, store_dir, segment_bytes=STORE_SEGMENT_BYTES, max_segments=None, max_queue=256):
+        self.store_dir = store_dir
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.queue = queue.Queue(max_queue)
+        self.dropped_count = 0
+        os.makedirs(store_dir, exist_ok=True)
+        segments = store_segment_paths(store_dir)
+        self.segment_number = int(os.path.basename(segments[-1])[10:16]) if segments else 0
+        self.segment = None
+        self.index = None
+        self._open_segment()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def append(self, timestamp, sensor_id, points):
+        """`points` は (theta[°], dist[mm]) のリスト（変換は書き込みスレッドで行う）"""
+        try:
+            self.queue.put_nowait((timestamp, sensor_id, points))
+        except queue.Full:
+            self.dropped_count += 1
+
+    def _open_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.index.close()
+        self.segment_number += 1
+        path = os.path.join(self.store_dir, f"rotations-{self.segment_number:06d}")
+        self.segment = open(path + ".seg", "wb")
+        self.index = open(path + ".idx", "wb")
+        if self.max_segments:
+            for old_path in store_segment_paths(self.store_dir)[:-self.max_segments]:
+                os.remove(old_path)
+                if os.path.exists(old_path[:-4] + ".idx"):
+                    os.remove(old_path[:-4] + ".idx")
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for item in batch:
+                if item is None:  # stop() から
+                    running = False
+                    continue
+                self._write(*item)
+            # 索引が書き込まれていないデータを指さないように，セグメントを先に書き出す
+            self.segment.flush()
+            self.index.flush()
+
+    def _write(self, timestamp, sensor_id, points):
+        sensor_bytes = (sensor_id or "").encode("utf-8")
+        theta_array = array.array("i", [round(theta * 100) for theta, _ in points])
+        dist_array = array.array("i", [dist for _, dist in points])
+        if sys.byteorder == "big":
+            theta_array.byteswap()
+            dist_array.byteswap()
+        record = b"".join([
+            STORE_RECORD_HEADER.pack(STORE_RECORD_MAGIC, STORE_VERSION, 0, len(points), timestamp, len(sensor_bytes)),
+            sensor_bytes,
+            bytes(-len(sensor_bytes) % 4),  # 配列を4バイト境界に揃える
+            theta_array.tobytes(),
+            dist_array.tobytes(),
+        ])
+
+        offset = self.segment.tell()
+        if offset and offset + len(record) > self.segment_bytes:
+            self._open_segment()
+            offset = 0
+        self.segment.write(record)
+        self.index.write(STORE_INDEX_ENTRY.pack(timestamp, offset))
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.segment.close()
+        self.index.close()
+
+
+class RotationStoreReader:
+    """
+    Random access by time to the segments written by RotationStore.
+
+    Segments are memory-mapped and looked up through their index files, so a
+    time range is found without reading the records before it.  Entries
+    beyond the end of a segment that is still being written are ignored.
+    """
+    def __init__(self, store_dir):
+        self.segments = []  # (mmap, [timestamp...], [offset...])
+        for path in store_segment_paths(store_dir):
+            size = os.path.getsize(path)
+            if size == 0:
+                continue
+            with open(path, "rb") as f:
+                segment_map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            with open(path[:-4] + ".idx", "rb") as f:
+                index_data = f.read()
+            index_data = index_data[:len(index_data) - len(index_data) % STORE_INDEX_ENTRY.size]
+            entries = sorted(entry for entry in STORE_INDEX_ENTRY.iter_unpack(index_data)
+                             if entry[1] + STORE_RECORD_HEADER.size <= size)
+            self.segments.append((segment_map, [entry[0] for entry in entries], [entry[1] for entry in entries]))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return sum(len(timestamps) for _, timestamps, _ in self.segments)
+
+    def time_range(self):
+        """保存されている最初と最後の時刻（空なら None）"""
+        timestamps = [timestamps for _, timestamps, _ in self.segments if timestamps]
+        if not timestamps:
+            return None
+        return min(t[0] for t in timestamps), max(t[-1] for t in timestamps)
+
+    def read(self, start=None, end=None, sensor_id=None):
+        """
+        Yield StoredRotation for start <= timestamp < end in time order.
+
+        `theta` (0.01°) and `dist` (mm) are int32 arrays; with NumPy they are
+        views of the mapped file without a copy.
+        """
+        streams = [self._read_segment(segment, start, end, sensor_id) for segment in self.segments]
+        return heapq.merge(*streams, key=lambda rotation: rotation.timestamp)
+
+    def _read_segment(self, segment, start, end, sensor_id):
+        segment_map, timestamps, offsets = segment
+        first = bisect.bisect_left(timestamps, start) if start is not None else 0
+        last = bisect.bisect_left(timestamps, end) if end is not None else len(timestamps)
+        for position in range(first, last):
+            rotation = self._read_record(segment_map, offsets[position])
+            if rotation is not None and (sensor_id is None or rotation.sensor_id == sensor_id):
+                yield rotation
+
+    def _read_record(self, segment_map, offset):
+        magic, version, _, count, timestamp, sensor_length = STORE_RECORD_HEADER.unpack_from(segment_map, offset)
+        if magic != STORE_RECORD_MAGIC or version != STORE_VERSION:
+            raise ValueError(f"Invalid rotation record at offset {offset}")
+        position = offset + STORE_RECORD_HEADER.size
+        sensor_id = segment_map[position:position + sensor_length].decode("utf-8")
+        position += sensor_length + (-sensor_length % 4)
+        if position + count * 8 > len(segment_map):
+            return None  # 書き込み途中の周
+        if np is not None:
+            theta = np.frombuffer(segment_map, dtype="<i4", count=count, offset=position)
+            dist = np.frombuffer(segment_map, dtype="<i4", count=count, offset=position + count * 4)
+        else:
+            theta = array.array("i", segment_map[position:position + count * 4])
+            dist = array.array("i", segment_map[position + count * 4:position + count * 8])
+            if sys.byteorder == "big":
+                theta.byteswap()
+                dist.byteswap()
+        return StoredRotation(timestamp, sensor_id, theta, dist)
+
+    def close(self):
+        for segment_map, _, _ in self.segments:
+            try:
+                segment_map.close()
+            except BufferError:
+                pass  # まだ使われている NumPy 配列があれば，それが解放された時に閉じられる
+        self.segments = []
+
+
+
+
+# 🔹 **スキャンのキャッシュ**: センサーごとに最新の N 周を角度ビンごとの距離で保持し，問い合わせ（/scan など）にメモリから答える
+SCAN_CACHE_BINS = 720        # 0.5°ごとの角度ビン
+SCAN_CACHE_ROTATIONS = 10    # センサーごとに保持する周の数
+GRID_SIZE = 200              # 占有グリッドの一辺のセル数（センサーが中心）
+GRID_RESOLUTION = 50         # 1セルの大きさ [mm]（200 x 50mm = 10m 四方）
+GRID_DECAY_ROTATIONS = 20    # この周数の間に点がなかったセルは空きに戻す
+GRID_MAX_HITS = 255
+
+
+def sector_bins(start_deg, end_deg, bins=SCAN_CACHE_BINS):
+    """
+    Bin ranges [(first, last + 1), ...] covering the sector from `start_deg` to `end_deg` (counterclockwise, may wrap).
+    """
+    if end_deg - start_deg >= 360.0:
+        return [(0, bins)]
+    width = 360.0 / bins
+    start = start_deg % 360.0
+    end = end_deg % 360.0
+    first = int(start // width)
+    last = math.ceil(end / width) - 1  # end を含むビン（ビンの境界ならその手前）
+    if start <= end:
+        return [(first, max(first, last) + 1)]
+    if last < 0:
+        return [(first, bins)]
+    return [(first, bins), (0, last + 1)]  # 0° をまたぐ
+
+
+class SensorScanCache:
+    """
+    The latest `rotations` rotations of one sensor in fixed angle bins.
+
+    Distances live in one preallocated ring of int32 (0 = no point in the
+    bin, otherwise the nearest one).  The row being written is never the
+    published `latest` one, so queries from another thread need no lock.
+    With `grid` an occupancy grid in the sensor frame is updated from every
+    rotation: a cell counts the consecutive rotations it was hit in and is
+    free again after GRID_DECAY_ROTATIONS without a hit.
+    """
+    def __init__(self, rotations=SCAN_CACHE_ROTATIONS, bins=SCAN_CACHE_BINS, grid=False):
+        self.bins = bins
+        self.rotations = max(2, rotations)  # 書き込み中の行と公開中の行
+        self.scale = bins / 360.0
+        self.count = 0    # 受け取った周の数
+        self.latest = -1  # 最新の周の行
+        self.timestamps = [0] * self.rotations
+        angles = [math.radians((index + 0.5) * 360.0 / bins) for index in range(bins)]
+        if np is not None:
+            self.dist = np.zeros((self.rotations, bins), dtype=np.int32)
+            self.cos = np.cos(np.array(angles))
+            self.sin = np.sin(np.array(angles))
+        else:
+            self.dist = [array.array("i", bytes(4 * bins)) for _ in range(self.rotations)]
+            self.cos = [math.cos(angle) for angle in angles]
+            self.sin = [math.sin(angle) for angle in angles]
+        self.grid_lock = threading.Lock() if grid else None
+        self.grid_hits = array.array("B", bytes(GRID_SIZE * GRID_SIZE)) if grid else None
+        self.grid_last = array.array("I", bytes(4 * GRID_SIZE * GRID_SIZE)) if grid else None
+        if grid and np is not None:
+            self.grid_hits = np.zeros(GRID_SIZE * GRID_SIZE, dtype=np.uint8)
+            self.grid_last = np.zeros(GRID_SIZE * GRID_SIZE, dtype=np.uint32)
+
+    def update(self, timestamp, points):
+        """Bin one filtered rotation [(theta, dist), ...] and publish it as the latest."""
+        row_index = (self.latest + 1) % self.rotations
+        if np is not None:
+            row = self._bin_numpy(points, self.dist[row_index])
+        else:
+            row = self._bin_python(points, self.dist[row_index])
+        self.timestamps[row_index] = timestamp
+        self.count += 1
+        if self.grid_hits is not None:
+            with self.grid_lock:
+                self._update_grid(row)
+        self.latest = row_index
+
+    def _bin_python(self, points, row):
+        nearest = [0] * self.bins
+        scale = self.scale
+        bins = self.bins
+        for theta, dist in points:
+            if dist > 0:
+                index = int(theta * scale) % bins
+                if not nearest[index] or dist < nearest[index]:
+                    nearest[index] = int(dist)
+        row[:] = array.array("i", nearest)
+        return row
+
+    def _bin_numpy(self, points, row):
+        values = np.fromiter(itertools.chain.from_iterable(points), dtype=np.float64, count=2 * len(points))
+        theta = values[0::2]
+        dist = values[1::2].astype(np.int64)
+        valid = dist > 0
+        index = (theta[valid] * self.scale).astype(np.int64) % self.bins
+        nearest = np.full(self.bins, np.iinfo(np.int32).max, dtype=np.int64)
+        np.minimum.at(nearest, index, dist[valid])
+        nearest[nearest == np.iinfo(np.int32).max] = 0
+        row[:] = nearest
+        return row
+
+    def _update_grid(self, row):
+        generation = self.count
+        half = GRID_SIZE // 2
+        if np is not None:
+            index = np.flatnonzero(row)
+            dist = row[index].astype(np.float64)
+            x = np.floor(dist * self.cos[index] / GRID_RESOLUTION).astype(np.int64) + half
+            y = np.floor(dist * self.sin[index] / GRID_RESOLUTION).astype(np.int64) + half
+            inside = (x >= 0) & (x < GRID_SIZE) & (y >= 0) & (y < GRID_SIZE)
+            cells = np.unique(y[inside] * GRID_SIZE + x[inside])
+            fresh = generation - self.grid_last[cells] <= GRID_DECAY_ROTATIONS
+            hits = self.grid_hits[cells].astype(np.int64)
+            self.grid_hits[cells] = np.where(fresh, np.minimum(hits + 1, GRID_MAX_HITS), 1)
+            self.grid_last[cells] = generation
+            return
+        cells = set()
+        for index, dist in enumerate(row):
+            if dist:
+                x = math.floor(dist * self.cos[index] / GRID_RESOLUTION) + half
+                y = math.floor(dist * self.sin[index] / GRID_RESOLUTION) + half
+                if 0 <= x < GRID_SIZE and 0 <= y < GRID_SIZE:
+                    cells.add(y * GRID_SIZE + x)
+        hits, last = self.grid_hits, self.grid_last
+        for cell in cells:
+            hits[cell] = min(hits[cell] + 1, GRID_MAX_HITS) if generation - last[cell] <= GRID_DECAY_ROTATIONS else 1
+            last[cell] = generation
+
+    def latest_scan(self):
+        """(timestamp, distances per bin as a list) of the latest rotation, or None."""
+        latest = self.latest
+        if latest < 0:
+            return None
+        return self.timestamps[latest], self.dist[latest].tolist()
+
+    def sector_min(self, start_deg, end_deg, rotations=1):
+        """
+        Nearest point (dist, theta of the bin centre, timestamp) between `start_deg` and `end_deg`
+        in the latest `rotations` rotations, or None.
+        """
+        latest = self.latest
+        if latest < 0:
+            return None
+        best = None
+        ranges = sector_bins(start_deg, end_deg, self.bins)
+        for age in range(min(rotations, self.count, self.rotations - 1)):
+            row_index = (latest - age) % self.rotations
+            row = self.dist[row_index]
+            for first, last in ranges:
+                if np is not None:
+                    part = row[first:last]
+                    nonzero = np.flatnonzero(part)
+                    if not len(nonzero):
+                        continue
+                    offset = int(nonzero[np.argmin(part[nonzero])])
+                    dist = int(part[offset])
+                else:
+                    part = row[first:last]
+                    candidates = [(dist, offset) for offset, dist in enumerate(part) if dist]
+                    if not candidates:
+                        continue
+                    dist, offset = min(candidates)
+                if best is None or dist < best[0]:
+                    best = (dist, (first + offset + 0.5) * 360.0 / self.bins, self.timestamps[row_index])
+        return best
+
+    def grid_snapshot(self):
+        """Occupancy grid as bytes (GRID_SIZE rows of GRID_SIZE uint8 hit counts, 0 = free), or None."""
+        if self.grid_hits is None:
+            return None
+        with self.grid_lock:
+            generation = self.count
+            if np is not None:
+                return np.where(generation - self.grid_last <= GRID_DECAY_ROTATIONS, self.grid_hits, 0) \
+                    .astype(np.uint8).tobytes()
+            return bytes(hits if generation - last <= GRID_DECAY_ROTATIONS else 0
+                         for hits, last in zip(self.grid_hits, self.grid_last))
+
+
+class ScanCache:
+    """
+    SensorScanCache per sensor; a lock is taken only when a sensor is seen for the first time.
+    """
+    def __init__(self, rotations=SCAN_CACHE_ROTATIONS, grid=False):
+        self.rotations = rotations
+        self.grid = grid
+        self.sensors = {}
+        self.lock = threading.Lock()
+
+    def update(self, sensor_id, timestamp, points):
+        key = sensor_id if sensor_id is not None else "default"
+        sensor_cache = self.sensors.get(key)
+        if sensor_cache is None:
+            with self.lock:
+                sensor_cache = self.sensors.setdefault(key, SensorScanCache(self.rotations, grid=self.grid))
+        sensor_cache.update(timestamp, points)
+
+    def get(self, sensor_id=None):
+        """The cache of `sensor_id`; without one, the cache of the only sensor (None if there are several)."""
+        if sensor_id is None:
+            sensors = list(self.sensors.values())
+            return sensors[0] if len(sensors) == 1 else None
+        return self.sensors.get(sensor_id)
+
+
+
+
+# 🔹 **メトリクス**（Prometheus のテキスト形式で /metrics に出力）
+METRICS_PORT = 8003
+DELAY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)  # 秒
+DECODE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05)  # 秒
+FILTER_REASONS = ("theta_range", "dist_range", "quality", "theta_jump", "median_outlier")  # filter_invalid_data で削除した理由
+LATENCY_STAGES = ("capture", "encode", "network", "decode")  # 遅延の内訳（ClockSync.stages）
+
+# 🔹 **時刻合わせ**（TCP の接続ごとに TIME_PING を送り，TIME_PONG から NTP と同じ式でクライアントの時計のずれを求める）
+TIME_SYNC_INTERVAL = 1.0              # TIME_PING を送る間隔（秒）
+TIME_SYNC_SAMPLES = 64                # 推定に使う直近の交換の数
+TIME_SYNC_RTT_WEIGHT_US = 300         # 交換の重み 1 / (RTT - 最小の RTT + これ)^2（遅れた交換ほど軽く）
+TIME_SYNC_MIN_SPAN_US = 10 * 1000000  # ドリフトを推定するのに必要な交換の時間の幅
+TIME_SYNC_MAX_DRIFT = 500e-6          # 推定するドリフトの上限（NTP と同じ 500ppm）
+TIME_SYNC_MAX_UNANSWERED = 3          # 応答のない TIME_PING がこれだけ溜まったら送るのをやめる（古いクライアント）
+TIME_SYNC_PENDING = 64                # 転送を待つ周の処理時刻を保持する数
+FEEDBACK_INTERVAL = 0.5               # FRAME_TYPE_FEEDBACK を送る間隔（秒）
+
+
+class Histogram:
+    """Fixed-bucket histogram; `observe` is a bisect and three additions."""
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 最後は +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class ClockSync:
+    """
+    Offset and drift of one sensor's clock, from TIME_PING / TIME_PONG exchanges.
+
+    For an exchange with server send / receive times t1, t4 and client
+    receive / send times t2, t3, the offset (client - server) is
+    ((t2 - t1) + (t3 - t4)) / 2 and the round trip (t4 - t1) - (t3 - t2).
+    An exchange whose round trip is close to the smallest one has a nearly
+    symmetric delay, so the recent exchanges are weighted by their extra
+    round trip; once they span TIME_SYNC_MIN_SPAN_US a weighted least-squares
+    line through them also gives the drift.  It also keeps the FLAG_TIMING
+    of received frames until the rotation is forwarded.
+    """
+    def __init__(self):
+        self.samples = collections.deque(maxlen=TIME_SYNC_SAMPLES)  # (サーバーの時刻, オフセット, RTT) [μs]
+        self.offset = None          # reference_time でのオフセット [μs]
+        self.reference_time = 0.0
+        self.drift = 0.0            # オフセットの変化率（μs / μs）
+        self.rtt = None
+        self.pending = collections.OrderedDict()  # 一周の開始時刻 -> (揃った, 圧縮した [μs], 受信した時刻 [s])
+
+    def add_sample(self, t1, t2, t3, t4):
+        rtt = (t4 - t1) - (t3 - t2)
+        if rtt < 0:
+            return  # どちらかの時計が交換の途中で飛んだ
+        self.samples.append(((t1 + t4) / 2, ((t2 - t1) + (t3 - t4)) / 2, rtt))
+        self.rtt = min_rtt = min(sample[2] for sample in self.samples)
+        weights = [1.0 / (sample[2] - min_rtt + TIME_SYNC_RTT_WEIGHT_US) ** 2 for sample in self.samples]
+        total = sum(weights)
+        mean_time = sum(weight * sample[0] for weight, sample in zip(weights, self.samples)) / total
+        mean_offset = sum(weight * sample[1] for weight, sample in zip(weights, self.samples)) / total
+        if self.samples[-1][0] - self.samples[0][0] >= TIME_SYNC_MIN_SPAN_US:
+            variance = sum(weight * (sample[0] - mean_time) ** 2 for weight, sample in zip(weights, self.samples))
+            drift = sum(weight * (sample[0] - mean_time) * (sample[1] - mean_offset)
+                        for weight, sample in zip(weights, self.samples)) / variance
+            self.drift = min(max(drift, -TIME_SYNC_MAX_DRIFT), TIME_SYNC_MAX_DRIFT)
+        self.reference_time, self.offset = mean_time, mean_offset
+
+    def offset_at(self, server_time_us):
+        """Estimated client - server offset [us] at a server time; 0 until the first exchange."""
+        if self.offset is None:
+            return 0.0
+        return self.offset + self.drift * (server_time_us - self.reference_time)
+
+    def frame_received(self, timestamp, captured_us, encoded_us, received):
+        while len(self.pending) >= TIME_SYNC_PENDING:
+            self.pending.popitem(last=False)  # 転送されなかった周
+        self.pending[timestamp] = (captured_us, encoded_us, received)
+
+    def stages(self, timestamp, now):
+        """
+        Seconds of each LATENCY_STAGES for a rotation forwarded at `now`, or None without FLAG_TIMING.
+
+        capture: start of the rotation until it was complete, encode: until
+        it was encoded, network: until the server received it (with the
+        client's send queue), decode: until it was forwarded (decode, filter
+        and queueing on the server).  Together they are the corrected delay.
+        """
+        while self.pending and next(iter(self.pending)) < timestamp:
+            self.pending.popitem(last=False)
+        timing = self.pending.pop(timestamp, None)
+        if timing is None:
+            return None
+        captured_us, encoded_us, received = timing
+        sent = (timestamp + encoded_us - self.offset_at(received * 1e6)) / 1e6  # サーバーの時計での送信時刻
+        return captured_us / 1e6, (encoded_us - captured_us) / 1e6, received - sent, now - received
+
+
+class SensorMetrics:
+    """
+    Counters and histograms of one sensor.
+
+    Only the thread (or task) that handles the sensor updates them, so the
+    hot path needs no lock; the /metrics handler just reads the values.
+    """
+    def __init__(self):
+        self.rotations_received = 0
+        self.rotations_dropped = collections.Counter()  # 理由 -> 周の数
+        self.points_filtered = dict.fromkeys(FILTER_REASONS, 0)
+        self.bytes_in = 0
+        self.decode_seconds = Histogram(DECODE_BUCKETS)
+        self.delay_seconds = Histogram(DELAY_BUCKETS)
+        self.stage_seconds = {stage: Histogram(DELAY_BUCKETS) for stage in LATENCY_STAGES}
+        self.clock = ClockSync()
+        self.lag_seconds = 0.0  # 最新の周の network + decode（FRAME_TYPE_FEEDBACK で返す）
+        self.backlog = 0        # DecodePool で解凍を待っているフレームの数
+
+
+class MetricsRegistry:
+    """
+    Per-sensor metrics and the text exposition for /metrics.
+
+    A lock is taken only when a sensor is seen for the first time.
+    """
+    def __init__(self):
+        self.sensors = {}
+        self.lock = threading.Lock()
+        self.manager = None  # ビューアのキューの深さを出力する MonitorManager
+
+    def sensor(self, sensor_id):
+        key = sensor_id if sensor_id is not None else "default"
+        sensor_metrics = self.sensors.get(key)
+        if sensor_metrics is None:
+            with self.lock:
+                sensor_metrics = self.sensors.setdefault(key, SensorMetrics())
+        return sensor_metrics
+
+    def render(self):
+        lines = []
+        sensors = sorted(self.sensors.items())
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{escape_label(label)}"' for key, label in labels)
+                lines.append(f"{name}{{{label_text}}} {value}")
+
+        def histogram(name, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, hist in samples:
+                label_text = ",".join(f'{key}="{escape_label(label)}"' for key, label in labels)
+                cumulative = 0
+                for bound, count in zip(hist.bounds + ("+Inf",), list(hist.counts)):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{{label_text}}} {hist.sum}')
+                lines.append(f'{name}_count{{{label_text}}} {hist.count}')
+
+        metric("lidar_rotations_received_total", "counter", "Rotations decoded.",
+               [((("sensor", sensor_id),), m.rotations_received) for sensor_id, m in sensors])
+        metric("lidar_rotations_dropped_total", "counter", "Rotations not forwarded to the viewers.",
+               [((("sensor", sensor_id), ("reason", reason)), count)
+                for sensor_id, m in sensors for reason, count in sorted(m.rotations_dropped.items())])
+        metric("lidar_points_filtered_total", "counter", "Points removed by filter_invalid_data.",
+               [((("sensor", sensor_id), ("reason", reason)), count)
+                for sensor_id, m in sensors for reason, count in m.points_filtered.items()])
+        metric("lidar_bytes_received_total", "counter", "Bytes received from the sensor.",
+               [((("sensor", sensor_id),), m.bytes_in) for sensor_id, m in sensors])
+        histogram("lidar_decode_seconds", "Time to decode one frame.",
+                  [((("sensor", sensor_id),), m.decode_seconds) for sensor_id, m in sensors])
+        histogram("lidar_delay_seconds", "Delay from the start of the rotation to its processing (clock corrected).",
+                  [((("sensor", sensor_id),), m.delay_seconds) for sensor_id, m in sensors])
+        histogram("lidar_stage_seconds", "Delay per stage, for frames with FLAG_TIMING.",
+                  [((("sensor", sensor_id), ("stage", stage)), m.stage_seconds[stage])
+                   for sensor_id, m in sensors for stage in LATENCY_STAGES])
+        synced = [(sensor_id, m.clock) for sensor_id, m in sensors if m.clock.offset is not None]
+        metric("lidar_clock_offset_seconds", "gauge", "Estimated offset of the sensor's clock (sensor - server).",
+               [((("sensor", sensor_id),), clock.offset_at(time.time() * 1e6) / 1e6) for sensor_id, clock in synced])
+        metric("lidar_clock_drift_ppm", "gauge", "Estimated drift of the sensor's clock.",
+               [((("sensor", sensor_id),), clock.drift * 1e6) for sensor_id, clock in synced])
+        metric("lidar_clock_rtt_seconds", "gauge", "Smallest round trip of the recent time-sync exchanges.",
+               [((("sensor", sensor_id),), clock.rtt / 1e6) for sensor_id, clock in synced])
+        metric("lidar_lag_seconds", "gauge", "Network + decode delay of the latest rotation (sent back as FEEDBACK).",
+               [((("sensor", sensor_id),), m.lag_seconds) for sensor_id, m in sensors])
+        metric("lidar_decode_backlog", "gauge", "Frames waiting in the DecodePool.",
+               [((("sensor", sensor_id),), m.backlog) for sensor_id, m in sensors])
+
+        if self.manager is not None:
+            viewers = self.manager.viewers()
+            metric("lidar_monitor_queue_depth", "gauge", "Messages waiting to be sent to a viewer.",
+                   [((("port", role), ("viewer", client.peer)), client.queue_depth()) for role, client in viewers])
+            metric("lidar_monitor_dropped_total", "counter", "Messages dropped for a slow viewer.",
+                   [((("port", role), ("viewer", client.peer)), client.dropped_count) for role, client in viewers])
+        return "\n".join(lines) + "\n"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+DISPLAY_TIMEZONE = datetime.timezone(datetime.timedelta(hours=9), "JST")  # 表示する時刻は日本時間
+
+
+def format_timestamp(timestamp_us, clock_offset_us=0.0):
+    """
+    クライアントから受信したマイクロ秒単位のUNIXタイムスタンプを
+    'HH:MM:SS.sss 遅延: X.XXX秒' の形式に変換する
+
+    clock_offset_us はクライアントの時計のずれ（ClockSync.offset_at）で，サーバーの時計に直してから遅延を求める
+    """
+    timestamp_us -= clock_offset_us
+    japan_time = datetime.datetime.fromtimestamp(timestamp_us / 1e6, DISPLAY_TIMEZONE)
+
+    now_us = int(time.time() * 1e6)  # 現在のタイムスタンプ（マイクロ秒単位）
+    delay_s = (now_us - timestamp_us) / 1e6  # 遅延（秒）．負の値は時計の補正の誤差なので隠さずに表示する
+
+    formatted_time = japan_time.strftime("%H:%M:%S.%f")[:-3]  # 'HH:MM:SS.sss'（ミリ秒単位まで）
+    return f"Time: {formatted_time} Delay: {delay_s:.3f}sec"
+
+
+class FrameParser:
+    """
+    Split the received byte stream into frames incrementally.
+
+    Each complete frame is decoded exactly once; bytes belonging to the
+    next (incomplete) frame are kept for the following `feed` call.
+    TIME_PONG frames and the FLAG_TIMING of rotations go to the sensor's
+    ClockSync; control_frames() gives the TIME_PING and FEEDBACK frames to
+    send back.
+    """
+    def __init__(self, sensor_metrics=None):
+        self.buffer = bytearray()
+        self.prediction_state = PredictionState()  # この接続（センサー）の参照する周
+        self.sensor_metrics = sensor_metrics
+        self.clock = sensor_metrics.clock if sensor_metrics is not None else ClockSync()
+        self.skipped_bytes = 0
+        self.checksummed = False  # CRC 付きのフレームを受け取ったら，以降 CRC のないフレームは壊れたものとみなす
+        self.timed = False        # FLAG_TIMING のフレームを送ってくるクライアントだけが TIME_PING に応答する
+        self.next_ping = 0.0      # 次に TIME_PING を送る時刻（time.monotonic）
+        self.next_feedback = 0.0
+        self.pings_sent = 0
+        self.pongs_received = 0
+
+    def control_frames(self, now):
+        """
+        The TIME_PING / FEEDBACK frames to send on this connection at `now` (time.monotonic); b"" if none is due.
+
+        They go only to a client that sends FLAG_TIMING frames: one that
+        never reads the connection would reset it on close, losing the
+        frames the server has not read yet.  After TIME_SYNC_MAX_UNANSWERED
+        unanswered pings no more pings are sent; FEEDBACK still is if the
+        client has answered a ping before (it reads the connection), so a
+        few lost TIME_PONGs do not stop it.
+        """
+        if not self.timed:
+            return b""
+        pinging = self.pings_sent - self.pongs_received < TIME_SYNC_MAX_UNANSWERED
+        if not pinging and not self.pongs_received:
+            return b""  # TIME_PING に一度も応答しないクライアント
+        frames = b""
+        if pinging and now >= self.next_ping:
+            self.next_ping = now + TIME_SYNC_INTERVAL
+            self.pings_sent += 1
+            frames += FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, FRAME_TYPE_TIME_PING, 0, 0, 0,
+                                        int(time.time() * 1e6))
+        if now >= self.next_feedback and self.sensor_metrics is not None:
+            self.next_feedback = now + FEEDBACK_INTERVAL
+            frames += FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, FRAME_TYPE_FEEDBACK, 0, FEEDBACK.size, 0,
+                                        int(time.time() * 1e6))
+            frames += FEEDBACK.pack(min(int(self.sensor_metrics.lag_seconds * 1e6), 0xFFFFFFFF),
+                                    min(self.sensor_metrics.backlog, 0xFFFF))
+        return frames
+
+    def split(self, data):
+        """
+        Split off the complete frames; a corrupt one is dropped and the stream resynchronised.
+
+        A header that cannot be right (magic, version, payload length for
+        its point count) or a FLAG_CRC frame whose CRC32 does not match is
+        skipped up to the next FRAME_MAGIC, so one bad frame costs only that
+        rotation instead of the connection.  Once a stream has sent FLAG_CRC
+        frames, a frame without it (a flipped flag bit) is not trusted either.
+        """
+        received = time.time()  # TIME_PONG と FLAG_TIMING の受信時刻
+        self.buffer.extend(data)
+        frames = []
+        offset = 0
+        header_size = FRAME_HEADER.size
+
+        while len(self.buffer) - offset >= header_size:
+            magic, version, frame_type, flags, payload_length, point_count, timestamp = \
+                FRAME_HEADER.unpack_from(self.buffer, offset)
+            if magic != FRAME_MAGIC or version != FRAME_VERSION or point_count > FRAME_MAX_POINTS or \
+                    payload_length > point_count * FRAME_MAX_POINT_BYTES + FRAME_MAX_EXTRA_BYTES:
+                offset = self._resync(offset, "corrupt",
+                                      f"invalid frame header (magic: {bytes(magic)!r}, version: {version}, "
+                                      f"payload: {payload_length} bytes for {point_count} points)")
+                continue
+
+            end = offset + header_size + payload_length
+            if len(self.buffer) < end:
+                break  # 残りは次の recv で届く
+
+            payload = bytes(self.buffer[offset + header_size:end])
+            if flags & FLAG_CRC:
+                if payload_length < CRC.size or CRC.unpack_from(payload, payload_length - CRC.size)[0] != \
+                        zlib.crc32(memoryview(payload)[:-CRC.size], zlib.crc32(self.buffer[offset:offset + header_size])):
+                    offset = self._resync(offset, "checksum", "CRC32 mismatch")
+                    continue
+                payload = payload[:-CRC.size]
+                self.checksummed = True
+            elif self.checksummed:
+                offset = self._resync(offset, "checksum", "frame without CRC32")
+                continue
+            if frame_type == FRAME_TYPE_TIME_PONG:
+                if len(payload) == TIME_PONG.size:
+                    ping_time, client_received = TIME_PONG.unpack(payload)
+                    self.clock.add_sample(ping_time, client_received, timestamp, received * 1e6)
+                    self.pongs_received += 1
+                offset = end
+                continue
+            try:
+                if flags & FLAG_TIMING:
+                    if len(payload) < TIMING.size:
+                        raise FrameError("Timing section is longer than the payload")
+                    captured_us, encoded_us = TIMING.unpack_from(payload, len(payload) - TIMING.size)
+                    payload = payload[:-TIMING.size]
+                    self.clock.frame_received(timestamp, captured_us, encoded_us, received)
+                    self.timed = True
+                payload, quality = split_quality(flags, point_count, payload)
+            except FrameError as e:
+                offset = self._resync(offset, "corrupt", str(e))
+                continue
+            frames.append(Frame(version, frame_type, flags, point_count, timestamp, payload, quality))
+            offset = end
+
+        if offset:
+            del self.buffer[:offset]  # 処理済みのフレームを削除し，余りを次に持ち越す
+        return frames
+
+    def _resync(self, offset, reason, message):
+        """Skip the bad frame at `offset` up to the next FRAME_MAGIC; returns the new offset."""
+        next_offset = self.buffer.find(FRAME_MAGIC, offset + 1)
+        if next_offset < 0:
+            next_offset = max(offset + 1, len(self.buffer) - 1)  # 最後の1バイトは次の magic の先頭かもしれない
+        self.skipped_bytes += next_offset - offset
+        logger.warning(f"Warning: {message}, skipped {next_offset - offset} bytes to the next frame")
+        if self.sensor_metrics is not None:
+            self.sensor_metrics.rotations_dropped[reason] += 1
+        return next_offset
+
+    def split_frame(self, data):
+        """Split one frame received as a unit (a datagram); an incomplete rest is discarded."""
+        self.buffer.clear()
+        try:
+            return self.split(data)
+        finally:
+            self.buffer.clear()
+
+    def feed_frame(self, data):
+        """Decode one frame received as a unit (a datagram), like feed()."""
+        self.buffer.clear()
+        try:
+            return self.feed(data)
+        finally:
+            self.buffer.clear()
+
+    def feed(self, data):
+        rotations = []
+        for frame in self.split(data):
+            if frame.frame_type != FRAME_TYPE_ROTATION:
+                continue
+            start = time.perf_counter()
+            try:
+                timestamp, decompressed_data = decode_frame(frame, self.prediction_state)
+            except (ValueError, IndexError, struct.error) as e:
+                # CRC がないフレームの中身が壊れていた場合（この周だけ捨てる）
+                logger.warning(f"Warning: Could not decode a frame ({e}), skipping...")
+                if self.sensor_metrics is not None:
+                    self.sensor_metrics.rotations_dropped["decode_error"] += 1
+                continue
+            if self.sensor_metrics is not None:
+                self.sensor_metrics.decode_seconds.observe(time.perf_counter() - start)
+                if decompressed_data is None:
+                    self.sensor_metrics.rotations_dropped["missing_reference"] += 1
+            if decompressed_data is not None:
+                rotations.append((timestamp, decompressed_data, frame.quality))
+        return rotations
+
+
+class LegacyStreamParser:
+    """
+    Compatibility mode for the headerless stream (payload + 8-byte timestamp).
+
+    The whole buffer is re-decoded on every `feed` until it succeeds, as before;
+    the format has no marker to resynchronise on, so a buffer that grows past
+    LEGACY_MAX_BUFFER without decoding is dropped as corrupt.
+    """
+    def __init__(self, sensor_metrics=None):
+        self.buffer = bytearray()
+        self.sensor_metrics = sensor_metrics
+
+    def control_frames(self, now):
+        return b""  # 旧形式のクライアントは受信しない
+
+    def feed(self, data):
+        self.buffer.extend(data)
+        start = time.perf_counter()
+        try:
+            rotation = decompress_data(self.buffer)
+        except ValueError:
+            if len(self.buffer) > LEGACY_MAX_BUFFER:
+                logger.warning(f"Warning: {len(self.buffer)} bytes could not be decoded, dropping them...")
+                if self.sensor_metrics is not None:
+                    self.sensor_metrics.rotations_dropped["corrupt"] += 1
+                self.buffer.clear()
+            return []
+        if self.sensor_metrics is not None:
+            self.sensor_metrics.decode_seconds.observe(time.perf_counter() - start)
+        self.buffer.clear()
+        return [rotation + (None,)]  # 旧形式には Q がない
+
+# 🔹 **フィルターの条件**（センサーの機種ごとのプロファイル）
+FilterRules = collections.namedtuple(
+    "FilterRules",
+    "theta_min theta_max dist_min dist_max max_jump min_quality median_window median_max_diff",
+    defaults=(0.0, 360.0, 0, 14000, 100.0, None, None, None))
+FilterRules.__doc__ = """
+Thresholds of filter_invalid_data.
+
+Angles in degrees, distances in mm.  `min_quality` needs frames with Q
+(FLAG_QUALITY); `median_window` / `median_max_diff` drop points whose
+distance differs from the median of their neighbours by more than that.
+None disables a rule.
+"""
+FILTER_PROFILES = {
+    "rplidar_c1": FilterRules(),                   # 従来の条件（0～360°, 0～14000mm, 100°のジャンプ）
+    "rplidar_a1": FilterRules(dist_max=12000),
+    "rplidar_s2": FilterRules(dist_max=30000),
+    "rplidar_c1_strict": FilterRules(min_quality=10, median_window=5, median_max_diff=1000),
+}
+DEFAULT_FILTER_PROFILE = "rplidar_c1"
+ROTATION_MIN_POINTS = 300  # フィルター後の点の数がこの範囲にない周はビューアに転送しない
+ROTATION_MAX_POINTS = 700
+# 🔹 これより点の少ない周は純Python版で判定する（配列への変換が判定より高くつく，bench_filter.py --points）。
+# NumPy版が速いのは中央値の条件がある場合と角度のジャンプが少ない周で，ジャンプの多い周は同じくらい。
+FILTER_NUMPY_MIN_POINTS = 400
+
+
+def filter_invalid_data(decompressed_data, reasons=None, rules=None, quality=None):
+    """
+    サーバー側でデータをフィルタリングして、異常な値を排除する
+
+    `rules` (FilterRules) の条件を順に適用する: 角度の範囲, 距離の範囲, Q, 角度のジャンプ
+    （直前に残した点との差）, 距離の中央値からの外れ値。NumPy がある場合は FILTER_NUMPY_MIN_POINTS 点以上の
+    周を配列でまとめて判定する。
+    `reasons` (dict) が渡された場合は削除した理由ごとの数を加算する（点ごとのログは出さない）。
+    """
+    if rules is None:
+        rules = FILTER_PROFILES[DEFAULT_FILTER_PROFILE]
+    if np is not None and len(decompressed_data) >= FILTER_NUMPY_MIN_POINTS:
+        keep, counts = _filter_mask_numpy(decompressed_data, rules, quality)
+    else:
+        keep, counts = _filter_mask(decompressed_data, rules, quality)
+
+    delete_data_count = sum(counts.values())
+    if reasons is not None:
+        for reason, count in counts.items():
+            reasons[reason] += count
+    if not delete_data_count:
+        return list(decompressed_data), 0
+    filtered_data = [point for point, kept in zip(decompressed_data, keep) if kept]
+    return filtered_data, delete_data_count
+
+
+def _filter_mask(decompressed_data, rules, quality):
+    """純Python版: 残す点の bool のリストと理由ごとの数"""
+    counts = dict.fromkeys(FILTER_REASONS, 0)
+    keep = []
+    prev_theta = None
+    for index, (theta, dist) in enumerate(decompressed_data):
+        if not (rules.theta_min <= theta <= rules.theta_max):
+            reason = "theta_range"
+        elif not (rules.dist_min <= dist <= rules.dist_max):
+            reason = "dist_range"
+        elif rules.min_quality is not None and quality is not None and quality[index] < rules.min_quality:
+            reason = "quality"
+        elif rules.max_jump is not None and prev_theta is not None and abs(theta - prev_theta) > rules.max_jump:
+            reason = "theta_jump"
+        else:
+            keep.append(True)
+            prev_theta = theta
+            continue
+        counts[reason] += 1
+        keep.append(False)
+
+    if rules.median_window and rules.median_max_diff is not None:
+        kept_index = [index for index, kept in enumerate(keep) if kept]
+        dists = [decompressed_data[index][1] for index in kept_index]
+        half = rules.median_window // 2
+        for position, index in enumerate(kept_index):
+            neighbours = dists[max(0, position - half):position + half + 1]
+            if abs(dists[position] - statistics.median(neighbours)) > rules.median_max_diff:
+                keep[index] = False
+                counts["median_outlier"] += 1
+    return keep, counts
+
+
+def _filter_mask_numpy(decompressed_data, rules, quality):
+    """NumPy版: _filter_mask と同じ結果を配列演算で求める"""
+    counts = dict.fromkeys(FILTER_REASONS, 0)
+    points = np.fromiter(itertools.chain.from_iterable(decompressed_data), dtype=np.float64,
+                         count=2 * len(decompressed_data))  # タプルのリストからは asarray より速い
+    theta = points[0::2]
+    dist = points[1::2]
+
+    bad = (theta < rules.theta_min) | (theta > rules.theta_max)
+    counts["theta_range"] = int(bad.sum())
+    bad_dist = ~bad & ((dist < rules.dist_min) | (dist > rules.dist_max))
+    counts["dist_range"] = int(bad_dist.sum())
+    bad |= bad_dist
+    if rules.min_quality is not None and quality is not None:
+        bad_quality = ~bad & (np.frombuffer(quality, dtype=np.uint8) < rules.min_quality)
+        counts["quality"] = int(bad_quality.sum())
+        bad |= bad_quality
+    keep = ~bad
+
+    if rules.max_jump is not None:
+        # ジャンプは「直前に残した点」との差なので，最初に超えた所からは1点ずつ判定する
+        kept_index = np.flatnonzero(keep)
+        kept_theta = theta[kept_index]
+        jumps = np.flatnonzero(np.abs(np.diff(kept_theta)) > rules.max_jump)
+        if jumps.size:
+            first = int(jumps[0])
+            kept_theta = kept_theta.tolist()
+            prev_theta = kept_theta[first]
+            for position in range(first + 1, len(kept_theta)):
+                if abs(kept_theta[position] - prev_theta) > rules.max_jump:
+                    keep[kept_index[position]] = False
+                    counts["theta_jump"] += 1
+                else:
+                    prev_theta = kept_theta[position]
+
+    if rules.median_window and rules.median_max_diff is not None:
+        kept_index = np.flatnonzero(keep)
+        dists = dist[kept_index]
+        half = rules.median_window // 2
+        if dists.size:
+            medians = np.empty_like(dists)
+            if dists.size > 2 * half:
+                windows = np.lib.stride_tricks.sliding_window_view(dists, 2 * half + 1)
+                medians[half:dists.size - half] = np.median(windows, axis=1)
+            # 端は窓を切り詰める（_filter_mask と同じ）
+            for position in itertools.chain(range(min(half, dists.size)),
+                                            range(max(half, dists.size - half), dists.size)):
+                medians[position] = np.median(dists[max(0, position - half):position + half + 1])
+            outliers = np.abs(dists - medians) > rules.median_max_diff
+            keep[kept_index[outliers]] = False
+            counts["median_outlier"] = int(outliers.sum())
+    return keep, counts
+
+
+def log_filter_summary(sensor_id, delete_data_count, reasons):
+    """1周につき1行だけ，削除した点の数を理由ごとに記録する"""
+    if delete_data_count:
+        sensor_info = f" from {sensor_id}" if sensor_id is not None else ""
+        details = ", ".join(f"{reason}: {count}" for reason, count in reasons.items() if count)
+        logger.warning(f"Warning: Skipped {delete_data_count} invalid points{sensor_info} ({details})")
+
+
+class DatagramReassembler:
+    """
+    Reassemble the datagrams of one sensor into frames, in sequence order.
+
+    Only rotations newer than the last delivered one are delivered: a
+    rotation that completes late, out of order or twice is "stale".  The
+    sequence numbers skipped by a delivery are counted as "lost" (dropped
+    datagrams and rotations whose fragments never all arrived).  Each
+    rotation is counted once: a late one that was already counted as lost
+    is dropped without counting it again.
+    """
+    def __init__(self, sensor_metrics=None):
+        self.sensor_metrics = sensor_metrics
+        self.pending = collections.OrderedDict()  # seq -> [断片のリスト, 受け取った数, 最初に受け取った時刻]
+        self.lost_seqs = collections.OrderedDict()  # lost として数えた直近の seq（DATAGRAM_RESTART_WINDOW まで）
+        self.last_seq = None
+        self.lost_count = 0
+        self.stale_count = 0
+
+    def _drop(self, reason, count=1):
+        if reason == "lost":
+            self.lost_count += count
+        else:
+            self.stale_count += count
+        if self.sensor_metrics is not None:
+            self.sensor_metrics.rotations_dropped[reason] += count
+
+    def feed(self, seq, index, count, fragment, now):
+        """
+        Add one fragment; returns the complete frame (bytes) or None.
+        """
+        if self.last_seq is not None:
+            ahead = (seq - self.last_seq) & DATAGRAM_SEQ_MASK
+            if ahead == 0 or ahead > DATAGRAM_SEQ_MASK // 2:
+                if (self.last_seq - seq) & DATAGRAM_SEQ_MASK <= DATAGRAM_RESTART_WINDOW:
+                    if index == 0:
+                        if seq in self.lost_seqs:
+                            del self.lost_seqs[seq]  # lost として数え済みの周が遅れて届いた
+                        else:
+                            self._drop("stale")  # 遅れて届いた周
+                    return None
+                logger.info(f"Sequence restarted at {seq} (last: {self.last_seq})")
+                self.last_seq = None
+                self.pending.clear()
+                self.lost_seqs.clear()
+
+        # 揃わないまま古くなった周を捨てる（次に届けた周の seq の飛びで lost として数える）
+        while self.pending:
+            oldest = next(iter(self.pending.values()))
+            if now - oldest[2] <= DATAGRAM_REASSEMBLY_TIMEOUT and len(self.pending) < DATAGRAM_MAX_PENDING:
+                break
+            self.pending.popitem(last=False)
+
+        entry = self.pending.get(seq)
+        if entry is None:
+            entry = self.pending[seq] = [[None] * count, 0, now]
+        fragments = entry[0]
+        if index >= len(fragments) or fragments[index] is not None:
+            return None  # 断片の数が合わない / 重複
+        fragments[index] = fragment
+        entry[1] += 1
+        if entry[1] < len(fragments):
+            return None
+
+        del self.pending[seq]
+        if self.last_seq is not None:
+            skipped = ((seq - self.last_seq) & DATAGRAM_SEQ_MASK) - 1
+            if skipped:
+                self._drop("lost", skipped)
+                for offset in range(min(skipped, DATAGRAM_RESTART_WINDOW), 0, -1):
+                    self.lost_seqs[(seq - offset) & DATAGRAM_SEQ_MASK] = None
+                while len(self.lost_seqs) > DATAGRAM_RESTART_WINDOW:
+                    self.lost_seqs.popitem(last=False)
+        self.last_seq = seq
+        for pending_seq in list(self.pending):
+            if (seq - pending_seq) & DATAGRAM_SEQ_MASK <= DATAGRAM_SEQ_MASK // 2:
+                del self.pending[pending_seq]  # この周より古い組み立て中の周
+        return b"".join(fragments)
+
+
+class DatagramReceiver:
+    """
+    Receive rotations sent over UDP (client.py --transport udp).
+
+    Each datagram carries a sensor ID; the sensor of a rotation is
+    "host:sensor ID".  Complete frames are decoded like the TCP stream (or
+    handed to the DecodePool, where a full pool drops the rotation instead
+    of waiting, since a late rotation is worthless).  Also used without
+    asyncio: the threaded LidarServer calls datagram_received() itself.
+    """
+    def __init__(self, lidar_server, manager=None, decode_pool=None):
+        self.lidar_server = lidar_server
+        self.manager = manager
+        self.decode_pool = decode_pool
+        self.sensors = {}  # sensor_id -> (DatagramReassembler, FrameParser)
+        self.rotation_counts = collections.Counter()
+
+    def datagram_received(self, data, address):
+        try:
+            magic, version, sensor, seq, index, count = DATAGRAM_HEADER.unpack_from(data)
+        except struct.error:
+            logger.warning(f"Warning: Short datagram from {address}, skipping...")
+            return
+        if magic != DATAGRAM_MAGIC or version != DATAGRAM_VERSION or count == 0:
+            logger.warning(f"Warning: Invalid datagram from {address} (magic: {magic!r}, version: {version}), skipping...")
+            return
+
+        sensor_id = f"{address[0]}:{sensor}"
+        state = self.sensors.get(sensor_id)
+        if state is None:
+            logger.info(f"LiDAR datagrams from {sensor_id}")
+            self.lidar_server.register_sensor(sensor_id, address[0])
+            sensor_metrics = self.lidar_server.metrics.sensor(sensor_id)
+            state = self.sensors[sensor_id] = (DatagramReassembler(sensor_metrics), FrameParser(sensor_metrics))
+        reassembler, parser = state
+        parser.sensor_metrics.bytes_in += len(data)
+        frame = reassembler.feed(seq, index, count, data[DATAGRAM_HEADER.size:], time.monotonic())
+        if frame is None:
+            return
+
+        try:
+            if self.decode_pool is not None:
+                for decoded_frame in parser.split_frame(frame):
+                    if self.decode_pool.submit(sensor_id, decoded_frame):
+                        parser.sensor_metrics.backlog += 1
+                    else:
+                        parser.sensor_metrics.rotations_dropped["decode_busy"] += 1
+                return
+            rotations = parser.feed_frame(frame)
+        except FrameError as e:
+            logger.error(f"Error decoding a datagram frame from {sensor_id}: {e}")
+            return
+        for timestamp, decompressed_data, quality in rotations:
+            self.rotation_counts[sensor_id] += 1
+            self.lidar_server.process_rotation(timestamp, decompressed_data, self.manager, sensor_id, quality)
+
+    def error_received(self, exc):
+        logger.warning(f"UDP error: {exc}")
+
+    # asyncio.DatagramProtocol の残り（asyncio を読み込まないように継承しない）
+    def connection_made(self, transport):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+
+ServerConfig = collections.namedtuple(
+    "ServerConfig",
+    "host lidar_port monitor_ports legacy_stream use_asyncio monitor_queue_size monitor_policy store_dir "
+    "store_max_segments metrics_port decode_workers filter_profile sensor_profiles udp scan_cache_rotations "
+    "occupancy_grid min_points max_points use_numpy log_dir async_logging point_sample_rate raw_data_path",
+    defaults=("0.0.0.0", 8000, (8001, 8002), False, False, MONITOR_QUEUE_SIZE, POLICY_DROP_OLDEST, None,
+              None, METRICS_PORT, 0, DEFAULT_FILTER_PROFILE, None, True, SCAN_CACHE_ROTATIONS,
+              False, ROTATION_MIN_POINTS, ROTATION_MAX_POINTS, True, "./logs", False, 1.0, None))
+ServerConfig.__doc__ = """
+Settings of one LidarServer; load_config(ServerConfig, "server") reads them
+from a JSON file and LIDAR_SERVER_* environment variables.
+
+`lidar_port` receives the rotations (TCP, and UDP with `udp`),
+`monitor_ports` serve the viewers (data, delay); 0 binds any free port.
+`use_asyncio` accepts many LiDAR clients on one event loop and
+`decode_workers` decodes in that many processes (asyncio only).
+`monitor_queue_size` / `monitor_policy` bound what a slow viewer may buffer.
+`store_dir` records every accepted rotation with RotationStore.
+`metrics_port` serves /metrics and the ScanCache queries (0 binds any free
+port, None disables it).
+`filter_profile` names the FILTER_PROFILES entry used by default and
+`sensor_profiles` ({host: profile}) overrides it for single sensors.
+`scan_cache_rotations` keeps that many rotations per sensor in the ScanCache
+(0 disables it), `occupancy_grid` also updates an occupancy grid.
+Rotations with fewer than `min_points` or more than `max_points` points
+left after filtering are not forwarded.  `use_numpy` imports NumPy for the
+vectorised paths when the server starts (for the whole process).
+The last four are passed to logging_setup() by lidar_server_main().
+"""
+
+
+class LidarServer:
+    """
+    One LiDAR ingest server: the LiDAR port, the monitoring ports 8001/8002 and /metrics.
+
+    Everything a server keeps (metrics, viewers, scan cache, store, filter
+    rules) belongs to the instance, so several servers can run in one
+    process, e.g. in tests and benchmarks.  Nothing is bound until start()
+    (threaded, in the background) or serve_forever(); with port 0 the bound
+    ports are in `lidar_port`, `monitor_ports` and `metrics_port`.  The
+    logging set up by logging_setup() is shared by the whole process.
+    """
+    def __init__(self, config=None, **options):
+        config = (config if config is not None else ServerConfig())._replace(**options)
+        sensor_profiles = dict(config.sensor_profiles or {})
+        unknown = {config.filter_profile, *sensor_profiles.values()} - set(FILTER_PROFILES)
+        if unknown:
+            raise ValueError(f"Unknown filter profile: {', '.join(sorted(unknown))}")
+        if config.monitor_policy not in (POLICY_DROP_OLDEST, POLICY_DISCONNECT):
+            raise ValueError(f"Unknown monitor policy: {config.monitor_policy}")
+        if len(config.monitor_ports) != 2:
+            raise ValueError("monitor_ports needs two ports (data, delay)")
+        self.config = config
+        self.default_filter_rules = FILTER_PROFILES[config.filter_profile]
+        self.sensor_filter_rules = {host: FILTER_PROFILES[profile] for host, profile in sensor_profiles.items()}
+        self.sensor_hosts = {}  # sensor_id -> 送信元のホスト（register_sensor，フィルターのプロファイルを選ぶ）
+        self.metrics = MetricsRegistry()
+        self.monitor_manager = MonitorManager(config.monitor_queue_size, config.monitor_policy)
+        self.scan_cache = ScanCache(config.scan_cache_rotations, config.occupancy_grid) \
+            if config.scan_cache_rotations else None
+        self.rotation_store = None  # start() で開く（store_dir の時）
+        self.metrics_server = None
+        self.lidar_port = config.lidar_port
+        self.monitor_ports = list(config.monitor_ports)
+        self.metrics_port = config.metrics_port
+        self.sockets = []        # 待ち受け中のソケット（close() で閉じる）
+        self.lidar_clients = set()
+        self.lidar_thread = None
+        self.running = False
+
+    def register_sensor(self, sensor_id, host):
+        """Record the host a sensor ID was created for (the ID itself is not parsed: IPv6, "#2", ...)."""
+        self.sensor_hosts[sensor_id] = host
+
+    def filter_rules_for(self, sensor_id, host=None):
+        """
+        The FilterRules of a sensor: its host's `sensor_profiles` entry (`host`, or the one
+        given to register_sensor for `sensor_id`), otherwise the default profile.
+        """
+        if host is None:
+            host = self.sensor_hosts.get(sensor_id)
+        return self.sensor_filter_rules.get(host, self.default_filter_rules)
+
+    def process_rotation(self, timestamp, decompressed_data, manager=None, sensor_id=None, quality=None, host=None):
+        """
+        Filter one decoded rotation and forward it to the monitoring clients.
+
+        `sensor_id` tags the output when several sensors share one server;
+        it (or `host`, for a connection without sensor ID) selects the filter
+        profile.  `quality` is the Q of each point, if sent.
+        """
+        # 🔹 追加: サーバー側で異常値をフィルタリング
+        reasons = dict.fromkeys(FILTER_REASONS, 0)
+        filtered_data, delete_data_count = filter_invalid_data(decompressed_data, reasons,
+                                                               self.filter_rules_for(sensor_id, host), quality)
+        sensor_metrics = self.metrics.sensor(sensor_id)
+        for reason, count in reasons.items():
+            sensor_metrics.points_filtered[reason] += count
+        log_filter_summary(sensor_id, delete_data_count, reasons)
+        self.forward_rotation(timestamp, len(decompressed_data), filtered_data, delete_data_count, manager, sensor_id)
+
+    def forward_rotation(self, timestamp, total_data_count, filtered_data, delete_data_count, manager=None,
+                         sensor_id=None):
+        """
+        Forward an already filtered rotation to the monitoring clients, the store and the logs.
+        """
+        if manager is None:
+            manager = self.monitor_manager
+        sensor_info = f"\nSensor: {sensor_id}" if sensor_id is not None else ""
+
+        send_message = f"{sensor_info}\nReceived data count: {total_data_count}"
+        sensor_metrics = self.metrics.sensor(sensor_id)
+        now = time.time()
+        clock_offset = sensor_metrics.clock.offset_at(now * 1e6)  # センサーの時計のずれを補正する
+        timestamp_info = "\n" + format_timestamp(timestamp, clock_offset)
+
+        sensor_metrics.rotations_received += 1
+        sensor_metrics.delay_seconds.observe(max(0.0, now - (timestamp - clock_offset) / 1e6))
+        stages = sensor_metrics.clock.stages(timestamp, now)
+        if stages is not None:
+            for stage, seconds in zip(LATENCY_STAGES, stages):
+                sensor_metrics.stage_seconds[stage].observe(max(0.0, seconds))
+            sensor_metrics.lag_seconds = max(0.0, stages[2] + stages[3])
+            timestamp_info += "\nStages: " + " ".join(f"{stage}: {seconds:.3f}sec"
+                                                      for stage, seconds in zip(LATENCY_STAGES, stages))
+
+        # データ数チェック
+        if len(filtered_data) < self.config.min_points or len(filtered_data) > self.config.max_points:
+            logger.warning(f"Warning: Skipping this rotation due to invalid data count: {len(filtered_data)}")
+            sensor_metrics.rotations_dropped["data_count"] += 1
+            delete_data_info = f"\nDelete data count: {total_data_count}"
+            send_message += f"{delete_data_info}{timestamp_info}\n"
+
+            manager.broadcast_8001(RotationMessage(timestamp, None, sensor_id, clock_offset))
+            manager.broadcast_8002(send_message)
+            return
+
+        # 🔹 タイムスタンプと遅延を追加して表示
+        message = RotationMessage(timestamp, filtered_data, sensor_id)
+        delete_data_info = f"\nDelete data count: {delete_data_count}"
+        send_message += f"{delete_data_info}{timestamp_info}\n"
+        if self.rotation_store is not None:
+            self.rotation_store.append(timestamp, sensor_id, filtered_data)
+        if self.scan_cache is not None:
+            self.scan_cache.update(sensor_id, timestamp, filtered_data)
+        if logging_util.raw_recorder is not None:
+            # テキストの代わりにバイナリで記録（角度の変換は書き込みスレッドで行う）
+            logging_util.raw_recorder.record(timestamp, (round(theta * 100) for theta, _ in filtered_data),
+                                             (dist for _, dist in filtered_data))
+        elif logger.isEnabledFor(logging.DEBUG) and logging_util.point_sampler.sample():
+            logger.debug("%s%s", message, timestamp_info)  # 8001番ポートのテキストと共有する（文字列化は出力時）
+        #print(formatted_output, end="")  # 余計な改行を防ぐ
+
+        # 監視用クライアントに送信
+        manager.broadcast_8001(message)
+        manager.broadcast_8002(send_message)
+
+    def _start_shared(self, manager):
+        """NumPy, the store and /metrics (exporting the viewers of `manager`), for both servers."""
+        config = self.config
+        if config.use_numpy:
+            load_numpy()
+        if config.store_dir:
+            self.rotation_store = RotationStore(config.store_dir, max_segments=config.store_max_segments)
+        if config.metrics_port is not None:
+            from .http_api import start_metrics_server  # http.server はメトリクスを出す時だけ読み込む
+            self.metrics_server = start_metrics_server(self, config.metrics_port, manager, config.host)
+            self.metrics_port = self.metrics_server.server_address[1]
+        self.running = True
+
+    def _listen(self, port, kind=socket.SOCK_STREAM):
+        listen_socket = socket.socket(socket.AF_INET, kind)
+        self.sockets.append(listen_socket)
+        if kind == socket.SOCK_STREAM:
+            listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listen_socket.bind((self.config.host, port))
+        if kind == socket.SOCK_STREAM:
+            listen_socket.listen()
+        return listen_socket
+
+    def start(self):
+        """
+        Bind the ports and serve from background threads (the threaded server); returns self.
+
+        As before, one LiDAR client is handled at a time (the next one is
+        accepted when it disconnects).
+        """
+        config = self.config
+        if config.use_asyncio:
+            raise ValueError("The asyncio server runs in serve_forever()")
+        if config.decode_workers:
+            logger.warning("decode_workers is only used with use_asyncio=True")
+        try:
+            lidar_socket = self._listen(config.lidar_port)
+            self.lidar_port = lidar_socket.getsockname()[1]
+            monitor_sockets = []
+            for index, port in enumerate(self.monitor_ports):
+                monitor_sockets.append(self._listen(port))
+                self.monitor_ports[index] = monitor_sockets[-1].getsockname()[1]
+            udp_socket = self._listen(self.lidar_port, socket.SOCK_DGRAM) if config.udp else None
+            self._start_shared(self.monitor_manager)
+        except BaseException:
+            self.close()
+            raise
+
+        logger.info(f"LiDAR server listening on port {self.lidar_port}")
+        for monitor_socket, port, logical_port in zip(monitor_sockets, self.monitor_ports, (8001, 8002)):
+            logger.info(f"Lidar Data Monitoring server listening on port {port}")
+            threading.Thread(target=self._accept_viewers, args=(monitor_socket, logical_port), daemon=True).start()
+        if udp_socket is not None:
+            logger.info(f"LiDAR UDP server listening on port {self.lidar_port}")
+            threading.Thread(target=self._receive_datagrams, args=(udp_socket,), daemon=True).start()
+        self.lidar_thread = threading.Thread(target=self._accept_lidar_clients, args=(lidar_socket,), daemon=True)
+        self.lidar_thread.start()
+        return self
+
+    def serve_forever(self):
+        """
+        Run until interrupted (or closed): the AsyncLidarServer with `use_asyncio`, otherwise the threaded server.
+        """
+        if self.config.use_asyncio:
+            import asyncio  # asyncio は asyncio のサーバーの時だけ読み込む
+            asyncio.run(self._serve_async())
+            return
+        if self.lidar_thread is None:
+            self.start()
+        try:
+            self.lidar_thread.join()
+        finally:
+            self.close()
+
+    async def _serve_async(self):
+        from .async_server import AsyncLidarServer
+        server = AsyncLidarServer(self)
+        try:
+            self._start_shared(server.manager)
+            await server.serve_forever()
+        finally:
+            await server.close()  # ワーカープロセスと共有メモリも片付ける
+            self.close()
+
+    def close(self):
+        """Stop serving: close the sockets and the viewers, stop /metrics and flush the store."""
+        self.running = False
+        for open_socket in self.sockets + list(self.lidar_clients):
+            try:
+                open_socket.shutdown(socket.SHUT_RDWR)  # accept() / recv() で待っているスレッドを起こす
+            except OSError:
+                pass
+            open_socket.close()
+        self.sockets = []
+        self.monitor_manager.close()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+            self.metrics_server = None
+        if self.rotation_store is not None:
+            self.rotation_store.stop()  # キューに残った周を書き出す
+            self.rotation_store = None
+
+    def _accept_lidar_clients(self, lidar_socket):
+        #Lidarとの接続が切れて handle_lidar_client が終了した時に再接続
+        while self.running:
+            try:
+                client_socket, address = lidar_socket.accept()
+            except OSError:
+                if not self.running:
+                    break  # close()
+                raise
+            self.handle_lidar_client(client_socket, address[0])
+
+    def handle_lidar_client(self, client_socket, host=None):
+        """
+        Handle incoming data from a LiDAR client; `host` selects its filter profile.
+        """
+        logger.info(f"LiDAR Client connected: {host}")
+        self.lidar_clients.add(client_socket)
+        # 🔹 旧クライアント（ヘッダーなし）の場合は互換モードで受信
+        sensor_metrics = self.metrics.sensor(None)
+        # 接続ごとに別のクライアント（別の時計）かもしれないので，前の接続の時刻合わせは引き継がない
+        sensor_metrics.clock = ClockSync()
+        parser = LegacyStreamParser(sensor_metrics) if self.config.legacy_stream else FrameParser(sensor_metrics)
+        try:
+            while True:
+                data = client_socket.recv(4096)
+                if not data:
+                    break
+                sensor_metrics.bytes_in += len(data)
+                control = parser.control_frames(time.monotonic())
+                if control:
+                    client_socket.sendall(control)  # 時刻合わせの応答は TIME_PONG として受信データに混ざって届く
+
+                for timestamp, decompressed_data, quality in parser.feed(data):
+                    self.process_rotation(timestamp, decompressed_data, quality=quality, host=host)
+
+        except Exception as e:
+            if self.running:
+                logger.exception(e)
+
+        finally:
+            self.lidar_clients.discard(client_socket)
+            client_socket.close()
+            logger.warning("LiDAR Client disconnected")
+
+    def _accept_viewers(self, monitor_socket, port):
+        """
+        Accept the viewers of one monitoring port (8001: data, 8002: time and delay).
+        """
+        while self.running:
+            try:
+                client_socket, address = monitor_socket.accept()
+                self.monitor_manager.add_client(client_socket, port)  # 実際のポート番号が違っても 8001 / 8002 の出力
+            except Exception as e:
+                if not self.running:
+                    break  # close()
+                logger.exception(f"Error accepting client connection: {e}")
+
+    def _receive_datagrams(self, udp_socket):
+        """
+        Receive LiDAR datagrams on the LiDAR port (UDP).
+        """
+        receiver = DatagramReceiver(self)
+        while self.running:
+            try:
+                data, address = udp_socket.recvfrom(65535)
+            except OSError:
+                if not self.running:
+                    break  # close()
+                raise
+            if not self.running:
+                break
+            try:
+                receiver.datagram_received(data, address)
+            except Exception as e:
+                logger.exception(e)
+
+
+def serve(lidar_server):
+    """
+    Run `lidar_server` until interrupted, with the process logging set up from its config.
+    """
+    config = lidar_server.config
+    logging_setup(config.log_dir, config.async_logging, config.point_sample_rate, config.raw_data_path)
+    try:
+        lidar_server.serve_forever()
+    finally:
+        lidar_server.close()
+        logging_shutdown()
+
+
+def lidar_server_main(config=None, **options):
+    """
+    Start the main server for LiDAR data and monitoring.
+
+    `config` is a ServerConfig (by default loaded with load_config(), i.e.
+    from $LIDAR_CONFIG and the LIDAR_SERVER_* variables); `options`
+    override single fields.
+    """
+    if config is None:
+        config = load_config(ServerConfig, "server")
+    serve(LidarServer(config, **options))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Receive LiDAR rotations and serve them to viewers.", argument_default=argparse.SUPPRESS,
+        epilog="Settings left out here come from the \"server\" object of the --config file (or $LIDAR_CONFIG) "
+               "and from LIDAR_SERVER_<SETTING> variables, e.g. LIDAR_SERVER_LIDAR_PORT=9000.")
+    parser.add_argument("--config", default=None, help="設定ファイル（JSON）")
+    parser.add_argument("--host", help="待ち受けるアドレス")
+    parser.add_argument("--lidar-port", type=int)
+    parser.add_argument("--monitor-ports", type=int, nargs=2, metavar=("DATA", "DELAY"))
+    parser.add_argument("--legacy-stream", action="store_true", help="ヘッダーなしの旧形式を受け付ける")
+    parser.add_argument("--asyncio", dest="use_asyncio", action="store_true", help="複数台のLiDARを asyncio で受け付ける")
+    parser.add_argument("--monitor-queue-size", type=int)
+    parser.add_argument("--monitor-policy", choices=[POLICY_DROP_OLDEST, POLICY_DISCONNECT])
+    parser.add_argument("--store-dir", help="受信した周を保存するディレクトリ")
+    parser.add_argument("--store-max-segments", type=int)
+    parser.add_argument("--decode-workers", type=int, help="解凍するワーカープロセスの数（--asyncio の時）")
+    parser.add_argument("--filter-profile", choices=sorted(FILTER_PROFILES))
+    parser.add_argument("--sensor-profile", dest="sensor_profiles", action="append", metavar="HOST=PROFILE",
+                        help="センサー（送信元のホスト）ごとのフィルターのプロファイル")
+    parser.add_argument("--metrics-port", type=int, help="/metrics のポート（0 で空いているポート）")
+    parser.add_argument("--no-metrics", dest="metrics_port", action="store_const", const=None,
+                        help="/metrics を提供しない")
+    parser.add_argument("--no-udp", dest="udp", action="store_false", help="UDP のデータグラムを受け付けない")
+    parser.add_argument("--scan-cache", dest="scan_cache_rotations", type=int, metavar="N",
+                        help="センサーごとにキャッシュする周の数（0 で無効）")
+    parser.add_argument("--occupancy-grid", action="store_true", help="占有グリッドも更新する（/grid）")
+    parser.add_argument("--min-points", type=int, help="フィルター後の点がこれより少ない周は転送しない")
+    parser.add_argument("--max-points", type=int, help="フィルター後の点がこれより多い周は転送しない")
+    parser.add_argument("--no-numpy", dest="use_numpy", action="store_false", help="NumPy を読み込まない")
+    parser.add_argument("--log-dir")
+    parser.add_argument("--async-logging", action="store_true")
+    parser.add_argument("--point-sample-rate", type=float)
+    parser.add_argument("--raw-data-path")
+    args = parser.parse_args(argv)
+    if "sensor_profiles" in args:
+        if not all("=" in item for item in args.sensor_profiles):
+            parser.error("--sensor-profile must be HOST=PROFILE")
+        args.sensor_profiles = dict(item.split("=", 1) for item in args.sensor_profiles)
+    return args
+
+
+def main(argv=None):
+    """Command line: the settings are loaded with load_config() and the options override them."""
+    options = vars(parse_args(argv))
+    try:
+        lidar_server = LidarServer(load_config(ServerConfig, "server", options.pop("config"), **options))
+    except ValueError as e:
+        sys.exit(f"error: {e}")
+    serve(lidar_server)
+
+
+if __name__ == "__main__":
+    main()
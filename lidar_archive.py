@@ -0,0 +1,232 @@
+"""
+Compress recorded LiDAR data offline, and extract it again.
+
+Inputs are ultra_simple stdout captures (like test.txt) or RawDataRecorder
+files of any length; they are read in chunks (constant memory), split into
+rotations on the "S" lines by client.StdoutRotationParser as on the Pi,
+and compressed in a process pool with the same encoders as client.py.
+Every input becomes `<output dir>/<name>.lza`, the frames back to back
+(the stream server.py receives), plus `<name>.lza.idx` with one
+(start time [us], offset) entry per rotation.
+
+    python lidar_archive.py compress logs/*.txt -o archives --encoding rice --verify
+    python lidar_archive.py extract archives/scan.txt.lza -o scan.txt --start 100 --count 50
+"""
+import argparse
+import collections
+import concurrent.futures
+import itertools
+import os
+import struct
+import sys
+import time
+
+from lidar import client, codec, server
+
+ARCHIVE_SUFFIX = ".lza"
+ARCHIVE_INDEX_ENTRY = struct.Struct("<QQ")  # 一周の開始時刻(μs), アーカイブ内のオフセット（RotationStore の .idx と同じ）
+ARCHIVE_BATCH = 64           # 1つのタスクで圧縮する周の数
+ROTATION_PERIOD_US = 100000  # テキストの記録には時刻がないので，開始時刻から 10Hz で時刻を付ける
+READ_CHUNK = 1024*1024
+
+
+def iter_rotations(path, start_time=None):
+    """
+    Yield the rotations of one recording without reading it into memory.
+
+    Text captures get `start_time` (default: the file's mtime) plus
+    ROTATION_PERIOD_US per rotation; a last rotation without a closing "S"
+    line is dropped, as the live client never sends it either.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(client.RAW_RECORD_MAGIC)) == client.RAW_RECORD_MAGIC:
+            f.seek(0)
+            yield from client.iter_raw_records(f)
+            return
+        f.seek(0)
+        if start_time is None:
+            start_time = int(os.path.getmtime(path) * 1e6)
+        parser = client.StdoutRotationParser()
+        count = 0
+        while True:
+            rotations = parser.read_from(f)
+            if rotations is None:
+                break
+            for rotation in rotations:
+                yield rotation._replace(start_time=start_time + count * ROTATION_PERIOD_US)
+                count += 1
+
+
+def same_points(rotation, decoded, send_quality):
+    """Does the decoded frame give back the rotation (the (0, 0) points are not encoded)?"""
+    if len(decoded) != 1:
+        return False
+    timestamp, points, quality = decoded[0]
+    kept = [index for index, (theta, dist) in enumerate(zip(rotation.theta, rotation.dist)) if theta or dist]
+    if timestamp != rotation.start_time or len(points) != len(kept):
+        return False
+    if any(round(theta * 100) != rotation.theta[index] or dist != rotation.dist[index]
+           for (theta, dist), index in zip(points, kept)):
+        return False
+    if send_quality:
+        return bytes(quality) == bytes(min(rotation.quality[index], 255) for index in kept)
+    return True
+
+
+def compress_batch(rotations, encoding, send_quality, verify):
+    """
+    Worker: compress a batch of rotations; returns ([(start time, frame), ...], mismatches, skipped).
+
+    `skipped` counts the rotations the encoder rejected (e.g. a delta out of
+    the 11 / 16-bit range of the fixed encoding); they are not archived.
+    """
+    compress, _ = client.make_compressor(False, encoding, None, send_quality)
+    frames = []
+    mismatches = 0
+    skipped = 0
+    parser = server.FrameParser()
+    for rotation in rotations:
+        frame = compress(rotation)
+        if not frame:
+            skipped += 1  # 符号化できない周（アーカイブに入らない）
+            continue
+        frame = bytes(frame)
+        frames.append((rotation.start_time, frame))
+        if verify and not same_points(rotation, parser.feed_frame(frame), send_quality):
+            mismatches += 1
+    return frames, mismatches, skipped
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def compress_file(pool, path, output_dir, encoding, send_quality, verify, max_pending, batch_size=ARCHIVE_BATCH):
+    """
+    Compress one recording; at most `max_pending` batches are in flight, so memory stays bounded.
+    """
+    archive_path = os.path.join(output_dir, os.path.basename(path) + ARCHIVE_SUFFIX)
+    totals = collections.Counter()
+    pending = collections.deque()
+    start = time.perf_counter()
+    with open(archive_path, "wb") as archive, open(archive_path + ".idx", "wb") as index:
+        def write(future):
+            frames, mismatches, skipped = future.result()
+            for timestamp, frame in frames:
+                index.write(ARCHIVE_INDEX_ENTRY.pack(timestamp, totals["archive_bytes"]))
+                archive.write(frame)
+                totals["archive_bytes"] += len(frame)
+            totals["rotations"] += len(frames)
+            totals["mismatches"] += mismatches
+            totals["skipped"] += skipped
+
+        for batch in batches(iter_rotations(path), batch_size):
+            pending.append(pool.submit(compress_batch, batch, encoding, send_quality, verify))
+            if len(pending) >= max_pending:
+                write(pending.popleft())
+        while pending:
+            write(pending.popleft())
+    totals["seconds"] = time.perf_counter() - start
+    totals["input_bytes"] = os.path.getsize(path)
+    return archive_path, totals
+
+
+def read_index(archive_path):
+    with open(archive_path + ".idx", "rb") as f:
+        return list(ARCHIVE_INDEX_ENTRY.iter_unpack(f.read()))
+
+
+def extract(archive_path, output, start=0, count=None):
+    """
+    Write rotations `start` .. `start + count` of an archive back as ultra_simple text.
+    """
+    index = read_index(archive_path)
+    if start >= len(index):
+        return 0
+    end = len(index) if count is None else min(len(index), start + count)
+    stop_offset = index[end][1] if end < len(index) else None
+    parser = server.FrameParser()
+    written = 0
+    with open(archive_path, "rb") as f:
+        f.seek(index[start][1])
+        remaining = None if stop_offset is None else stop_offset - index[start][1]
+        while remaining is None or remaining > 0:
+            chunk = f.read(READ_CHUNK if remaining is None else min(READ_CHUNK, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            for timestamp, points, quality in parser.feed(chunk):
+                if quality is None:
+                    output.writelines(f"   theta: {theta:.2f} Dist: {dist:08.2f} \n" for theta, dist in points)
+                else:
+                    output.writelines(f"   theta: {theta:.2f} Dist: {dist:08.2f} Q: {q} \n"
+                                      for (theta, dist), q in zip(points, quality))
+                output.write("S\n")  # 周の区切り（StdoutRotationParser で同じ周に戻る）
+                written += 1
+    return written
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    compress = commands.add_parser("compress", help="記録を圧縮してアーカイブにする")
+    compress.add_argument("inputs", nargs="+")
+    compress.add_argument("-o", "--output-dir", default=".")
+    compress.add_argument("--encoding", choices=sorted(client.ENCODING_NAMES), default="rice")
+    compress.add_argument("--quality", action="store_true", help="点ごとの Q も残す")
+    compress.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    compress.add_argument("--verify", action="store_true", help="圧縮した周を解凍して元と比べる")
+    extract_parser = commands.add_parser("extract", help="アーカイブを ultra_simple のテキストに戻す")
+    extract_parser.add_argument("archive")
+    extract_parser.add_argument("-o", "--output", default=None, help="出力先（省略時は標準出力）")
+    extract_parser.add_argument("--start", type=int, default=0, help="最初の周の番号")
+    extract_parser.add_argument("--count", type=int, default=None, help="周の数")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    codec.load_numpy()  # 圧縮のワーカープロセスにも引き継がれる
+    if args.command == "extract":
+        if args.output is None:
+            written = extract(args.archive, sys.stdout, args.start, args.count)
+        else:
+            with open(args.output, "w") as output:
+                written = extract(args.archive, output, args.start, args.count)
+        if args.output is not None:
+            print(f"{written} rotations written to {args.output}")
+        return 0
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    encoding = client.ENCODING_NAMES[args.encoding]
+    grand_total = collections.Counter()
+    print(f"{'file':<32}{'rotations':>10}{'skipped':>9}{'input MB':>10}{'archive MB':>12}{'ratio':>8}{'MB/s':>8}"
+          + (f"{'mismatches':>12}" if args.verify else ""))
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+        for path in args.inputs:
+            _, totals = compress_file(pool, path, args.output_dir, encoding, args.quality, args.verify,
+                                      args.workers * 4)
+            grand_total.update(totals)
+            print_totals(os.path.basename(path), totals, args.verify)
+    if len(args.inputs) > 1:
+        print_totals("total", grand_total, args.verify)
+    # 符号化できずに抜けた周も，元に戻らなかった周として扱う
+    return 1 if args.verify and (grand_total["mismatches"] or grand_total["skipped"]) else 0
+
+
+def print_totals(name, totals, verify):
+    ratio = totals["input_bytes"] / totals["archive_bytes"] if totals["archive_bytes"] else float("nan")
+    rate = totals["input_bytes"] / 1e6 / totals["seconds"] if totals["seconds"] else float("nan")
+    print(f"{name:<32}{totals['rotations']:>10}{totals['skipped']:>9}{totals['input_bytes'] / 1e6:>10.2f}"
+          f"{totals['archive_bytes'] / 1e6:>12.3f}{ratio:>8.1f}{rate:>8.1f}"
+          + (f"{totals['mismatches']:>12}" if verify else ""))
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
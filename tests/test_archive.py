@@ -0,0 +1,19 @@
+"""
+lidar_archive: every rotation is either archived or counted.
+"""
+import lidar_archive
+from lidar import client, codec
+
+
+def test_rejected_rotations_are_counted():
+    good = client.Rotation(1, [100, 200, 300], [500, 510, 520], [10, 10, 10])
+    out_of_range = client.Rotation(2, [100, 1300], [500, 510], [10, 10])  # 角度の差分が 11 ビットを超える
+    frames, mismatches, skipped = lidar_archive.compress_batch([good, out_of_range], codec.ENCODING_FIXED,
+                                                               False, True)
+    assert [timestamp for timestamp, _ in frames] == [1]
+    assert (mismatches, skipped) == (0, 1)
+
+    frames, mismatches, skipped = lidar_archive.compress_batch([good, out_of_range], codec.ENCODING_RICE,
+                                                               False, True)
+    assert [timestamp for timestamp, _ in frames] == [1, 2]
+    assert (mismatches, skipped) == (0, 0)
@@ -0,0 +1,43 @@
+"""
+ClockSync: on random clocks and links, the offset estimate is within 1 ms after 30 exchanges.
+"""
+import random
+
+import pytest
+
+from lidar import server
+
+START = 1.7e15  # サーバーの時刻 [us]
+
+
+def simulate(rng, offset_us, drift, exchanges):
+    """The error [us] of the ClockSync offset after `exchanges` TIME_PING exchanges, one per second."""
+    up_base, down_base, jitter = rng.uniform(50, 500), rng.uniform(50, 500), rng.uniform(100, 1000)
+
+    def delay(base):
+        """One-way delay [us]: base + exponential jitter, sometimes a spike."""
+        value = base + rng.expovariate(1.0 / jitter)
+        if rng.random() < 0.05:
+            value += rng.uniform(10000, 100000)  # 再送や混雑
+        return value
+
+    def client_clock(t):
+        return t + offset_us + drift * (t - START)
+
+    clock = server.ClockSync()
+    t4 = START
+    for index in range(1, exchanges + 1):
+        t1 = START + index * 1e6
+        t2 = t1 + delay(down_base)
+        t3 = t2 + 50  # クライアントが応答するまで
+        t4 = t3 + delay(up_base)
+        clock.add_sample(t1, client_clock(t2), client_clock(t3), t4)
+    return clock.offset_at(t4) - (offset_us + drift * (t4 - START))
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_offset_error_after_30_exchanges(seed):
+    rng = random.Random(seed)
+    for _ in range(30):
+        error = simulate(rng, rng.uniform(-10e6, 10e6), rng.uniform(-100e-6, 100e-6), 30)
+        assert abs(error) < 1000
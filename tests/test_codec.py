@@ -0,0 +1,126 @@
+"""
+Round trip of randomized rotations through the client's compressor and the server's parser.
+"""
+import random
+
+import pytest
+
+from lidar import client, codec, server
+
+ENCODINGS = {
+    "fixed": {},
+    "rice": {"encoding": codec.ENCODING_RICE},
+    "varint": {"encoding": codec.ENCODING_VARINT},
+    "predictive": {"keyframe_interval": 3},
+}
+SEEDS = range(10)
+ROTATIONS = 5  # 1つの接続で続けて送る周（予測モードは前の周を参照する）
+
+
+@pytest.fixture(params=["python", "numpy"])
+def numpy_mode(request, monkeypatch):
+    """Run with the pure Python and with the NumPy encoder / decoder."""
+    if request.param == "numpy":
+        monkeypatch.setattr(codec, "np", pytest.importorskip("numpy"))
+    else:
+        monkeypatch.setattr(codec, "np", None)
+    return request.param
+
+
+def random_rotation(rng, start_time):
+    """ランダムな一周分（差分は固定長の符号化に収まる範囲，(0, 0) の点と 255 を超える Q を含む）"""
+    theta_values, dist_values, quality_values = [], [], []
+    theta = rng.randint(0, 1000)
+    dist = rng.randint(0, 14000)
+    while theta < 36000:
+        if rng.random() < 0.01:
+            theta_values.append(0)
+            dist_values.append(0)
+            quality_values.append(0)
+        theta_values.append(theta)
+        dist_values.append(dist)
+        quality_values.append(rng.randint(0, 300))
+        theta += rng.randint(0, 120)
+        dist = min(max(dist + int(rng.gauss(0, 40 if rng.random() > 0.01 else 8000)), 0), 65535)
+    return client.Rotation(start_time, theta_values, dist_values, quality_values)
+
+
+def expected_points(rotation):
+    points = [(theta, dist) for theta, dist in zip(rotation.theta, rotation.dist) if theta or dist]
+    theta_deltas = [b[0] - a[0] for a, b in zip(points, points[1:])]
+    dist_deltas = [b[1] - a[1] for a, b in zip(points, points[1:])]
+    return codec.accumulate_points(points[0][0], points[0][1], theta_deltas, dist_deltas)
+
+
+def expected_quality(rotation):
+    return bytes(min(quality, 255) for theta, dist, quality in zip(rotation.theta, rotation.dist, rotation.quality)
+                 if theta or dist)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+@pytest.mark.parametrize("send_quality", [False, True], ids=["no-quality", "quality"])
+@pytest.mark.parametrize("checksum", [False, True], ids=["no-crc", "crc"])
+@pytest.mark.parametrize("mode", ENCODINGS)
+def test_round_trip(mode, checksum, send_quality, seed, numpy_mode):
+    rng = random.Random(seed)
+    compress, _ = client.make_compressor(send_quality=send_quality, checksum=checksum, **ENCODINGS[mode])
+    parser = server.FrameParser()
+    for start_time in range(1, ROTATIONS + 1):
+        rotation = random_rotation(rng, start_time)
+        frame = compress(rotation)
+        assert frame is not None
+        # 受信側では任意の位置で分割されて届く
+        cut = rng.randint(0, len(frame))
+        decoded = parser.feed(bytes(frame[:cut])) + parser.feed(bytes(frame[cut:]))
+
+        quality = expected_quality(rotation) if send_quality else None
+        assert [(timestamp, points, None if q is None else bytes(q)) for timestamp, points, q in decoded] == \
+            [(start_time, expected_points(rotation), quality)]
+    assert parser.skipped_bytes == 0
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_legacy_round_trip(seed, numpy_mode):
+    rng = random.Random(seed)
+    compress, _ = client.make_compressor(legacy_format=True)
+    rotation = random_rotation(rng, 1)
+    parser = server.LegacyStreamParser()
+    assert parser.feed(bytes(compress(rotation))) == [(1, expected_points(rotation), None)]
+
+
+def test_fixed_encoders_agree(monkeypatch):
+    monkeypatch.setattr(codec, "np", pytest.importorskip("numpy"))
+    rng = random.Random(0)
+    for start_time in range(20):
+        rotation = random_rotation(rng, start_time)
+        assert codec.compress_points_numpy(rotation.theta, rotation.dist, start_time) == \
+            codec.compress_points(rotation.theta, rotation.dist, start_time)
+
+
+def test_fixed_rejects_out_of_range_deltas(numpy_mode):
+    compress, _ = client.make_compressor()
+    rotation = client.Rotation(1, [100, 1200], [500, 600], [10, 10])  # 角度の差分が 11 ビットを超える
+    assert compress(rotation) is None
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+@pytest.mark.parametrize("send_quality", [False, True], ids=["no-quality", "quality"])
+@pytest.mark.parametrize("encoding", [codec.ENCODING_RICE, codec.ENCODING_VARINT], ids=["rice", "varint"])
+def test_lossy_round_trip(encoding, send_quality, seed):
+    rng = random.Random(seed)
+    quantization = codec.Quantization(rng.randint(1, 400), rng.randint(1, 200))
+    compress, _ = client.make_compressor(encoding=encoding, send_quality=send_quality, quantization=quantization)
+    rotation = random_rotation(rng, 1)
+    [(timestamp, points, quality)] = server.FrameParser().feed(bytes(compress(rotation)))
+
+    _, _, source_indices = codec.quantize_points(rotation.theta, rotation.dist, quantization)
+    assert timestamp == 1
+    assert len(points) == len(source_indices)
+    max_theta_error, max_dist_error = codec.quantization_max_error(quantization)
+    for (theta, dist), index in zip(points, source_indices):
+        assert abs(theta - rotation.theta[index] / 100.0) <= max_theta_error + 1e-9
+        assert abs(dist - rotation.dist[index]) <= max_dist_error
+    if send_quality:
+        assert bytes(quality) == bytes(min(rotation.quality[index], 255) for index in source_indices)
+    else:
+        assert quality is None
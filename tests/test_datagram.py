@@ -0,0 +1,119 @@
+"""
+DatagramReassembler: every rotation is delivered or counted as dropped ("lost" / "stale") exactly once.
+"""
+import random
+
+import pytest
+
+from lidar import codec, server
+
+FRAGMENTS = 3
+
+
+def rotation_datagrams(seq):
+    """The datagrams of rotation `seq`: (seq, index, count, fragment)."""
+    frame = bytes(range(256)) * 4 + seq.to_bytes(4, "big")
+    datagrams = []
+    for datagram in codec.split_datagrams(frame, 1, seq, payload_size=-(-len(frame) // FRAGMENTS)):
+        _, _, _, seq, index, count = codec.DATAGRAM_HEADER.unpack_from(datagram)
+        datagrams.append((seq, index, count, datagram[codec.DATAGRAM_HEADER.size:]))
+    return datagrams
+
+
+def feed(reassembler, datagrams, now=0.0):
+    """Feed the datagrams; returns the seqs of the delivered rotations."""
+    delivered = []
+    for seq, index, count, fragment in datagrams:
+        frame = reassembler.feed(seq, index, count, fragment, now)
+        if frame is not None:
+            assert frame == b"".join(datagram[3] for datagram in rotation_datagrams(seq))
+            delivered.append(seq)
+    return delivered
+
+
+def test_in_order():
+    reassembler = server.DatagramReassembler()
+    datagrams = [datagram for seq in range(10) for datagram in rotation_datagrams(seq)]
+    assert len(datagrams) == 10 * FRAGMENTS
+    assert feed(reassembler, datagrams) == list(range(10))
+    assert (reassembler.lost_count, reassembler.stale_count) == (0, 0)
+
+
+def test_missing_fragment_is_lost():
+    reassembler = server.DatagramReassembler()
+    datagrams = [datagram for seq in range(5) for datagram in rotation_datagrams(seq)]
+    del datagrams[2 * FRAGMENTS + 1]
+    assert feed(reassembler, datagrams) == [0, 1, 3, 4]
+    assert (reassembler.lost_count, reassembler.stale_count) == (1, 0)
+
+
+def test_late_fragment_of_lost_rotation_is_not_counted_again():
+    reassembler = server.DatagramReassembler()
+    datagrams = [datagram for seq in range(5) for datagram in rotation_datagrams(seq)]
+    late = datagrams.pop(2 * FRAGMENTS)  # seq 2 の最初の断片が seq 3 より後に届く
+    datagrams.insert(4 * FRAGMENTS - 1, late)
+    assert feed(reassembler, datagrams) == [0, 1, 3, 4]
+    assert (reassembler.lost_count, reassembler.stale_count) == (1, 0)
+
+
+def test_overtaken_rotation_is_counted_once():
+    reassembler = server.DatagramReassembler()
+    order = [0, 1, 3, 2, 4]
+    assert feed(reassembler, [datagram for seq in order for datagram in rotation_datagrams(seq)]) == [0, 1, 3, 4]
+    assert (reassembler.lost_count, reassembler.stale_count) == (1, 0)
+
+
+def test_duplicate_is_stale():
+    reassembler = server.DatagramReassembler()
+    order = [0, 1, 1, 2]
+    assert feed(reassembler, [datagram for seq in order for datagram in rotation_datagrams(seq)]) == [0, 1, 2]
+    assert (reassembler.lost_count, reassembler.stale_count) == (0, 1)
+
+
+def test_restart_is_not_counted():
+    reassembler = server.DatagramReassembler()
+    order = [5000, 5001, 0, 1]  # クライアントが再起動して seq が 0 に戻った
+    assert feed(reassembler, [datagram for seq in order for datagram in rotation_datagrams(seq)]) == order
+    assert (reassembler.lost_count, reassembler.stale_count) == (0, 0)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_lost_equals_injected_loss(seed):
+    """Random loss in order (bench_udp.py without jitter): each rotation with a missing datagram is lost once."""
+    rng = random.Random(seed)
+    rotations = 200
+    datagrams = []
+    lost_seqs = set()
+    for seq in range(rotations):
+        for datagram in rotation_datagrams(seq):
+            if 0 < seq < rotations - 1 and rng.random() < 0.05:
+                lost_seqs.add(seq)
+            else:
+                datagrams.append(datagram)
+
+    reassembler = server.DatagramReassembler()
+    assert feed(reassembler, datagrams) == sorted(set(range(rotations)) - lost_seqs)
+    assert (reassembler.lost_count, reassembler.stale_count) == (len(lost_seqs), 0)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_each_rotation_counted_once(seed):
+    """Random loss and reordering: delivered + lost + stale equals the rotations sent."""
+    rng = random.Random(seed)
+    rotations = 200
+    datagrams = []
+    lost_seqs = set()
+    for seq in range(rotations):
+        for datagram in rotation_datagrams(seq):
+            if 0 < seq < rotations - 1 and rng.random() < 0.05:
+                lost_seqs.add(seq)  # 最初と最後の周は失わない（前後に届いた周がないと数えられない）
+                continue
+            # 3周分までの揺らぎで順番が入れ替わる（最初の周は基準なので先に届ける）
+            datagrams.append((seq + rng.uniform(0, 3) if seq else -1, datagram))
+    datagrams.sort(key=lambda item: item[0])
+
+    reassembler = server.DatagramReassembler()
+    delivered = feed(reassembler, [datagram for _, datagram in datagrams])
+    assert delivered == sorted(set(delivered))
+    assert not lost_seqs & set(delivered)
+    assert len(delivered) + reassembler.lost_count + reassembler.stale_count == rotations
@@ -0,0 +1,66 @@
+"""
+DecodePool: a sensor's rotations come back in order, also when it reconnects with the same ID.
+"""
+import queue
+
+import pytest
+
+from lidar import codec, server
+from lidar.decode_pool import DecodePool
+
+
+def frames(count, start_time):
+    """`count` frames of the same rotation, with start times from `start_time`."""
+    theta_values = list(range(100, 36000, 60))
+    dist_values = [1000 + index % 50 for index in range(len(theta_values))]
+    data = b"".join(bytes(codec.compress_points(theta_values, dist_values, start_time + index))
+                    for index in range(count))
+    return server.FrameParser().split(data)
+
+
+@pytest.fixture
+def pool():
+    messages = queue.Queue()
+    decode_pool = DecodePool(2, messages.put, use_numpy=False)
+    yield decode_pool, messages
+    decode_pool.close()
+
+
+def read(decode_pool, messages, count):
+    return [decode_pool.read_result(messages.get(timeout=60)) for _ in range(count)]
+
+
+def test_reconnect_keeps_worker_and_order(pool):
+    decode_pool, messages = pool
+    for frame in frames(10, 0):
+        assert decode_pool.submit("a", frame)
+    worker = decode_pool.assignment["a"]
+    decode_pool.release("a")  # 切断: まだ解凍されていないフレームが残っている
+    for frame in frames(1, 0):
+        assert decode_pool.submit("b", frame)  # 空いたように見えるワーカーに別のセンサーが入る
+    for frame in frames(10, 100):
+        assert decode_pool.submit("a", frame)  # 同じ ID で再接続
+    assert decode_pool.assignment["a"] == worker
+
+    rotations = read(decode_pool, messages, 21)
+    assert [rotation.timestamp for rotation in rotations if rotation.sensor_id == "a"] == \
+        list(range(10)) + list(range(100, 110))
+    assert all(rotation.error is None and rotation.points for rotation in rotations)
+    assert "a" not in decode_pool.released
+
+
+def test_release_frees_assignment_after_last_result(pool):
+    decode_pool, messages = pool
+    for frame in frames(3, 0):
+        assert decode_pool.submit("a", frame)
+    decode_pool.release("a")
+    assert "a" in decode_pool.assignment
+    read(decode_pool, messages, 3)
+    assert "a" not in decode_pool.assignment
+    assert decode_pool.sensor_counts == [0, 0]
+
+    decode_pool.release("b")  # 割り当てのないセンサー
+    assert decode_pool.submit("c", frames(1, 0)[0])
+    read(decode_pool, messages, 1)
+    decode_pool.release("c")
+    assert decode_pool.assignment == {} and decode_pool.sensor_counts == [0, 0]
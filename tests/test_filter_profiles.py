@@ -0,0 +1,36 @@
+"""
+Filter profiles: a sensor gets the profile of the host it connected from, whatever its sensor ID looks like.
+"""
+import pytest
+
+from lidar import server
+from lidar.async_server import AsyncLidarServer
+
+PROFILES = {"::1": "rplidar_a1", "192.168.201.7": "rplidar_a1"}
+
+
+@pytest.fixture
+def lidar_server():
+    return server.LidarServer(filter_profile="rplidar_s2", sensor_profiles=PROFILES, metrics_port=None)
+
+
+def test_tcp_sensor_ids(lidar_server):
+    async_server = AsyncLidarServer(lidar_server)
+    a1 = server.FILTER_PROFILES["rplidar_a1"]
+    sensor_ids = [async_server._claim_sensor_id("::1", None),  # HELLO なし: ホストだけ（IPv6）
+                  async_server._claim_sensor_id("::1", None),  # 同じホストの2本目: "::1#2"
+                  async_server._claim_sensor_id("192.168.201.7", None),
+                  async_server._claim_sensor_id("192.168.201.7", None),
+                  async_server._claim_sensor_id("::1", 3)]
+    assert sensor_ids == ["::1", "::1#2", "192.168.201.7", "192.168.201.7#2", "::1:3"]
+    assert all(lidar_server.filter_rules_for(sensor_id) is a1 for sensor_id in sensor_ids)
+
+    other = async_server._claim_sensor_id("::2", None)
+    assert lidar_server.filter_rules_for(other) is lidar_server.default_filter_rules
+
+
+def test_host_without_sensor_id(lidar_server):
+    a1 = server.FILTER_PROFILES["rplidar_a1"]
+    assert lidar_server.filter_rules_for(None, "::1") is a1  # スレッドのサーバー（センサーIDなし）
+    assert lidar_server.filter_rules_for(None) is lidar_server.default_filter_rules
+    assert lidar_server.filter_rules_for("192.168.201.7:1") is lidar_server.default_filter_rules  # 登録されていない
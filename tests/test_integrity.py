@@ -0,0 +1,92 @@
+"""
+FrameParser with CRC32: damaged frames are never delivered, every undamaged frame still is.
+"""
+import os
+import random
+
+import pytest
+
+from lidar import client, server
+
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test.txt")
+ENCODINGS = (client.ENCODING_FIXED, client.ENCODING_RICE, client.ENCODING_VARINT)
+CORRUPTIONS = ("payload", "header", "truncate", "garbage")
+
+
+@pytest.fixture(scope="module")
+def rotation():
+    with open(TEST_FILE, "rb") as f:
+        [rotation] = client.StdoutRotationParser().feed(f.read().rstrip(b"\n") + b"\n")  # 最後の S 行で一周が完成する
+    return rotation
+
+
+def make_frames(rotation, count, encoding, rng):
+    """`count` frames with CRC32 of slightly different rotations; the timestamp is the rotation number."""
+    compress, _ = client.make_compressor(encoding=encoding, checksum=True)
+    frames, expected = [], []
+    for index in range(count):
+        dist = [max(0, d + rng.randint(-20, 20)) if d else 0 for d in rotation.dist]
+        frames.append(bytes(compress(rotation._replace(start_time=index, dist=dist))))
+        expected.append([(theta, d) for theta, d in zip(rotation.theta, dist) if theta or d])
+    return frames, expected
+
+
+def corrupt(frames, rate, rng):
+    """Damage about `rate` of the frames; returns (stream, numbers of the frames that were changed)."""
+    parts, damaged = [], set()
+    for index, frame in enumerate(frames):
+        if rng.random() >= rate:
+            parts.append(frame)
+            continue
+        frame = bytearray(frame)
+        kind = rng.choice(CORRUPTIONS)
+        if kind != "garbage":
+            damaged.add(index)  # 前にゴミが入っただけのフレームは壊れていない
+        if kind == "payload":
+            frame[rng.randrange(server.FRAME_HEADER.size, len(frame))] ^= 1 << rng.randrange(8)
+        elif kind == "header":
+            frame[rng.randrange(server.FRAME_HEADER.size)] ^= 1 << rng.randrange(8)
+        elif kind == "truncate":
+            del frame[rng.randrange(1, len(frame)):]
+        else:
+            frame[:0] = bytes(rng.randrange(256) for _ in range(rng.randint(1, 64)))
+        parts.append(bytes(frame))
+    return b"".join(parts), damaged
+
+
+def decode(stream, expected, rng):
+    """Feed the stream in random chunks like recv(); returns (timestamps decoded correctly, wrong rotations)."""
+    parser = server.FrameParser()
+    seen, wrong = [], 0
+    for offset in range(0, len(stream), 4096):
+        end = min(len(stream), offset + 4096)
+        cuts = sorted({offset, end, *(rng.randrange(offset, end) for _ in range(3))})
+        for start, stop in zip(cuts, cuts[1:]):
+            for timestamp, points, _ in parser.feed(stream[start:stop]):
+                decoded = [(round(theta * 100), dist) for theta, dist in points]
+                if timestamp < len(expected) and timestamp not in seen and decoded == expected[timestamp]:
+                    seen.append(timestamp)
+                else:
+                    wrong += 1
+    return seen, wrong
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+@pytest.mark.parametrize("seed", range(10))
+def test_clean_stream(rotation, encoding, seed):
+    rng = random.Random(seed)
+    frames, expected = make_frames(rotation, rng.randint(1, 30), encoding, rng)
+    assert decode(b"".join(frames), expected, rng) == (list(range(len(frames))), 0)
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+@pytest.mark.parametrize("seed", range(30))
+def test_resync_after_damage(rotation, encoding, seed):
+    rng = random.Random(seed)
+    frames, expected = make_frames(rotation, rng.randint(1, 30), encoding, rng)
+    stream, damaged = corrupt(frames, rng.uniform(0.0, 0.5), rng)
+    # 壊れたヘッダーの長さ分が届くまでフレームは待たされるので，最後に magic を含まないデータで押し出す
+    stream += bytes(server.FRAME_MAX_POINTS * server.FRAME_MAX_POINT_BYTES + server.FRAME_MAX_EXTRA_BYTES)
+    seen, wrong = decode(stream, expected, rng)
+    assert wrong == 0
+    assert set(range(len(frames))) - set(seen) - damaged == set()
@@ -0,0 +1,30 @@
+"""
+metrics_port: 0 binds any free port like the other listeners, None disables /metrics.
+"""
+import urllib.request
+
+from lidar import server
+
+
+def test_port_zero_binds_free_port():
+    lidar_server = server.LidarServer(host="127.0.0.1", lidar_port=0, monitor_ports=(0, 0), metrics_port=0).start()
+    try:
+        assert lidar_server.metrics_port
+        with urllib.request.urlopen(f"http://127.0.0.1:{lidar_server.metrics_port}/metrics", timeout=5) as response:
+            assert response.status == 200
+    finally:
+        lidar_server.close()
+
+
+def test_none_disables_metrics():
+    lidar_server = server.LidarServer(host="127.0.0.1", lidar_port=0, monitor_ports=(0, 0), metrics_port=None).start()
+    try:
+        assert lidar_server.metrics_server is None and lidar_server.metrics_port is None
+    finally:
+        lidar_server.close()
+
+
+def test_command_line():
+    assert server.parse_args(["--no-metrics"]).metrics_port is None
+    assert server.parse_args(["--metrics-port", "0"]).metrics_port == 0
+    assert "metrics_port" not in server.parse_args([])
@@ -0,0 +1,30 @@
+"""
+MonitorManager: viewers are in the client list for exactly as long as their sender thread runs.
+"""
+import socket
+
+from lidar import server
+
+
+def test_failed_negotiation_removes_viewer(monkeypatch):
+    monkeypatch.setattr(server.MonitorClientHandler, "_negotiate_format", lambda self: False)
+    manager = server.MonitorManager()
+    for _ in range(20):
+        server_end, client_end = socket.socketpair()
+        with client_end:
+            handler = manager.add_client(server_end, 8001)
+            handler.thread.join(timeout=5)
+    assert manager.clients_8001 == ()
+
+
+def test_viewer_receives_until_stopped():
+    manager = server.MonitorManager()
+    server_end, client_end = socket.socketpair()
+    with client_end:
+        handler = manager.add_client(server_end, 8002)
+        assert manager.clients_8002 == (handler,)
+        manager.broadcast_8002("hello\n")
+        assert client_end.recv(1024) == b"hello\n"
+        manager.close()
+    assert not handler.thread.is_alive()
+    assert manager.clients_8002 == ()
@@ -0,0 +1,132 @@
+"""
+RotationAssembler and StdoutRotationParser on the ultra_simple output in test.txt.
+"""
+import io
+import os
+import random
+
+import pytest
+
+from lidar import client
+
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test.txt")
+
+
+@pytest.fixture(scope="module")
+def test_output():
+    """test.txt with a newline after its last ("S") line, as ultra_simple prints it."""
+    with open(TEST_FILE, "rb") as f:
+        return f.read().rstrip(b"\n") + b"\n"
+
+
+@pytest.fixture(scope="module")
+def test_points(test_output):
+    """(theta, dist, Q) of the rotation in test.txt; the "S" line starts the next rotation."""
+    points = []
+    for line in test_output.decode().splitlines():
+        fields = line.split()
+        if fields[:1] == ["theta:"]:
+            points.append((int(float(fields[1]) * 100), int(float(fields[3])), int(fields[5])))
+    return points
+
+
+def rotation_points(rotation):
+    return list(zip(rotation.theta, rotation.dist, rotation.quality))
+
+
+def test_rotation_ends_at_start_marker(test_output, test_points):
+    parser = client.StdoutRotationParser()
+    [rotation] = parser.feed(test_output)  # 最後の "S" 行で一周が揃う（"S" 行の点は次の周）
+    assert rotation_points(rotation) == test_points
+    assert len(test_points) == 614
+    assert rotation.stats == client.RotationStats(614, test_points[0][0], test_points[-1][0],
+                                                  max(b[0] - a[0] for a, b in zip(test_points, test_points[1:])))
+    assert client.check_rotation(rotation)
+    assert len(parser.assembler) == 0
+
+
+def test_consecutive_rotations(test_output, test_points):
+    parser = client.StdoutRotationParser()
+    rotations = parser.feed(test_output * 3)
+    assert [rotation_points(rotation) for rotation in rotations] == [test_points] * 3
+    assert all(rotation.stats.count == 614 for rotation in rotations)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_chunk_boundaries(test_output, test_points, seed):
+    """Chunks split anywhere, even inside a line, give the same rotations."""
+    rng = random.Random(seed)
+    data = test_output * 2
+    parser = client.StdoutRotationParser()
+    rotations = []
+    offset = 0
+    while offset < len(data):
+        size = rng.choice([1, 7, 33, rng.randint(1, 4096)])
+        rotations.extend(parser.feed(data[offset:offset + size]))
+        offset += size
+    assert [rotation_points(rotation) for rotation in rotations] == [test_points] * 2
+
+
+def test_partial_trailing_line_waits_for_newline(test_output, test_points):
+    parser = client.StdoutRotationParser()
+    first_line = test_output.index(b"theta:")
+    cut = test_output.index(b"Dist:", first_line)  # 最初の点の行の途中まで
+    assert parser.feed(test_output[:cut]) == []
+    assert len(parser.assembler) == 0
+    assert parser.pending == cut - (test_output.rfind(b"\n", 0, cut) + 1)
+
+    line_end = test_output.index(b"\n", cut) + 1
+    assert parser.feed(test_output[cut:line_end]) == []
+    assert list(zip(parser.assembler.theta, parser.assembler.dist, parser.assembler.quality)) == test_points[:1]
+    assert parser.pending == 0
+
+
+def test_read_from_small_buffer(test_output, test_points):
+    """read_from() carries incomplete lines over a small buffer and parses a last line without newline at EOF."""
+    stream = io.BytesIO(test_output.rstrip(b"\n"))
+    parser = client.StdoutRotationParser(chunk_size=100)
+    rotations = []
+    while True:
+        completed = parser.read_from(stream)
+        if completed is None:
+            break
+        rotations.extend(completed)
+    assert [rotation_points(rotation) for rotation in rotations] == [test_points]
+
+
+def test_invalid_points_are_skipped(test_points):
+    lines = [f"   theta: {theta / 100:.2f} Dist: {dist:08.2f} Q: {quality}" for theta, dist, quality in test_points]
+    lines.insert(100, "   theta: 0.00 Dist: 00000.00 Q: 0")
+    parser = client.StdoutRotationParser()
+    [rotation] = parser.feed(("\n".join(lines) + "\nS  theta: 0.10 Dist: 02756.00 Q: 47\n").encode())
+    assert rotation_points(rotation) == test_points
+
+
+def test_point_count_limits(test_points):
+    parser = client.StdoutRotationParser()
+    lines = "".join(f"theta: {theta / 100:.2f} Dist: {dist:08.2f} Q: {quality}\n"
+                    for theta, dist, quality in test_points[::3])
+    [rotation] = parser.feed((lines + "S\n").encode())
+    assert rotation.stats.count == len(test_points[::3]) < client.ROTATION_MIN_POINTS
+    assert not client.check_rotation(rotation)
+
+
+def test_unordered_rotation_gap(test_points):
+    """Out of order samples fall back to the binned gap, which is exact above ROTATION_MAX_GAP."""
+    rng = random.Random(0)
+    kept = [point for point in test_points if not 10000 <= point[0] <= 12500]  # 25° の抜け
+    shuffled = kept[:]
+    rng.shuffle(shuffled)
+    assembler = client.RotationAssembler()
+    for theta, dist, quality in shuffled:
+        assembler.add(theta, dist, quality)
+    thetas = sorted(point[0] for point in kept)
+    expected_gap = max(b - a for a, b in zip(thetas, thetas[1:]))
+    assert expected_gap > client.ROTATION_MAX_GAP
+    assert assembler.stats() == client.RotationStats(len(kept), thetas[0], thetas[-1], expected_gap)
+    assert client.RotationAssembler.stats_of(thetas) == assembler.stats()
+
+    rotation = assembler.finish(1)
+    assert rotation.stats.max_gap == expected_gap
+    assert not client.check_rotation(rotation)
+    assert len(assembler) == 0 and assembler.stats() == client.RotationStats(0, None, None, 0)
@@ -0,0 +1,72 @@
+"""
+SensorScanCache: the pure-Python and NumPy caches agree, and sector_min() finds the point a brute-force search finds.
+"""
+import os
+import random
+
+import pytest
+
+from lidar import client, server
+
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test.txt")
+
+
+@pytest.fixture(scope="module")
+def base():
+    """The rotation of test.txt as (theta [°], dist) pairs."""
+    with open(TEST_FILE, "rb") as f:
+        [rotation] = client.StdoutRotationParser().feed(f.read().rstrip(b"\n") + b"\n")  # 最後の S 行で一周が完成する
+    return [(theta / 100, dist) for theta, dist in zip(rotation.theta, rotation.dist)]
+
+
+@pytest.fixture(scope="module")
+def numpy_module():
+    numpy_module = server.load_numpy()
+    if numpy_module is None:
+        pytest.skip("NumPy is not installed")
+    return numpy_module
+
+
+def perturbed(base, rng):
+    return [(theta, max(0, dist + rng.randint(-30, 30)) if dist else 0) for theta, dist in base]
+
+
+def brute_force_sector(rotations, start, end, bins=server.SCAN_CACHE_BINS):
+    """(dist, bin) of the nearest point of `rotations` in the sector, the lowest bin on a tie."""
+    best = None
+    ranges = server.sector_bins(start, end, bins)
+    for points in rotations:
+        for theta, dist in points:
+            index = int(theta * (bins / 360.0)) % bins
+            if dist > 0 and any(first <= index < last for first, last in ranges):
+                if best is None or dist < best[0] or (dist == best[0] and index < best[1]):
+                    best = (int(dist), index)
+    return best
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_python_numpy_and_brute_force_agree(base, numpy_module, monkeypatch, seed):
+    rng = random.Random(seed)
+    caches = {}
+    for numpy_or_none in (None, numpy_module):
+        monkeypatch.setattr(server, "np", numpy_or_none)
+        caches[numpy_or_none] = server.SensorScanCache(5, grid=True)
+    history = []
+    for index in range(100):
+        points = perturbed(base, rng)
+        if rng.random() < 0.2:
+            points = rng.sample(points, rng.randrange(len(points)))  # 点の抜けた周
+        history.append(points)
+        start = rng.uniform(-30.0, 360.0)
+        end = start + rng.uniform(0.0, 120.0)
+        rotations = rng.randint(1, 4)
+        expected = brute_force_sector(history[-rotations:], start, end)
+
+        results = []
+        for numpy_or_none, cache in caches.items():
+            monkeypatch.setattr(server, "np", numpy_or_none)
+            cache.update(index, points)
+            nearest = cache.sector_min(start, end, rotations)
+            assert (None if nearest is None else nearest[0]) == (expected and expected[0])
+            results.append((cache.latest_scan(), cache.grid_snapshot()))
+        assert results[0] == results[1]